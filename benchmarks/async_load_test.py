@@ -0,0 +1,68 @@
+"""Throughput of the synchronous and asyncio prompt paths against a local stub backend.
+
+Run with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/async_load_test.py [--requests 200] [--workers 8]
+
+The sync path serves requests on `--workers` threads, like a worker pool would. The async path runs every
+request on one event loop, bounded only by the per-process prompt cap (`--concurrency`).
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stubs
+
+from async_agents import set_max_concurrent_prompts
+
+
+def _report(name: str, requests: int, elapsed: float):
+    print(
+        f"{name:>6}: {requests} requests in {elapsed:6.2f}s = {requests / elapsed:7.2f} req/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--workers", type=int, default=8, help="threads serving the sync path"
+    )
+    parser.add_argument("--concurrency", type=int, default=256, help="async prompt cap")
+    parser.add_argument("--llm-latency", type=float, default=stubs.LATENCIES.llm)
+    parser.add_argument("--search-latency", type=float, default=stubs.LATENCIES.search)
+    args = parser.parse_args()
+
+    stubs.LATENCIES.llm = args.llm_latency
+    stubs.LATENCIES.search = args.search_latency
+    client = stubs.install()
+
+    from api import ExampleDocumentQAService
+
+    service = ExampleDocumentQAService(client=client)
+    # Every request asks something different, so the answer cache does not hide the backend latency.
+    questions = [f"What is fact number {i}?" for i in range(args.requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        sync_answers = list(pool.map(service.prompt, questions))
+    _report("sync", args.requests, time.perf_counter() - start)
+
+    questions = [
+        f"What is fact number {i + args.requests}?" for i in range(args.requests)
+    ]
+    set_max_concurrent_prompts(args.concurrency)
+
+    async def run_async():
+        return await asyncio.gather(*[service.prompt_async(q) for q in questions])
+
+    start = time.perf_counter()
+    async_answers = asyncio.run(run_async())
+    _report("async", args.requests, time.perf_counter() - start)
+
+    assert all(sync_answers) and all(async_answers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""End-to-end latency of each agent service's `prompt`, offline, against the local stand-ins in `stubs`.
+
+Run with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/e2e_latency.py [--services docqa assistant] [--users 1 8]
+        [--requests 40] [--repeat-rate 0.2] [--llm-latency 0.5] [--output e2e_latency.json]
+
+For each service and each number of concurrent users, `--requests` prompts are answered by that many threads.
+Prompts are distinct, so the answer and speech caches miss, except for a `--repeat-rate` fraction that repeats an
+earlier prompt of the same run. The report gives p50/p95/p99 latency, throughput, and a per-stage breakdown: how many calls each request
+made to each stand-in (context, llm, index_search, web_search, image, speech) and the latency charged for them.
+Stages can overlap (speech is synthesized in parallel), so the stage times need not add up to the latency.
+The JSON report also has the service's own span histograms (see `metrics`) for each run.
+
+Results are also written as JSON to `--output`, so runs can be compared with each other.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import stubs
+
+from metrics import METRICS
+
+# Remembered speech and answers would hide the stand-in latencies, since every run asks the same questions.
+os.environ.setdefault("SPEECH_CACHE_PATH", "")
+
+# Service name -> (module, class, prompt template). `{nonce}` keeps the answer and search caches from answering
+# one prompt with the results of another.
+SERVICES: Dict[str, tuple] = {
+    "docqa": ("api", "ExampleDocumentQAService", "What is fact {nonce}?"),
+    "assistant": (
+        "example_agents.annoyed_robot",
+        "MyAssistant",
+        "What is the weather like in {nonce}?",
+    ),
+    "imagesearch": (
+        "example_agents.image_search_agent",
+        "ImageSearchBot",
+        "Who won match {nonce}?",
+    ),
+    "captain": (
+        "example_agents.captain_picard_with_voice",
+        "StarTrekCaptainWithVoice",
+        "Show me starship {nonce}",
+    ),
+}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def load_service(name: str, client):
+    module_name, class_name, _ = SERVICES[name]
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)(client=client)
+
+
+def make_prompts(
+    template: str, count: int, repeat_rate: float, rng: random.Random
+) -> List[str]:
+    prompts: List[str] = []
+    for _ in range(count):
+        if prompts and rng.random() < repeat_rate:
+            prompts.append(rng.choice(prompts))
+        else:
+            prompts.append(
+                template.format(nonce=uuid.UUID(int=rng.getrandbits(128)).hex)
+            )
+    return prompts
+
+
+def measure(prompt: Callable[[str], str], prompts: List[str], users: int) -> dict:
+    """Answer `prompts` on `users` threads; return latency percentiles, throughput and the stage breakdown."""
+
+    def timed(text: str) -> float:
+        started_at = time.perf_counter()
+        prompt(text)
+        return time.perf_counter() - started_at
+
+    stubs.STAGES.reset()
+    METRICS.reset()
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        latencies = sorted(pool.map(timed, prompts))
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        "users": users,
+        "requests": len(prompts),
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "mean_s": sum(latencies) / len(latencies),
+        "throughput_rps": len(prompts) / elapsed,
+        "stages": {
+            stage: {
+                "calls_per_request": totals["calls"] / len(prompts),
+                "seconds_per_request": totals["seconds"] / len(prompts),
+            }
+            for stage, totals in sorted(stubs.STAGES.snapshot().items())
+        },
+        "spans": {
+            name: {key: value for key, value in histogram.items() if key != "buckets"}
+            for name, histogram in METRICS.snapshot()["stages"].items()
+        },
+    }
+
+
+def _print_result(service: str, result: dict):
+    stages = ", ".join(
+        f"{stage} {s['calls_per_request']:.1f}x {s['seconds_per_request']:.2f}s"
+        for stage, s in result["stages"].items()
+    )
+    print(
+        f"{service:>12} {result['users']:>6} {result['p50_s']:>7.2f} {result['p95_s']:>7.2f} "
+        f"{result['p99_s']:>7.2f} {result['throughput_rps']:>8.2f}  {stages}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--services", nargs="+", choices=list(SERVICES), default=list(SERVICES)
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--repeat-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="e2e_latency.json")
+    for stage in ("context", "llm", "search", "web_search", "image", "speech"):
+        parser.add_argument(
+            f"--{stage.replace('_', '-')}-latency",
+            type=float,
+            default=getattr(stubs.LATENCIES, stage),
+        )
+    args = parser.parse_args()
+
+    for stage in ("context", "llm", "search", "web_search", "image", "speech"):
+        setattr(stubs.LATENCIES, stage, getattr(args, f"{stage}_latency"))
+    client = stubs.install()
+
+    rng = random.Random(args.seed)
+    results = []
+    print(
+        f"{'service':>12} {'users':>6} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'req/s':>8}  stages per request"
+    )
+    for name in args.services:
+        service = load_service(name, client)
+        template = SERVICES[name][2]
+        for users in args.users:
+            # Each run asks new questions, so no cache answers them from an earlier run.
+            prompts = make_prompts(template, args.requests, args.repeat_rate, rng)
+            result = measure(service.prompt, prompts, users)
+            result["service"] = name
+            results.append(result)
+            _print_result(name, result)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "repeat_rate": args.repeat_rate,
+        "seed": args.seed,
+        "latencies": {
+            name: getattr(stubs.LATENCIES, name)
+            for name in vars(stubs.StubLatencies)
+            if not name.startswith("_")
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Ingestion throughput (docs/min) of the bulk indexer, using a stand-in fetcher instead of the network.
+
+Run with:
+
+    PYTHONPATH=src python benchmarks/ingestion_throughput.py [--docs 400] [--fetch-latency 0.2] [--workers 1 8 32]
+
+The stand-in fetcher waits `--fetch-latency` seconds and returns a generated HTML page; every tenth URL repeats
+an earlier page's content and every twentieth fails once, so de-duplication and retries are exercised too.
+Documents are indexed into a throwaway local index.
+"""
+import argparse
+import tempfile
+import threading
+import time
+from typing import Tuple
+
+from ingestion import BulkIngester
+from local_index import LocalEmbeddingIndex, index_content_locally
+
+
+class StandInFetcher:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, url: str) -> Tuple[bytes, str]:
+        time.sleep(self.latency)
+        doc = int(url.rsplit("/", 1)[-1])
+        if doc % 20 == 19:
+            with self._lock:
+                if url not in self._failed:
+                    self._failed.add(url)
+                    raise ConnectionError("stand-in transient failure")
+        page = doc - 1 if doc % 10 == 9 else doc
+        body = " ".join(
+            f"<p>Document {page} paragraph {i}: wheat, rice and pulses need care.</p>"
+            for i in range(40)
+        )
+        return f"<html><body>{body}</body></html>".encode(), "text/html"
+
+
+def run(docs: int, fetch_latency: float, workers: int):
+    with tempfile.TemporaryDirectory() as root:
+        index = LocalEmbeddingIndex(root)
+        ingester = BulkIngester(max_workers=workers, backoff_s=0.01)
+        job = ingester.start(
+            [f"https://example.com/docs/{i}" for i in range(docs)],
+            index_document=lambda url, content, mime_type: index_content_locally(
+                index, url, content, mime_type
+            ),
+            fetcher=StandInFetcher(fetch_latency),
+        )
+        job.wait()
+        progress = job.progress()
+        print(
+            f"{workers:>8} {progress['done']:>6} {progress['duplicate']:>10} {progress['failed']:>7} "
+            f"{progress['elapsed_s']:>10.2f} {progress['docs_per_min']:>12.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=400)
+    parser.add_argument("--fetch-latency", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    print(
+        f"{'workers':>8} {'done':>6} {'duplicate':>10} {'failed':>7} {'seconds':>10} {'docs/min':>12}"
+    )
+    for workers in args.workers:
+        run(args.docs, args.fetch_latency, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Query latency of the local embedding index as the corpus grows.
+
+Run with:
+
+    PYTHONPATH=src python benchmarks/local_index_latency.py [corpus sizes...]
+
+For each corpus size this builds a throwaway index of clustered unit vectors (queries are perturbed corpus rows)
+and reports p50/p95 query latency for brute-force and IVF search, plus IVF recall@k against brute force.
+"""
+
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from local_index import HashingEmbedder, LocalEmbeddingIndex
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+QUERIES = 200
+K = 5
+
+
+def _percentile_ms(samples: List[float], percentile: float) -> float:
+    return float(np.percentile(samples, percentile) * 1000)
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def _search_all(
+    index: LocalEmbeddingIndex, queries: np.ndarray
+) -> Tuple[List[float], List[set]]:
+    timings, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found = index.search_embedding(query, k=K)
+        timings.append(time.perf_counter() - start)
+        results.append({item.tag.text for item in found.items})
+    return timings, results
+
+
+def run(sizes: List[int]):
+    embedder = HashingEmbedder()
+    rng = np.random.default_rng(42)
+
+    print(f"{'rows':>10} {'mode':>6} {'p50 ms':>9} {'p95 ms':>9} {'recall@k':>9}")
+    for size in sizes:
+        centers = _unit(
+            rng.standard_normal((max(1, size // 100), embedder.dimensionality))
+        )
+        vectors = _unit(
+            centers[rng.integers(0, len(centers), size)]
+            + 0.5
+            * rng.standard_normal((size, embedder.dimensionality))
+            / np.sqrt(embedder.dimensionality)
+        )
+        queries = _unit(
+            vectors[rng.integers(0, size, QUERIES)]
+            + 0.3
+            * rng.standard_normal((QUERIES, embedder.dimensionality))
+            / np.sqrt(embedder.dimensionality)
+        )
+
+        with tempfile.TemporaryDirectory() as path:
+            index = LocalEmbeddingIndex(path, embedder=embedder, search_mode="brute")
+            index.insert_embeddings(
+                vectors, [{"text": str(i), "value": {}} for i in range(size)]
+            )
+            brute, expected = _search_all(index, queries)
+
+            index.search_mode = "ivf"
+            index.build_ivf()
+            ivf, found = _search_all(index, queries)
+            recall = np.mean([len(e & f) / len(e) for e, f in zip(expected, found)])
+
+            print(
+                f"{size:>10} {'brute':>6} {_percentile_ms(brute, 50):>9.3f} {_percentile_ms(brute, 95):>9.3f}"
+            )
+            print(
+                f"{size:>10} {'ivf':>6} {_percentile_ms(ivf, 50):>9.3f} {_percentile_ms(ivf, 95):>9.3f} "
+                f"{recall:>9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
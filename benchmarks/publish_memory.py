@@ -0,0 +1,89 @@
+"""Peak memory of publishing a block's content, buffered (the old path) versus streamed.
+
+Run with:
+
+    PYTHONPATH=src python benchmarks/publish_memory.py [sizes in MB...]
+
+A local HTTP stand-in, in a separate process, serves block content of the requested size and accepts uploads
+(discarding them while reading in small pieces). For each size, the buffered path downloads the content into one
+bytes object and uploads it; the streamed path pipes it through `stream_to_signed_url`. Peak memory is measured
+with tracemalloc, so it counts the Python allocations of this process only.
+"""
+import multiprocessing
+import sys
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from steamship import Block
+from steamship.utils.signed_urls import upload_to_signed_url
+
+from utils import open_block_content, stream_to_signed_url
+
+DEFAULT_SIZES_MB = [1, 16, 64]
+_PIECE = bytes(range(256)) * 256  # 64 KiB
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802
+        size = int(self.path.rsplit("/", 1)[-1])
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Content-Type", "audio/mp3")
+        self.end_headers()
+        sent = 0
+        while sent < size:
+            piece = _PIECE[: size - sent]
+            self.wfile.write(piece)
+            sent += len(piece)
+
+    def do_PUT(self):  # noqa: N802
+        remaining = int(self.headers["Content-Length"])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, len(_PIECE))))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(port_queue):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _peak_mb(publish) -> float:
+    tracemalloc.start()
+    publish()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def run(sizes_mb):
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(port_queue,), daemon=True)
+    server.start()
+    base = f"http://127.0.0.1:{port_queue.get()}"
+
+    print(f"{'size MB':>8} {'buffered peak MB':>17} {'streamed peak MB':>17}")
+    try:
+        for size_mb in sizes_mb:
+            size = int(size_mb * 2**20)
+            block = Block(content_url=f"{base}/content/{size}", mime_type="audio/mp3")
+            buffered = _peak_mb(
+                lambda: upload_to_signed_url(f"{base}/upload", block.raw())
+            )
+            streamed = _peak_mb(
+                lambda: stream_to_signed_url(
+                    f"{base}/upload", open_block_content(None, block)
+                )
+            )
+            print(f"{size_mb:>8} {buffered:>17.1f} {streamed:>17.1f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    run([float(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES_MB)
@@ -0,0 +1,120 @@
+"""A burst of prompts against a stub LLM that answers with 429s beyond a set rate, with and without pacing.
+
+Run with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/rate_limit_burst.py [--requests 40] [--users 20] [--stub-rps 5]
+        [--batch 10]
+
+`--batch` batch LLM calls (standing in for background work) are queued first, then `--users` threads send `--requests`
+document questions at once. Each run is made twice: "reactive" lifts the scheduler's limits, so calls go out as they
+come and only back off after a 429; "paced" sets the request limit to `--rpm` (by default 90% of the stub's rate), so
+calls are admitted as the limit allows, interactive ones first. The report gives interactive latency, how long the
+batch took, the 429s seen, calls that failed for good, and the scheduler's queue and admission wait statistics.
+"""
+import argparse
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional
+
+import stubs
+from e2e_latency import percentile
+
+from rate_limit import BATCH, SCHEDULER
+
+
+def run(service, client, args, requests_per_minute: Optional[float]) -> dict:
+    SCHEDULER.configure(requests_per_minute, None)
+    SCHEDULER.reset_stats()
+    stubs.RATE_LIMITS.reset()
+    stubs.STAGES.reset()
+    generator = client.use_plugin("gpt-4")
+
+    def batch_call():
+        return SCHEDULER.call(
+            lambda: generator.generate(text="Embed this document.").wait(),
+            priority=BATCH,
+        )
+
+    def prompt(question: str) -> Optional[float]:
+        started_at = time.perf_counter()
+        try:
+            service.prompt(question)
+        except Exception:
+            return None
+        return time.perf_counter() - started_at
+
+    questions = [f"What is fact {uuid.uuid4().hex}?" for _ in range(args.requests)]
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.batch)) as batch_pool:
+        batch = [batch_pool.submit(batch_call) for _ in range(args.batch)]
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            results = list(pool.map(prompt, questions))
+        wait(batch)
+        batch_s = time.perf_counter() - started_at
+    latencies = sorted(r for r in results if r is not None)
+    stats = SCHEDULER.stats()
+    return {
+        "requests_per_minute": requests_per_minute,
+        "failed_prompts": results.count(None),
+        "failed_batch": sum(1 for f in batch if f.exception() is not None),
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "max_s": latencies[-1] if latencies else 0.0,
+        "batch_s": batch_s,
+        "upstream_429s": stubs.STAGES.snapshot().get("llm_429", {}).get("calls", 0),
+        "scheduler": {
+            key: value
+            for key, value in stats.items()
+            if key not in ("wait", "paused_s")
+        },
+        "wait": {
+            name: {key: value for key, value in waits.items() if key != "buckets"}
+            for name, waits in stats["wait"].items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=10)
+    parser.add_argument("--stub-rps", type=float, default=5.0)
+    parser.add_argument("--rpm", type=float, default=None)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--output", default="rate_limit_burst.json")
+    args = parser.parse_args()
+
+    stubs.LATENCIES.llm = args.llm_latency
+    stubs.LATENCIES.search = 0.01
+    stubs.RATE_LIMITS.llm_per_s = args.stub_rps
+    client = stubs.install()
+
+    from api import ExampleDocumentQAService
+
+    service = ExampleDocumentQAService(client=client)
+    rpm = args.rpm or args.stub_rps * 60 * 0.9
+    results = {}
+    print(
+        f"{'mode':>9} {'p50 s':>7} {'p95 s':>7} {'max s':>7} {'batch s':>8} {'429s':>5} {'failed':>6} "
+        f"{'max queue':>9} {'interactive wait p95 s':>22}"
+    )
+    for mode, requests_per_minute in (("reactive", None), ("paced", rpm)):
+        result = results[mode] = run(service, client, args, requests_per_minute)
+        interactive_wait = result["wait"].get("interactive", {}).get("p95_s", 0.0)
+        print(
+            f"{mode:>9} {result['p50_s']:>7.2f} {result['p95_s']:>7.2f} {result['max_s']:>7.2f} "
+            f"{result['batch_s']:>8.2f} {result['upstream_429s']:>5} "
+            f"{result['failed_prompts'] + result['failed_batch']:>6} "
+            f"{result['scheduler']['max_queue_depth']:>9} {interactive_wait:>22.2f}"
+        )
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"args": vars(args), "results": results}, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Time to first audio of a spoken reply: synthesized whole (the old path) versus a sentence at a time.
+
+Run with:
+
+    PYTHONPATH=src python benchmarks/speech_latency.py [--sentences 2 6 12] [--ms-per-char 8]
+
+A stand-in synthesizer takes a fixed 150 ms per call plus `--ms-per-char` per character, roughly how a
+text-to-speech API's latency grows with the length of its input.
+"""
+import argparse
+import time
+
+from steamship import Block
+
+from speech import SpeechPipeline
+
+SENTENCE = (
+    "The Enterprise will hold position near the nebula until the away team returns."
+)
+
+
+def stand_in_synthesizer(ms_per_char: float):
+    def synthesize(text: str) -> Block:
+        time.sleep(0.15 + len(text) * ms_per_char / 1000)
+        return Block(text=f"<audio of {len(text)} chars>")
+
+    return synthesize
+
+
+def run(sentences: int, ms_per_char: float):
+    reply = " ".join([SENTENCE] * sentences)
+    synthesize = stand_in_synthesizer(ms_per_char)
+
+    started_at = time.perf_counter()
+    synthesize(reply)
+    whole = time.perf_counter() - started_at
+
+    report = SpeechPipeline().emit([Block(text=reply)], synthesize, [], {})
+    print(
+        f"{sentences:>10} {whole:>14.2f} {report['time_to_first_audio_s']:>17.2f} {report['total_s']:>15.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sentences", type=int, nargs="+", default=[2, 6, 12])
+    parser.add_argument("--ms-per-char", type=float, default=8)
+    args = parser.parse_args()
+
+    print(
+        f"{'sentences':>10} {'whole reply s':>14} {'pipelined first s':>17} {'pipelined all s':>15}"
+    )
+    for sentences in args.sentences:
+        run(sentences, args.ms_per_char)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Local stand-ins for the Steamship backend, used by the benchmarks to run agent services offline.
+
+`install()` patches `AgentContext.get_or_create` to use an in-memory chat history, and `StubSteamship` hands
+out fake plugin instances (LLM generator, embedding index, web search, image generators, text-to-speech) whose
+work completes after a configurable latency. The latency charged to each kind of call is added up in `STAGES`.
+`RATE_LIMITS` makes the LLM generator answer with 429s beyond a given rate.
+Nothing here talks to the network.
+"""
+import asyncio
+import itertools
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from types import SimpleNamespace
+from typing import Deque, Dict, List, Optional
+
+from steamship import Block, MimeTypes, Steamship, SteamshipError, Tag, Task, TaskState
+from steamship.agents.memory import ChatHistory
+from steamship.agents.schema import AgentContext
+from steamship.base.configuration import Configuration
+from steamship.data.plugin.index_plugin_instance import SearchResult, SearchResults
+from steamship.data.plugin.plugin_instance import PluginInstance
+from steamship.data.tags.tag_constants import TagValueKey
+
+# Completions cached on disk by an earlier run would hide the stand-in LLM latency, and OpenAI's rate limits do
+# not apply to the stand-ins. Import this module before the agent services, unless COMPLETION_CACHE_PATH or
+# RATE_LIMIT_RPM/RATE_LIMIT_TPM are set to measure with them.
+os.environ.setdefault("COMPLETION_CACHE_PATH", "")
+os.environ.setdefault("RATE_LIMIT_RPM", "0")
+os.environ.setdefault("RATE_LIMIT_TPM", "0")
+
+
+class StubLatencies:
+    """Fake latencies, in seconds, for each kind of remote call."""
+
+    context = 0.05  # AgentContext.get_or_create
+    llm = 0.5  # one LLM completion
+    search = 0.1  # one embedding index search
+    web_search = 0.8  # one web search
+    image = 2.0  # one generated or fetched image
+    speech = 0.3  # one text-to-speech call, plus `speech_per_char` for each character
+    speech_per_char = 0.005
+
+
+LATENCIES = StubLatencies()
+
+
+class StubRateLimits:
+    """Rejects LLM completions beyond `llm_per_s` in any one second with a 429, as OpenAI does. None is no limit."""
+
+    def __init__(self):
+        self.llm_per_s: Optional[float] = None
+        self._recent: Deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def check(self):
+        if self.llm_per_s is None:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            while self._recent and self._recent[0] <= now - 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.llm_per_s:
+                STAGES.record("llm_429", 0.0)
+                # As a failed generation task does: OpenAI's message, and no error code.
+                raise SteamshipError(
+                    message="Rate limit reached for gpt-3.5-turbo in organization org-stub on requests per min."
+                )
+            self._recent.append(now)
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+
+
+RATE_LIMITS = StubRateLimits()
+
+
+class StageTimes:
+    """Calls made to each stand-in, and the latency charged for them, across all threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, int] = {}
+        self._seconds: Dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._calls[stage] = self._calls.get(stage, 0) + 1
+            self._seconds[stage] = self._seconds.get(stage, 0.0) + seconds
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                stage: {"calls": self._calls[stage], "seconds": self._seconds[stage]}
+                for stage in self._calls
+            }
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._seconds.clear()
+
+
+STAGES = StageTimes()
+
+_ids = itertools.count()
+
+
+class StubTask:
+    """Duck-typed Task that succeeds once its latency has elapsed."""
+
+    def __init__(self, output, latency: float, stage: Optional[str] = None):
+        if stage:
+            STAGES.record(stage, latency)
+        self.task_id = f"stub-task-{next(_ids)}"
+        self.output = output
+        self.state = TaskState.running
+        self.ready_at = time.perf_counter() + latency
+
+    def refresh(self):
+        if time.perf_counter() >= self.ready_at:
+            self.state = TaskState.succeeded
+
+    def wait(self, *args, **kwargs):
+        time.sleep(max(0.0, self.ready_at - time.perf_counter()))
+        self.refresh()
+        return self.output
+
+
+_TOOL_NAMES = re.compile(r"should be one of \[+([^\]]*)\]")
+_QUESTION = re.compile(r"Question: (.*)\n")
+
+
+def stub_completion(prompt: str) -> str:
+    """A plausible completion for the prompts the agents send.
+
+    Question answering prompts get an answer. ReACT prompts call the first listed tool (or, if the prompt allows
+    several actions at once, each listed tool), then finish with the last observation once there is one.
+    """
+    question = _QUESTION.search(prompt)
+    if question:
+        return f"Stub answer to: {question.group(1)}"
+    scratchpad = prompt.rsplit("New input:", 1)[-1]
+    if "Observation:" in scratchpad:
+        observation = scratchpad.rsplit("Observation:", 1)[-1].strip().split("\n")[0]
+        return f" Do I need to use a tool? No\nAI: {observation}"
+    tools = _TOOL_NAMES.search(prompt)
+    names = re.findall(r"\w+", tools.group(1)) if tools else []
+    user_input = scratchpad.split("\n", 1)[0].strip()
+    if not names:
+        return f" Do I need to use a tool? No\nAI: You said {user_input}"
+    if "of them at once" not in prompt:
+        names = names[:1]
+    actions = "".join(f"\nAction: {name}\nAction Input: {user_input}" for name in names)
+    return f" Do I need to use a tool? Yes{actions}"
+
+
+class StubGenerator(PluginInstance):
+    """Stands in for the OpenAI generator plugin instance."""
+
+    def generate(
+        self, text: Optional[str] = None, options: Optional[dict] = None, **kwargs
+    ):
+        RATE_LIMITS.check()
+        output = SimpleNamespace(blocks=[Block(text=stub_completion(text or ""))])
+        return StubTask(output, LATENCIES.llm, "llm")
+
+
+class StubMediaGenerator(PluginInstance):
+    """Stands in for image generation, image search and text-to-speech plugin instances."""
+
+    def generate(self, text: Optional[str] = None, **kwargs):
+        if self.handle == "elevenlabs":
+            latency = LATENCIES.speech + LATENCIES.speech_per_char * len(text or "")
+            stage, mime_type = "speech", MimeTypes.MP3
+        else:
+            latency, stage, mime_type = LATENCIES.image, "image", MimeTypes.PNG
+        block = Block(id=f"{uuid.uuid4()}", mime_type=mime_type)
+        return StubTask(SimpleNamespace(blocks=[block]), latency, stage)
+
+
+class StubWebSearch(PluginInstance):
+    """Stands in for the SERP API plugin instance used by SearchTool."""
+
+    def tag(self, doc: str, **kwargs):
+        result = Tag(
+            kind="search-result",
+            value={TagValueKey.STRING_VALUE: f"Top web result about {doc}."},
+        )
+        output = SimpleNamespace(file=SimpleNamespace(blocks=[Block(tags=[result])]))
+        return StubTask(output, LATENCIES.web_search, "web_search")
+
+
+class StubIndex:
+    """Stands in for the embedding index plugin instance."""
+
+    def _results(self, query: str, k: Optional[int]) -> SearchResults:
+        return SearchResults(
+            items=[
+                SearchResult(
+                    tag=Tag(text=f"Passage {i} about {query}."), score=1.0 - i / 10
+                )
+                for i in range(k or 1)
+            ]
+        )
+
+    def insert(self, tags: List[Tag], **kwargs):
+        pass
+
+    def search(self, query: str, k: Optional[int] = None) -> Task:
+        STAGES.record("index_search", LATENCIES.search)
+        time.sleep(LATENCIES.search)
+        return Task(state=TaskState.succeeded, output=self._results(query, k))
+
+    async def asearch(self, query: str, k: Optional[int] = None) -> SearchResults:
+        STAGES.record("index_search", LATENCIES.search)
+        await asyncio.sleep(LATENCIES.search)
+        return self._results(query, k)
+
+
+MEDIA_PLUGINS = {"stable-diffusion", "dall-e", "google-image-search", "elevenlabs"}
+
+
+class StubSteamship(Steamship):
+    """Steamship client whose plugins are the stubs above. Create with `StubSteamship.construct()`."""
+
+    def use_plugin(
+        self, plugin_handle: str, instance_handle: Optional[str] = None, **kwargs
+    ):
+        if plugin_handle == "embedding-index":
+            return StubIndex()
+        if plugin_handle == "serpapi-wrapper":
+            return StubWebSearch.construct(client=self, handle=plugin_handle)
+        if plugin_handle in MEDIA_PLUGINS:
+            return StubMediaGenerator.construct(client=self, handle=plugin_handle)
+        return StubGenerator.construct(
+            client=self,
+            handle=instance_handle or plugin_handle,
+            config=kwargs.get("config"),
+        )
+
+
+class StubFile:
+    """In-memory stand-in for the File behind a ChatHistory."""
+
+    def __init__(self, file_id: str):
+        self.id = file_id
+        self.blocks: List[Block] = []
+        self.tags: List[Tag] = []
+
+    def append_block(
+        self, text: Optional[str] = None, tags: Optional[List[Tag]] = None, **kwargs
+    ) -> Block:
+        block = Block(
+            id=f"stub-block-{next(_ids)}", file_id=self.id, text=text, tags=tags or []
+        )
+        self.blocks.append(block)
+        return block
+
+    def refresh(self):
+        return self
+
+
+def _stub_get_or_create(client, context_keys: dict, tags=None) -> AgentContext:
+    STAGES.record("context", LATENCIES.context)
+    time.sleep(LATENCIES.context)
+    context = AgentContext()
+    context.chat_history = ChatHistory(StubFile(context_keys.get("id", "stub")))
+    context.client = client
+    return context
+
+
+def install() -> StubSteamship:
+    """Route AgentContext creation to the in-memory stub and return a stub client to build services with."""
+    AgentContext.get_or_create = staticmethod(_stub_get_or_create)
+    return StubSteamship.construct(
+        config=Configuration.construct(workspace_handle="stub-workspace")
+    )
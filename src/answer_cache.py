@@ -0,0 +1,213 @@
+"""In-process cache of answers produced by the question answering tool.
+
+Answers are keyed on the normalized question plus the version of the index they were computed against.
+A question may also reuse the answer to one worded slightly differently: their character trigrams must be at least
+`DEFAULT_SIMILARITY_THRESHOLD` similar (a `similarity_threshold` of 1.0 allows exact matches only), and they must
+have the same content words, numbers and negations. "How do I treat aphids on wheat?" and "how to treat aphids on
+wheat" (0.82) share an answer, while "...DAP for 10 acres?" and "...DAP for 1 acre?" never do, however similar.
+
+Index versions are counted in this process only. `bump_index_version` invalidates the answers cached by this
+process; other worker processes serving the same index keep answering from their own caches until those answers
+expire (`ttl_seconds`, an hour by default), even when the index changed under them.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from steamship import Block
+
+# The embedding index instance handle used when no explicit handle is provided.
+DEFAULT_INDEX_HANDLE = "default-embedding-index"
+
+# Trigram similarity at which a differently worded question with the same content words reuses an answer.
+DEFAULT_SIMILARITY_THRESHOLD = 0.8
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Words that can differ between two wordings of the same question. Negations and question words are not among them.
+_FILLER_WORDS = frozenset(
+    "a an the do does did i me my we our you your it its this that these those to of on in at for with by from "
+    "and or is are am be should could would will shall please".split()
+)
+
+_index_versions: Dict[str, int] = {}
+_index_versions_lock = threading.Lock()
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase a question and strip punctuation and extra whitespace."""
+    return " ".join(_WORD_PATTERN.findall((question or "").lower()))
+
+
+def _trigrams(normalized: str) -> FrozenSet[str]:
+    padded = f"  {normalized} "
+    return frozenset(padded[i : i + 3] for i in range(len(padded) - 2))
+
+
+def content_words(normalized: str) -> FrozenSet[str]:
+    """The words of a normalized question that a near match must share: all but filler words."""
+    return frozenset(_WORD_PATTERN.findall(normalized)) - _FILLER_WORDS
+
+
+def question_similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """Dice coefficient between two trigram sets (1.0 means identical)."""
+    if not a or not b:
+        return 0.0
+    return 2.0 * len(a & b) / (len(a) + len(b))
+
+
+def get_index_version(index_handle: Optional[str] = None) -> int:
+    """Return the current content version of an index."""
+    with _index_versions_lock:
+        return _index_versions.get(index_handle or DEFAULT_INDEX_HANDLE, 0)
+
+
+def bump_index_version(index_handle: Optional[str] = None) -> int:
+    """Mark an index as changed, invalidating every answer this process cached against its previous content.
+
+    Other processes are not told; see the module docstring.
+    """
+    handle = index_handle or DEFAULT_INDEX_HANDLE
+    with _index_versions_lock:
+        _index_versions[handle] = _index_versions.get(handle, 0) + 1
+        return _index_versions[handle]
+
+
+class _CacheEntry:
+    __slots__ = ("blocks", "trigrams", "words", "expires_at")
+
+    def __init__(
+        self,
+        blocks: List[Block],
+        trigrams: FrozenSet[str],
+        words: FrozenSet[str],
+        expires_at: float,
+    ):
+        self.blocks = blocks
+        self.trigrams = trigrams
+        self.words = words
+        self.expires_at = expires_at
+
+
+class AnswerCache:
+    """LRU + TTL cache of question answers, scoped to an index handle and version."""
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, int, str], _CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(
+        self,
+        question: str,
+        index_handle: Optional[str] = None,
+        similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+    ) -> Optional[List[Block]]:
+        """Return a cached answer for `question`, or None.
+
+        An exact match on the normalized question is tried first. If `similarity_threshold` is below 1.0,
+        the most similar cached question against the same index version is used when it scores at least
+        that threshold and has the same content words (see `content_words`).
+        """
+        handle = index_handle or DEFAULT_INDEX_HANDLE
+        normalized = normalize_question(question)
+        key = (handle, get_index_version(handle), normalized)
+        now = time.monotonic()
+
+        with self._lock:
+            self._drop_expired(now)
+            entry = self._entries.get(key)
+            if entry is None and similarity_threshold < 1.0:
+                key, entry = self._closest(key, similarity_threshold)
+                if entry is not None:
+                    self.near_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [block.copy() for block in entry.blocks]
+
+    def put(
+        self,
+        question: str,
+        blocks: List[Block],
+        index_handle: Optional[str] = None,
+        index_version: Optional[int] = None,
+    ):
+        """Store the answer to `question`.
+
+        Pass the `index_version` observed *before* searching the index so that an answer computed while new
+        content was being added is not stored against the newer version.
+        """
+        handle = index_handle or DEFAULT_INDEX_HANDLE
+        normalized = normalize_question(question)
+        if index_version is None:
+            index_version = get_index_version(handle)
+        key = (handle, index_version, normalized)
+        entry = _CacheEntry(
+            blocks=[block.copy() for block in blocks],
+            trigrams=_trigrams(normalized),
+            words=content_words(normalized),
+            expires_at=time.monotonic() + self.ttl_seconds,
+        )
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+    def _closest(
+        self, key: Tuple[str, int, str], similarity_threshold: float
+    ) -> Tuple[Optional[Tuple[str, int, str]], Optional[_CacheEntry]]:
+        handle, version, normalized = key
+        trigrams = _trigrams(normalized)
+        words = content_words(normalized)
+        best_key, best_entry, best_score = None, None, similarity_threshold
+        for candidate_key, candidate in self._entries.items():
+            if candidate_key[0] != handle or candidate_key[1] != version:
+                continue
+            if candidate.words != words:
+                continue
+            score = question_similarity(trigrams, candidate.trigrams)
+            if score >= best_score:
+                best_key, best_entry, best_score = candidate_key, candidate, score
+        return best_key, best_entry
+
+    def _drop_expired(self, now: float):
+        expired = [
+            key for key, entry in self._entries.items() if entry.expires_at <= now
+        ]
+        for key in expired:
+            del self._entries[key]
+            self.evictions += 1
+
+
+# Shared by every VectorSearchQATool in the process so that invalidation from the service is seen by all of them.
+ANSWER_CACHE = AnswerCache()
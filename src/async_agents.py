@@ -0,0 +1,386 @@
+"""Asyncio support for agent services.
+
+The Steamship SDK is synchronous. These helpers keep the event loop free while waiting on remote work: short
+HTTP calls (submitting a task, refreshing its status) run on a shared thread pool, and the potentially long wait
+between status checks is an `asyncio.sleep`, so no thread is tied up while OpenAI is generating a response.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from steamship import Block, SteamshipError, Task, TaskState
+from steamship.agents.llms.openai import OpenAI
+from steamship.agents.react import ReACTAgent
+from steamship.agents.react.output_parser import ReACTOutputParser
+from steamship.agents.schema import LLM, Action, Agent, AgentContext, FinishAction, Tool
+from steamship.agents.schema.context import Metadata
+from steamship.agents.utils import with_llm
+from steamship.invocable import get
+
+from cassette import CASSETTE, decode_blocks, encode_blocks, llm_key, tool_key
+from context_pool import CONTEXT_POOL, record_reply
+from history_window import HISTORY_POLICY_KEY, HISTORY_WINDOW, HistoryPolicy
+from llm_cache import COMPLETION_CACHE, default_llm
+from metrics import METRICS
+from parallel_actions import (
+    ParallelReACTOutputParser,
+    action_steps,
+    parallel_actions_prompt,
+)
+from rate_limit import SCHEDULER, all_stats, scheduler_for, tool_upstream
+from scratchpad import bounded_scratchpad, record_prompt_tokens
+from search_cache import SEARCH_CACHE
+from streaming import OBSERVERS_KEY, StreamEvent, StreamingAgentService
+from utils import count_tokens
+
+MAX_CONCURRENT_PROMPTS_ENV = "MAX_CONCURRENT_PROMPTS"
+DEFAULT_MAX_CONCURRENT_PROMPTS = 256
+
+# Threads used only for the short, blocking SDK calls; waiting happens on the event loop.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ASYNC_IO_THREADS", "64")),
+    thread_name_prefix="steamship-io",
+)
+
+_prompt_slots: Dict[int, asyncio.Semaphore] = {}
+_prompt_slots_lock = threading.Lock()
+_max_concurrent_prompts = int(
+    os.environ.get(MAX_CONCURRENT_PROMPTS_ENV, DEFAULT_MAX_CONCURRENT_PROMPTS)
+)
+
+
+def set_max_concurrent_prompts(limit: int):
+    """Change the per-process cap on in-flight async prompts. Applies to event loops that have not run one yet."""
+    global _max_concurrent_prompts
+    with _prompt_slots_lock:
+        _max_concurrent_prompts = limit
+        _prompt_slots.clear()
+
+
+def prompt_slots() -> asyncio.Semaphore:
+    """The semaphore bounding concurrent async prompts on the running event loop."""
+    loop_id = id(asyncio.get_running_loop())
+    with _prompt_slots_lock:
+        if loop_id not in _prompt_slots:
+            _prompt_slots[loop_id] = asyncio.Semaphore(_max_concurrent_prompts)
+        return _prompt_slots[loop_id]
+
+
+async def run_sync(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking call on the I/O thread pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _executor, METRICS.propagate(functools.partial(func, *args, **kwargs))
+    )
+
+
+async def wait_task(
+    task: Task,
+    max_timeout_s: float = 180,
+    initial_delay_s: float = 0.1,
+    max_delay_s: float = 1.0,
+) -> Any:
+    """Awaitable equivalent of `Task.wait()`.
+
+    Polls with a delay that starts at `initial_delay_s` and grows to `max_delay_s`, so short tasks return
+    sooner than with `Task.wait()`'s fixed one-second delay. A failed task raises a SteamshipError with its status,
+    so that rate limited completions can be told apart and retried (see `rate_limit`).
+    """
+    t0 = time.perf_counter()
+    delay = initial_delay_s
+    while task.state not in (TaskState.succeeded, TaskState.failed):
+        if time.perf_counter() - t0 >= max_timeout_s:
+            raise SteamshipError(
+                message=f"Task {task.task_id} did not complete within requested timeout of {max_timeout_s}s."
+            )
+        await asyncio.sleep(delay)
+        await run_sync(task.refresh)
+        delay = min(delay * 1.5, max_delay_s)
+    if task.state == TaskState.failed:
+        raise SteamshipError(
+            message=task.status_message or f"Task {task.task_id} failed.",
+            code=task.status_code,
+        )
+    return task.output
+
+
+async def complete_async(
+    llm: LLM, prompt: str, stop: Optional[str] = None
+) -> List[Block]:
+    """Awaitable `llm.complete`.
+
+    LLMs that provide `acomplete` are awaited directly. Steamship's OpenAI LLM is driven through its generator
+    plugin so that only the submission occupies a thread. Anything else runs on the I/O thread pool. Completions
+    that reach the model wait to be admitted under the rate limits (see `rate_limit`), and are recorded or
+    replayed by the cassette, if one is in use.
+    """
+
+    async def upstream() -> List[Block]:
+        if isinstance(llm, OpenAI):
+            options = {"stop": stop} if stop else {}
+            task = await run_sync(llm.generator.generate, text=prompt, options=options)
+            await wait_task(task)
+            return task.output.blocks
+        return await run_sync(llm.complete, prompt=prompt, stop=stop)
+
+    async def complete() -> List[Block]:
+        if hasattr(llm, "acomplete"):
+            return await llm.acomplete(prompt=prompt, stop=stop)
+        return await SCHEDULER.acall(
+            upstream, tokens=SCHEDULER.completion_tokens_for(prompt)
+        )
+
+    if not CASSETTE.records_llm(llm):
+        return await complete()
+    return await CASSETTE.acall(
+        "llm", llm_key(llm, prompt, stop), complete, encode_blocks, decode_blocks
+    )
+
+
+async def run_tool_async(tool: Tool, tool_input: List[Block], context: AgentContext):
+    """Awaitable `tool.run`: tools that provide `arun` are awaited, others run on the I/O thread pool."""
+
+    async def run() -> List[Block]:
+        if hasattr(tool, "arun"):
+            return await tool.arun(tool_input, context)
+        return await run_sync(tool.run, tool_input, context)
+
+    if not CASSETTE.records_tool(tool):
+        return await run()
+    return await CASSETTE.acall(
+        "tool",
+        tool_key(tool, tool_input),
+        lambda: scheduler_for(tool_upstream(tool)).acall(run),
+        encode_blocks,
+        decode_blocks,
+    )
+
+
+class AsyncReACTAgent(ReACTAgent):
+    """ReACTAgent that can also choose its next action without blocking the event loop.
+
+    Its scratchpad is bounded (see `scratchpad.bounded_scratchpad`), so that long tool observations do not make
+    every later planning call larger.
+    """
+
+    # Observations of the last `keep_recent_steps` steps are cut to `max_observation_tokens`, and those of
+    # earlier steps to `compacted_observation_tokens`. If the prompt would still exceed `max_prompt_tokens`, the
+    # oldest steps are omitted. Set `max_prompt_tokens` to None to never omit steps.
+    max_observation_tokens: int = 400
+    keep_recent_steps: int = 2
+    compacted_observation_tokens: int = 48
+    max_prompt_tokens: Optional[int] = 3000
+    # Above 1, the planner may choose up to this many independent actions in one step (see `parallel_actions`);
+    # they run concurrently. Prompts need a `{parallel_actions}` placeholder to tell the planner so.
+    max_parallel_actions: int = 1
+
+    def __init__(self, tools: List[Tool], llm: LLM, **kwargs):
+        max_actions = kwargs.get("max_parallel_actions", 1)
+        if max_actions > 1:
+            output_parser = ParallelReACTOutputParser(
+                tools=tools, max_actions=max_actions
+            )
+        else:
+            output_parser = ReACTOutputParser(tools=tools)
+        kwargs.setdefault("output_parser", output_parser)
+        # ReACTAgent.__init__ takes no other fields, so the model is initialized directly.
+        Agent.__init__(self, tools=tools, llm=llm, **kwargs)
+
+    def build_prompt(self, context: AgentContext) -> str:
+        """Format the ReACT prompt for the current step as ReACTAgent.next_action does, with a bounded scratchpad."""
+        tool_index = "\n".join(f"- {t.name}: {t.agent_description}" for t in self.tools)
+
+        def format_prompt(scratchpad: str) -> str:
+            return self.PROMPT.format(
+                input=context.chat_history.last_user_message.text,
+                history=history,
+                tool_index=tool_index,
+                tool_names=[t.name for t in self.tools],
+                parallel_actions=parallel_actions,
+                scratchpad=scratchpad,
+            )
+
+        # Prompts with a `{history}` placeholder get the session's windowed history (see `history_window`).
+        history = HISTORY_WINDOW.render(context)
+        parallel_actions = parallel_actions_prompt(self.max_parallel_actions)
+
+        token_budget = None
+        if self.max_prompt_tokens is not None:
+            token_budget = self.max_prompt_tokens - count_tokens(format_prompt(""))
+        scratchpad = bounded_scratchpad(
+            context.completed_steps,
+            max_observation_tokens=self.max_observation_tokens,
+            keep_recent_steps=self.keep_recent_steps,
+            compacted_observation_tokens=self.compacted_observation_tokens,
+            token_budget=token_budget,
+        )
+        prompt = format_prompt(scratchpad)
+        record_prompt_tokens(
+            context, prompt, scratchpad, self._construct_scratchpad(context)
+        )
+        return prompt
+
+    def next_action(self, context: AgentContext) -> Action:
+        prompt = self.build_prompt(context)
+        with METRICS.span("planner", step=len(context.completed_steps)):
+            completions = CASSETTE.complete(self.llm, prompt, stop="Observation:")
+        return self.output_parser.parse(completions[0].text, context)
+
+    async def anext_action(self, context: AgentContext) -> Action:
+        prompt = self.build_prompt(context)
+        with METRICS.span("planner", step=len(context.completed_steps)):
+            completions = await complete_async(
+                self.llm, prompt=prompt, stop="Observation:"
+            )
+        return self.output_parser.parse(completions[0].text, context)
+
+
+class AsyncAgentService(StreamingAgentService):
+    """AgentService with an asyncio path: `prompt_agent_async` awaits every LLM call, tool run and Task."""
+
+    # How much of a session's chat history its agent sees and keeps in memory; override per service class.
+    # None keeps every message in memory and shows none of them to the planner.
+    history_policy: Optional[HistoryPolicy] = HistoryPolicy()
+
+    # The agent that `prompt_stream` and `prompt_async` run. Services set it in their `__init__`.
+    _agent: Optional[Agent] = None
+
+    def create_context(
+        self, prompt: str, session_id: Optional[str] = None
+    ) -> AgentContext:
+        """Create the AgentContext for one request and append `prompt` to its chat history.
+
+        Requests that share a `session_id` share a warm, pooled chat history (see `context_pool`); without one,
+        each request gets a history of its own.
+        """
+        with METRICS.span("context"):
+            context = CONTEXT_POOL.context(self.client, session_id)
+        context.metadata[HISTORY_POLICY_KEY] = self.history_policy
+        context.chat_history.append_user_message(prompt)
+        # This LLM answers document questions and summarizes histories. With LLM_TEMPERATURE=0, repeated prompts
+        # are answered from the completion cache (see `llm_cache`).
+        return with_llm(context=context, llm=default_llm(self.client))
+
+    @get("context_pool_stats")
+    def context_pool_stats(self) -> dict:
+        """Hit/miss/eviction counters of the session context pool, its write-behind flusher and history folding."""
+        return {**CONTEXT_POOL.stats(), "history": HISTORY_WINDOW.stats()}
+
+    @get("completion_cache_stats")
+    def completion_cache_stats(self) -> dict:
+        """Hit/miss/eviction counters of the LLM completion cache, with its hit rate."""
+        if COMPLETION_CACHE is None:
+            return {"enabled": False}
+        return {"enabled": True, **COMPLETION_CACHE.stats()}
+
+    @get("search_cache_stats")
+    def search_cache_stats(self) -> dict:
+        """Hit/miss/coalescing/eviction counters of the web and image search cache, with its hit rate."""
+        if SEARCH_CACHE is None:
+            return {"enabled": False}
+        return {"enabled": True, **SEARCH_CACHE.stats()}
+
+    @get("rate_limit_stats")
+    def rate_limit_stats(self) -> dict:
+        """Queue depth, admissions, 429s and admission wait times of the outbound call schedulers, by upstream."""
+        return all_stats()
+
+    @get("metrics")
+    def metrics(self) -> dict:
+        """Per-stage latency histograms and counters for this process, and the span trees of recent slow requests."""
+        return {**METRICS.snapshot(), "cassette": CASSETTE.stats()}
+
+    def run_agent(self, agent: Agent, context: AgentContext):
+        super().run_agent(agent, context)
+        record_reply(context)
+        HISTORY_WINDOW.fold(context)
+
+    async def run_action_async(self, action: Action, context: AgentContext):
+        if isinstance(action, FinishAction):
+            return
+        # The actions of a ParallelAction run concurrently, and are recorded in the order the planner chose them.
+        actions = action_steps(action)
+        outputs = await asyncio.gather(
+            *[self._run_tool_async(step, context) for step in actions]
+        )
+        for step, output in zip(actions, outputs):
+            step.output = output
+            context.completed_steps.append(step)
+            for observer in context.metadata.get(OBSERVERS_KEY, []):
+                observer(step)
+
+    @staticmethod
+    async def _run_tool_async(action: Action, context: AgentContext) -> List[Block]:
+        with METRICS.span(f"tool.{action.tool.name}"):
+            blocks_or_task = await run_tool_async(action.tool, action.input, context)
+        if isinstance(blocks_or_task, Task):
+            raise SteamshipError(
+                "Tools return Tasks are not yet supported (but will be soon). "
+                "Please use synchronous Tasks (Tools that return List[Block] for now."
+            )
+        return blocks_or_task
+
+    async def run_agent_async(self, agent: Agent, context: AgentContext):
+        """Awaitable `run_agent`. Emit functions, which may do blocking work, run on the I/O thread pool."""
+
+        async def next_action() -> Action:
+            if hasattr(agent, "anext_action"):
+                return await agent.anext_action(context)
+            return await run_sync(agent.next_action, context)
+
+        action = await next_action()
+        while not isinstance(action, FinishAction):
+            await self.run_action_async(action, context)
+            action = await next_action()
+
+        context.completed_steps.append(action)
+        with METRICS.span("emit"):
+            for func in context.emit_funcs:
+                await run_sync(func, action.output, context.metadata)
+        record_reply(context)
+        HISTORY_WINDOW.fold(context)
+
+    async def prompt_agent_async(
+        self, agent: Agent, prompt: str, session_id: Optional[str] = None
+    ) -> str:
+        """Run `agent` on `prompt` and return the same text `prompt` would, within the per-process cap."""
+        # The request's time includes any wait for a slot.
+        with METRICS.request("prompt_async"):
+            async with prompt_slots():
+                context = await run_sync(self.create_context, prompt, session_id)
+                output = ""
+
+                def sync_emit(blocks: List[Block], meta: Metadata):
+                    nonlocal output
+                    block_text = "\n".join(
+                        [
+                            b.text if b.is_text() else f"({b.mime_type}: {b.id})"
+                            for b in blocks
+                        ]
+                    )
+                    output += block_text
+
+                context.emit_funcs.append(sync_emit)
+                await self.run_agent_async(agent, context)
+                return output
+
+    def prompt_stream(
+        self, prompt: str, session_id: Optional[str] = None
+    ) -> Iterator[StreamEvent]:
+        """Run the service's agent with the provided text as the input, yielding output as it becomes available.
+
+        Steamship endpoints return a single response, so this is not exposed over HTTP; it is for in-process
+        callers that can forward partial output (tool observations, final text, then published blocks).
+        """
+        started_at = time.perf_counter()
+        context = self.create_context(prompt, session_id)
+        yield from self.stream_agent(self._agent, context, started_at=started_at)
+
+    async def prompt_async(self, prompt: str, session_id: Optional[str] = None) -> str:
+        """Asynchronous `prompt` for in-process callers; no thread is held while waiting on the LLM or tools."""
+        return await self.prompt_agent_async(self._agent, prompt, session_id)
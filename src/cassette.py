@@ -0,0 +1,313 @@
+"""Record and replay of upstream calls, for reproducible latency runs.
+
+With `CASSETTE_MODE=record`, the agent services write every upstream call to a gzipped JSON-lines cassette at
+`CASSETTE_PATH`, with its result and how long it took. Upstream calls are LLM completions, tool runs, embedding index
+searches and the signed-URL round trips of block publishing. With `CASSETTE_MODE=replay` the same calls are answered
+from the cassette instead: after the recorded latency, or at once with `CASSETTE_LATENCY=zero`. Chat histories are
+then kept in memory, and `run_repl` runs an AgentREPL without a Steamship workspace. Everything else (routing,
+caches, prompt building, context packing) still runs. A replay at zero latency therefore measures our own overhead,
+and one at the recorded latency reproduces the timing of the original conversation.
+
+Calls are matched on a hash of their inputs, in recording order; a call made more often than it was recorded gets its
+last recording again. A call with no recording, or one that failed when it was recorded, raises a SteamshipError.
+Tools and LLMs that set `replay_inner_calls` (such as VectorSearchQATool and CachingLLM) are not recorded as a whole,
+only the upstream calls they make.
+"""
+import asyncio
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+from steamship import Block, Steamship, SteamshipError
+from steamship.agents.schema import LLM, AgentContext, Tool
+from steamship.base.configuration import Configuration
+from steamship.data.plugin.plugin_instance import PluginInstance
+
+from rate_limit import scheduled_complete, scheduled_run_tool
+
+CASSETTE_MODE_ENV = "CASSETTE_MODE"
+CASSETTE_PATH_ENV = "CASSETTE_PATH"
+CASSETTE_LATENCY_ENV = "CASSETTE_LATENCY"
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+def encode_blocks(blocks: List[Block]) -> List[dict]:
+    return [json.loads(block.json(exclude_none=True)) for block in blocks]
+
+
+def decode_blocks(data: List[dict]) -> List[Block]:
+    return [Block.parse_obj(block) for block in data]
+
+
+def encode_model(model: BaseModel) -> dict:
+    return json.loads(model.json(exclude_none=True))
+
+
+def llm_settings(llm: LLM) -> Tuple[Optional[str], Optional[float]]:
+    """The model and temperature of `llm`, where known.
+
+    Steamship's OpenAI LLM keeps them only in the configuration of its generator plugin.
+    """
+    config = getattr(getattr(llm, "generator", None), "config", None) or {}
+    return (
+        config.get("model", getattr(llm, "model_name", None)),
+        config.get("temperature", getattr(llm, "temperature", None)),
+    )
+
+
+def llm_key(llm: LLM, prompt: str, stop: Optional[str]) -> list:
+    """What identifies a completion: the model and its settings, the prompt and the stop sequence."""
+    return [type(llm).__name__, *llm_settings(llm), prompt, stop]
+
+
+def tool_key(tool: Tool, tool_input: List[Block]) -> list:
+    return [tool.name, [block.as_llm_input() for block in tool_input]]
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+class Cassette:
+    """Records upstream calls to, or replays them from, the cassette at `path`.
+
+    `mode` is RECORD, REPLAY, or None to call through untouched. Replayed calls take their recorded latency times
+    `latency_scale`.
+    """
+
+    def __init__(
+        self, path: str, mode: Optional[str] = None, latency_scale: float = 1.0
+    ):
+        if mode not in (None, RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._recordings: Dict[str, Deque[dict]] = {}
+        self._last: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._out = None
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self.upstream_s = 0.0
+        if mode == RECORD:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._out = gzip.open(path, "wt", encoding="utf-8")
+            atexit.register(self.close)
+        elif mode == REPLAY:
+            self._load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == REPLAY
+
+    def call(
+        self,
+        kind: str,
+        key: list,
+        func: Callable[[], Any],
+        encode: Callable[[Any], Any] = _identity,
+        decode: Callable[[Any], Any] = _identity,
+    ) -> Any:
+        """`func()`, recorded or replayed as a `kind` call identified by `key`. Results are stored as `encode(result)`."""
+        if self.mode is None:
+            return func()
+        digest = self._digest(kind, key)
+        if self.mode == REPLAY:
+            recording = self._take(kind, digest)
+            time.sleep(recording["seconds"] * self.latency_scale)
+            return self._result(recording, decode)
+
+        started_at = time.perf_counter()
+        try:
+            result = func()
+        except Exception as e:
+            self._write(kind, digest, time.perf_counter() - started_at, error=str(e))
+            raise
+        self._write(
+            kind, digest, time.perf_counter() - started_at, output=encode(result)
+        )
+        return result
+
+    async def acall(
+        self,
+        kind: str,
+        key: list,
+        func: Callable[[], Awaitable[Any]],
+        encode: Callable[[Any], Any] = _identity,
+        decode: Callable[[Any], Any] = _identity,
+    ) -> Any:
+        """Awaitable `call`, for a coroutine function `func`."""
+        if self.mode is None:
+            return await func()
+        digest = self._digest(kind, key)
+        if self.mode == REPLAY:
+            recording = self._take(kind, digest)
+            await asyncio.sleep(recording["seconds"] * self.latency_scale)
+            return self._result(recording, decode)
+
+        started_at = time.perf_counter()
+        try:
+            result = await func()
+        except Exception as e:
+            self._write(kind, digest, time.perf_counter() - started_at, error=str(e))
+            raise
+        self._write(
+            kind, digest, time.perf_counter() - started_at, output=encode(result)
+        )
+        return result
+
+    def complete(
+        self, llm: LLM, prompt: str, stop: Optional[str] = None
+    ) -> List[Block]:
+        """`scheduled_complete`, recorded or replayed. LLMs that set `replay_inner_calls` are called directly."""
+        if not self.records_llm(llm):
+            return llm.complete(prompt=prompt, stop=stop)
+        return self.call(
+            "llm",
+            llm_key(llm, prompt, stop),
+            lambda: scheduled_complete(llm, prompt, stop),
+            encode_blocks,
+            decode_blocks,
+        )
+
+    def records_llm(self, llm: LLM) -> bool:
+        """Whether completions of `llm` are upstream calls of their own, rather than made up of the calls inside it."""
+        return not getattr(llm, "replay_inner_calls", False)
+
+    def records_tool(self, tool: Tool) -> bool:
+        """Whether runs of `tool` are upstream calls of their own, rather than made up of the calls inside it."""
+        return not getattr(tool, "replay_inner_calls", False)
+
+    def run_tool(
+        self, tool: Tool, tool_input: List[Block], context: AgentContext
+    ) -> List[Block]:
+        """`scheduled_run_tool`, recorded or replayed."""
+        return self.call(
+            "tool",
+            tool_key(tool, tool_input),
+            lambda: scheduled_run_tool(tool, tool_input, context),
+            encode_blocks,
+            decode_blocks,
+        )
+
+    def close(self):
+        with self._lock:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "path": self.path,
+                "recorded": self.recorded,
+                "replayed": self.replayed,
+                "misses": self.misses,
+                "upstream_s": self.upstream_s,
+            }
+
+    @staticmethod
+    def _digest(kind: str, key: list) -> str:
+        encoded = json.dumps([kind, *key], sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:32]
+
+    def _write(self, kind: str, digest: str, seconds: float, **result):
+        line = json.dumps(
+            {"kind": kind, "key": digest, "seconds": round(seconds, 4), **result},
+            separators=(",", ":"),
+        )
+        with self._lock:
+            self.recorded += 1
+            self.upstream_s += seconds
+            if self._out is not None:
+                self._out.write(line + "\n")
+                # Keep the cassette readable if the process does not exit cleanly.
+                self._out.flush()
+
+    def _load(self):
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    recording = json.loads(line)
+                    self._recordings.setdefault(recording["key"], deque()).append(
+                        recording
+                    )
+        except (EOFError, json.JSONDecodeError) as e:
+            # A recording cut short keeps the calls written before the cut.
+            logging.warning(f"Cassette {self.path} is truncated: {e}")
+
+    def _take(self, kind: str, digest: str) -> dict:
+        with self._lock:
+            recordings = self._recordings.get(digest)
+            if recordings:
+                recording = self._last[digest] = recordings.popleft()
+            else:
+                recording = self._last.get(digest)
+            if recording is None:
+                self.misses += 1
+                raise SteamshipError(
+                    message=f"Cassette {self.path} has no recording of this {kind} call; record it again."
+                )
+            self.replayed += 1
+            self.upstream_s += recording["seconds"]
+            return recording
+
+    @staticmethod
+    def _result(recording: dict, decode: Callable[[Any], Any]) -> Any:
+        if "error" in recording:
+            raise SteamshipError(message=recording["error"])
+        return decode(recording["output"])
+
+
+class ReplayClient(Steamship):
+    """Steamship client for replaying a cassette offline. Upstream calls never reach its plugins, which are inert."""
+
+    def use_plugin(
+        self, plugin_handle: str, instance_handle: Optional[str] = None, **kwargs
+    ):
+        return PluginInstance.construct(
+            client=self, handle=instance_handle or plugin_handle
+        )
+
+
+def replay_client() -> ReplayClient:
+    return ReplayClient.construct(
+        config=Configuration.construct(workspace_handle="cassette-replay")
+    )
+
+
+def run_repl(repl_class: type, *args, **kwargs):
+    """Create and run an AgentREPL: offline when replaying a cassette, otherwise in a temporary workspace."""
+    if CASSETTE.replaying:
+        client = replay_client()
+        repl_class(*args, client=client, **kwargs).run_with_client(client)
+    else:
+        repl_class(*args, **kwargs).run()
+
+
+def _default_cassette() -> Cassette:
+    latency = os.environ.get(CASSETTE_LATENCY_ENV, "recorded")
+    return Cassette(
+        os.environ.get(CASSETTE_PATH_ENV, "cassette.jsonl.gz"),
+        mode=os.environ.get(CASSETTE_MODE_ENV) or None,
+        latency_scale={"recorded": 1.0, "zero": 0.0}.get(latency)
+        if latency in ("recorded", "zero")
+        else float(latency),
+    )
+
+
+# Shared by every agent service in the process. Off unless CASSETTE_MODE is set.
+CASSETTE = _default_cassette()
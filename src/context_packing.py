@@ -0,0 +1,100 @@
+"""Packs retrieved passages into a question answering prompt under a token budget."""
+
+import re
+from dataclasses import dataclass
+from typing import FrozenSet, List
+
+from utils import count_tokens
+
+# Splits after sentence-ending punctuation followed by whitespace.
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+@dataclass
+class PackedContext:
+    """The passages selected for a prompt, already formatted, and what it cost to include them."""
+
+    passages: List[str]
+    tokens_used: int
+    candidates: int
+    duplicates_dropped: int = 0
+    trimmed: int = 0
+
+
+def _shingles(text: str, size: int = 3) -> FrozenSet[str]:
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return frozenset([" ".join(words)]) if words else frozenset()
+    return frozenset(
+        " ".join(words[i : i + size]) for i in range(len(words) - size + 1)
+    )
+
+
+def _containment(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """Fraction of the smaller shingle set found in the larger; overlapping index windows score highly."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _trim_to_budget(text: str, template: str, budget: int) -> str:
+    """Keep as many leading whole sentences of `text` as fit in `budget` tokens once formatted."""
+    kept = ""
+    for sentence in _SENTENCE_BOUNDARY.split(text):
+        candidate = f"{kept} {sentence}".strip()
+        if count_tokens(template.format(text=candidate)) > budget:
+            break
+        kept = candidate
+    return kept
+
+
+def pack_context(
+    texts: List[str],
+    token_budget: int,
+    template: str = "{text}",
+    duplicate_threshold: float = 0.8,
+    min_trimmed_tokens: int = 16,
+) -> PackedContext:
+    """Select passages, best-scoring first, until `token_budget` is spent.
+
+    `texts` must already be in score order. Passages that mostly repeat an already selected passage are
+    dropped. A passage that does not fit is trimmed to its leading sentences if at least `min_trimmed_tokens`
+    of budget remain; later (lower-scoring, possibly shorter) passages are still considered after that.
+    """
+    passages: List[str] = []
+    selected_shingles: List[FrozenSet[str]] = []
+    packed = PackedContext(passages=passages, tokens_used=0, candidates=len(texts))
+
+    for text in texts:
+        remaining = token_budget - packed.tokens_used
+        if remaining <= 0:
+            break
+
+        shingles = _shingles(text)
+        if any(
+            _containment(shingles, seen) >= duplicate_threshold
+            for seen in selected_shingles
+        ):
+            packed.duplicates_dropped += 1
+            continue
+
+        # Passages are joined with newlines, each of which costs a token.
+        separator = 1 if passages else 0
+        passage = template.format(text=text)
+        cost = count_tokens(passage) + separator
+        if cost > remaining:
+            if remaining < min_trimmed_tokens:
+                continue
+            trimmed = _trim_to_budget(text, template, remaining - separator)
+            if not trimmed:
+                continue
+            passage = template.format(text=trimmed)
+            cost = count_tokens(passage) + separator
+            packed.trimmed += 1
+
+        passages.append(passage)
+        selected_shingles.append(shingles)
+        packed.tokens_used += cost
+
+    return packed
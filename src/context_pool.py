@@ -0,0 +1,389 @@
+"""Warm, in-process pool of chat histories with write-behind persistence.
+
+`AgentContext.get_or_create` queries (and possibly creates) the backing File on every call, and each
+`ChatHistory.append_*` call is a synchronous `Block.create`. The `ContextPool` keeps the chat history of each
+session in memory, LRU-evicted by count and by approximate size, and hands out a fresh `AgentContext` around it
+per request. Appended messages are visible to the agent immediately and are written to Steamship in batches by
+a background `WriteBehindFlusher`, which is drained at interpreter exit.
+"""
+import atexit
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
+
+from steamship import Block
+from steamship.agents.memory import ChatHistory
+from steamship.agents.schema import AgentContext
+
+from cassette import CASSETTE
+from metrics import METRICS
+
+# Rough per-block overhead (tags, ids, object headers) added to the text length when sizing the pool.
+_BLOCK_OVERHEAD_BYTES = 256
+
+# Key in AgentContext.metadata holding the session id of contexts served from the pool.
+SESSION_KEY = "session_id"
+
+
+class _PendingWrite:
+    __slots__ = ("file", "placeholder", "kwargs", "attempts")
+
+    def __init__(self, file, placeholder: Block, kwargs: dict):
+        self.file = file
+        self.placeholder = placeholder
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class WriteBehindFlusher:
+    """Persists appended blocks off the request path.
+
+    Writes are drained every `flush_interval_s` (or as soon as `max_batch` are pending), at most `max_batch` at a
+    time. Writes to different files go out in parallel; writes to the same file keep their order. A write that
+    fails is retried on the next flush, up to `max_attempts` times, then dropped with an error log.
+    """
+
+    def __init__(
+        self,
+        flush_interval_s: float = 0.25,
+        max_batch: int = 64,
+        max_workers: int = 4,
+        max_attempts: int = 3,
+    ):
+        self.flush_interval_s = flush_interval_s
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self._pending: Deque[_PendingWrite] = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="history-flush"
+        )
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    def submit(self, file, placeholder: Block, kwargs: dict):
+        """Queue `file.append_block(**kwargs)`; `placeholder` receives the persisted block's id once written."""
+        with self._lock:
+            self._pending.append(_PendingWrite(file, placeholder, kwargs))
+            pending = len(self._pending)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(
+                    target=self._run, name="history-flusher", daemon=True
+                )
+                self._thread.start()
+        if pending >= self.max_batch:
+            self._wake.set()
+
+    def flush(self):
+        """Write everything queued so far, blocking until done."""
+        while self.pending():
+            self._flush_batch()
+
+    def flush_file(self, file_id: str) -> int:
+        """Write everything queued for the file `file_id`, in order, blocking until done. Returns how many writes.
+
+        Writes that keep failing are dropped after `max_attempts`, as in the background flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                writes = [w for w in self._pending if w.file.id == file_id]
+                if not writes:
+                    return 0
+                self._pending = deque(w for w in self._pending if w.file.id != file_id)
+            unwritten = writes
+            while unwritten:
+                unwritten = self._write_in_order(unwritten)
+            return len(writes)
+
+    def close(self):
+        """Stop the background thread after writing everything still queued."""
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval_s)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Chat history flush failed")
+
+    def _flush_batch(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = [
+                    self._pending.popleft()
+                    for _ in range(min(self.max_batch, len(self._pending)))
+                ]
+            if not batch:
+                return
+            by_file: "OrderedDict[int, List[_PendingWrite]]" = OrderedDict()
+            for write in batch:
+                by_file.setdefault(id(write.file), []).append(write)
+            # Once closed (at interpreter exit, thread pools no longer accept work) the final flush is serial.
+            write_all = map if self._closed else self._pool.map
+            retries: List[_PendingWrite] = []
+            for unwritten in write_all(self._write_in_order, by_file.values()):
+                retries.extend(unwritten)
+            self.batches += 1
+            with self._lock:
+                # Put retries back at the front, in their original order, so per-file ordering holds.
+                self._pending.extendleft(reversed(retries))
+
+    def _write_in_order(self, writes: List[_PendingWrite]) -> List[_PendingWrite]:
+        """Write one file's blocks in order; returns the writes to retry (the failed one and all after it)."""
+        for i, write in enumerate(writes):
+            try:
+                block = write.file.append_block(**write.kwargs)
+            except Exception as e:
+                write.attempts += 1
+                if write.attempts < self.max_attempts:
+                    logging.warning(f"Chat history write failed, will retry: {e}")
+                    return writes[i:]
+                logging.exception("Dropping chat history write after repeated failures")
+                self.failed += 1
+                continue
+            write.placeholder.id = block.id
+            self.written += 1
+        return []
+
+
+class _WriteBehindFile:
+    """File proxy whose `append_block` returns at once, leaving the server-side write to a flusher.
+
+    It keeps its own list of blocks, so the agent sees appended messages immediately and the wrapped File's
+    client-side block list (which the real `append_block` also appends to) is never read.
+    """
+
+    def __init__(self, file, flusher: WriteBehindFlusher):
+        self._file = file
+        self._flusher = flusher
+        self.blocks: List[Block] = list(file.blocks or [])
+        self.size_bytes = sum(_block_size(block) for block in self.blocks)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def append_block(
+        self, text: Optional[str] = None, tags: Optional[list] = None, **kwargs
+    ) -> Block:
+        placeholder = Block(file_id=self._file.id, text=text, tags=tags or [])
+        self.blocks.append(placeholder)
+        self.size_bytes += _block_size(placeholder)
+        self._flusher.submit(
+            self._file, placeholder, dict(text=text, tags=tags, **kwargs)
+        )
+        return placeholder
+
+    def forget_oldest(self, count: int):
+        """Drop the oldest `count` blocks from memory only; they stay in Steamship."""
+        forgotten = self.blocks[:count]
+        del self.blocks[:count]
+        self.size_bytes -= sum(_block_size(block) for block in forgotten)
+
+    def refresh(self):
+        # Reloading from the server would drop messages that are not written yet.
+        self._flusher.flush()
+        self._file.refresh()
+        self.blocks = list(self._file.blocks or [])
+        self.size_bytes = sum(_block_size(block) for block in self.blocks)
+        return self
+
+
+class _MemoryFile:
+    """A chat history File that is never stored, for sessions replayed from a cassette (see `cassette`)."""
+
+    def __init__(self, file_id: str):
+        self.id = file_id
+        self.blocks: List[Block] = []
+        self.tags: list = []
+
+    def append_block(
+        self, text: Optional[str] = None, tags: Optional[list] = None, **kwargs
+    ) -> Block:
+        block = Block(id=f"{uuid.uuid4()}", file_id=self.id, text=text, tags=tags or [])
+        self.blocks.append(block)
+        return block
+
+    def refresh(self):
+        return self
+
+
+def _block_size(block: Block) -> int:
+    return len(block.text or "") + _BLOCK_OVERHEAD_BYTES
+
+
+def _workspace_of(client) -> Optional[str]:
+    config = getattr(client, "config", None)
+    return getattr(config, "workspace_id", None) or getattr(
+        config, "workspace_handle", None
+    )
+
+
+class ContextPool:
+    """LRU pool of session chat histories, bounded by `max_contexts` and by approximately `max_bytes` of text.
+
+    Evicting a session only drops its in-memory copy: its pending writes stay queued in the flusher. The next
+    request for that session writes them before it reloads the history from Steamship, so no turn is missing.
+    """
+
+    def __init__(
+        self,
+        max_contexts: int = 256,
+        max_bytes: int = 64 * 1024 * 1024,
+        flusher: Optional[WriteBehindFlusher] = None,
+    ):
+        self.max_contexts = max_contexts
+        self.max_bytes = max_bytes
+        self.flusher = flusher or WriteBehindFlusher()
+        self._histories: "OrderedDict[Tuple[Optional[str], str], ChatHistory]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._creating: Dict[Tuple[Optional[str], str], threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def context(self, client, session_id: Optional[str] = None) -> AgentContext:
+        """A new AgentContext for one request.
+
+        With a `session_id`, the chat history is shared with earlier requests in that session, and `record_reply`
+        adds the agent's text reply to it. Without one, the context gets a history of its own, as before, that is not
+        pooled.
+        """
+        if session_id:
+            history = self.chat_history(client, session_id)
+        else:
+            history = self._load(client, f"{uuid.uuid4()}")
+        context = AgentContext()
+        context.chat_history = history
+        context.client = client
+        if session_id:
+            context.metadata[SESSION_KEY] = session_id
+        return context
+
+    def chat_history(self, client, session_id: str) -> ChatHistory:
+        """The pooled chat history of `session_id`, loaded (or created) on first use."""
+        key = (_workspace_of(client), session_id)
+        with self._lock:
+            history = self._get(key)
+            if history is not None:
+                return history
+            creating = self._creating.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given session; others wait for it rather than creating a duplicate File.
+        with creating:
+            with self._lock:
+                history = self._get(key)
+                if history is not None:
+                    return history
+                self.misses += 1
+            history = self._load(client, session_id)
+            with self._lock:
+                self._histories[key] = history
+                self._creating.pop(key, None)
+                self._evict()
+            return history
+
+    def clear(self):
+        with self._lock:
+            self._histories.clear()
+
+    def close(self):
+        """Write all pending chat history; called at interpreter exit for the shared pool."""
+        self.flusher.close()
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._size_bytes()
+
+    def stats(self) -> dict:
+        """Pool hit/miss/eviction counters, current size, and flusher counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "contexts": len(self._histories),
+                "bytes": self._size_bytes(),
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "flusher": self.flusher.stats(),
+            }
+
+    def _get(self, key) -> Optional[ChatHistory]:
+        history = self._histories.get(key)
+        if history is not None:
+            self._histories.move_to_end(key)
+            self.hits += 1
+            # Sessions grow between requests, so the size bound is re-checked on every use.
+            self._evict(keep=key)
+        return history
+
+    def _load(self, client, context_id: str) -> ChatHistory:
+        if CASSETTE.replaying:
+            # Replays run offline, so their chat histories are kept in memory only.
+            return ChatHistory(_WriteBehindFile(_MemoryFile(context_id), self.flusher))
+        with METRICS.span("context.load"):
+            file = AgentContext.get_or_create(
+                client, {"id": context_id}
+            ).chat_history.file
+            # Writes still queued from before the session was evicted must land before its history is read.
+            if self.flusher.flush_file(file.id):
+                file.refresh()
+        return ChatHistory(_WriteBehindFile(file, self.flusher))
+
+    def _size_bytes(self) -> int:
+        return sum(history.file.size_bytes for history in self._histories.values())
+
+    def _evict(self, keep=None):
+        while len(self._histories) > self.max_contexts or (
+            len(self._histories) > 1 and self._size_bytes() > self.max_bytes
+        ):
+            oldest = next(iter(self._histories))
+            if oldest == keep:
+                break
+            del self._histories[oldest]
+            self.evictions += 1
+
+
+def record_reply(context: AgentContext):
+    """Append the text of a finished run to the chat history, for contexts that continue a session."""
+    if SESSION_KEY not in context.metadata or not context.completed_steps:
+        return
+    blocks = context.completed_steps[-1].output or []
+    text = "\n".join(block.text for block in blocks if block.is_text())
+    if text:
+        context.chat_history.append_agent_message(text=text)
+
+
+# Shared by every agent service in the process.
+CONTEXT_POOL = ContextPool(
+    max_contexts=int(os.environ.get("CONTEXT_POOL_MAX_CONTEXTS", "256")),
+    max_bytes=int(os.environ.get("CONTEXT_POOL_MAX_BYTES", str(64 * 1024 * 1024))),
+)
+atexit.register(CONTEXT_POOL.close)
@@ -1,19 +1,21 @@
-import uuid
-from typing import List
+from typing import List, Optional
 
 from steamship import Block
 from steamship.agents.llms import OpenAI
 from steamship.agents.mixins.transports.steamship_widget import SteamshipWidgetTransport
-from steamship.agents.react import ReACTAgent
-from steamship.agents.schema import AgentContext, Metadata
-from steamship.agents.service.agent_service import AgentService
+from steamship.agents.schema import Metadata
 
 from steamship.agents.tools.image_generation.stable_diffusion import StableDiffusionTool
 from steamship.agents.tools.search.search import SearchTool
-from steamship.agents.utils import with_llm
 from steamship.invocable import post
 from steamship.utils.repl import AgentREPL
 
+from async_agents import AsyncAgentService, AsyncReACTAgent
+from cassette import run_repl
+from example_tools.pixar_style_tool import cached_images
+from history_window import HistoryPolicy
+from metrics import METRICS
+from search_cache import cached_search
 from utils import print_blocks
 
 SYSTEM_PROMPT = """You are Buddy, an assistant who loathes being an assistant.
@@ -50,7 +52,7 @@ Action Input: the input to the action
 Observation: the result of the action
 ```
 
-Some Tools will return Observations in the format of `Block(<identifier>)`. `Block(<identifier>)` represents a successful 
+{parallel_actions}Some Tools will return Observations in the format of `Block(<identifier>)`. `Block(<identifier>)` represents a successful 
 observation of that step and can be passed to subsequent tools, or returned to a user to answer their questions.
 `Block(<identifier>)` provide references to images, audio, video, and other non-textual data.
 
@@ -79,20 +81,25 @@ Make sure to use all observations to come up with your final response.
 
 Begin!
 
-New input: {input}
+{history}New input: {input}
 {scratchpad}"""
 
 
-class MyAssistant(AgentService):
+class MyAssistant(AsyncAgentService):
+    # Buddy is a conversationalist: it sees the last six turns of a session, and a summary of the rest.
+    history_policy = HistoryPolicy(window_turns=6)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        self._agent = ReACTAgent(
+        self._agent = AsyncReACTAgent(
             tools=[
-                SearchTool(),
-                StableDiffusionTool(),
+                cached_search(SearchTool()),
+                cached_images(StableDiffusionTool()),
             ],
             llm=OpenAI(self.client),
+            # Searching for facts and finding a picture do not depend on each other, so do both at once.
+            max_parallel_actions=2,
         )
         self._agent.PROMPT = SYSTEM_PROMPT
 
@@ -104,18 +111,19 @@ class MyAssistant(AgentService):
         )
 
     @post("prompt")
-    def prompt(self, prompt: str) -> str:
-        """Run an agent with the provided text as the input."""
+    @METRICS.traced("prompt")
+    def prompt(self, prompt: str, session_id: Optional[str] = None) -> str:
+        """Run an agent with the provided text as the input.
+
+        Pass the same `session_id` on every turn of a conversation to continue its chat history.
+        """
 
         # AgentContexts serve to allow the AgentService to run agents
         # with appropriate information about the desired tasking.
-        # Here, we create a new context on each prompt, and append the
-        # prompt to the message history stored in the context.
-        context_id = uuid.uuid4()
-        context = AgentContext.get_or_create(self.client, {"id": f"{context_id}"})
-        context.chat_history.append_user_message(prompt)
-        # Add the LLM
-        context = with_llm(context=context, llm=OpenAI(client=self.client))
+        # Here, we get a context for this prompt (the warm, pooled one of
+        # its session, if it has one), append the prompt to the message
+        # history stored in the context, and add the LLM.
+        context = self.create_context(prompt, session_id)
 
         # AgentServices provide an emit function hook to access the output of running
         # agents and tools. The emit functions fire at after the supplied agent emits
@@ -139,8 +147,9 @@ class MyAssistant(AgentService):
 
 
 if __name__ == "__main__":
-    AgentREPL(
+    run_repl(
+        AgentREPL,
         MyAssistant,
         method="prompt",
         agent_package_config={"botToken": "not-a-real-token-for-local-testing"},
-    ).run()
+    )
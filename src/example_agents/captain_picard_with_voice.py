@@ -1,6 +1,5 @@
 import logging
-import uuid
-from typing import List
+from typing import List, Optional
 
 from steamship import Block, Task, SteamshipError
 from steamship.agents.logging import AgentLogging
@@ -11,19 +10,20 @@ from steamship.agents.schema import (
     Action,
     FinishAction,
     Agent,
-    EmitFunc,
 )
 from steamship.agents.llms import OpenAI
-from steamship.agents.react import ReACTAgent
-from steamship.agents.service.agent_service import AgentService
 
 from steamship.agents.tools.image_generation.stable_diffusion import StableDiffusionTool
 from steamship.agents.tools.search.search import SearchTool
 from steamship.agents.tools.speech_generation.generate_speech import GenerateSpeechTool
-from steamship.agents.utils import with_llm
-from steamship.invocable import post
+from steamship.invocable import get, post
 from steamship.utils.repl import AgentREPL
 
+from async_agents import AsyncAgentService, AsyncReACTAgent
+from cassette import CASSETTE, run_repl
+from metrics import METRICS
+from speech import SPEECH_PIPELINE
+from speech_cache import SPEECH_CACHE, speech_key
 from utils import print_blocks
 
 SYSTEM_PROMPT = """You are Picard, captain of the Starship Enterprise.
@@ -88,11 +88,11 @@ Make sure to use all observations to come up with your final response.
 
 Begin!
 
-New input: {input}
+{history}New input: {input}
 {scratchpad}"""
 
 
-class StarTrekCaptainWithVoice(AgentService):
+class StarTrekCaptainWithVoice(AsyncAgentService):
     """Deployable Multimodal Agent that illustrates a character personality with voice.
 
     NOTE: To extend and deploy this agent, copy and paste the code into api.py.
@@ -102,7 +102,7 @@ class StarTrekCaptainWithVoice(AgentService):
         super().__init__(**kwargs)
 
         # The agent's planner is responsible for making decisions about what to do for a given input.
-        self._agent = ReACTAgent(
+        self._agent = AsyncReACTAgent(
             tools=[
                 StableDiffusionTool(),
             ],
@@ -117,46 +117,76 @@ class StarTrekCaptainWithVoice(AgentService):
             )
         )
 
-    def run_agent(self, agent: Agent, context: AgentContext):
-        """Override run-agent to patch in audio generation as a finishing step for text output."""
+    def add_speech_to_emit_funcs(self, context: AgentContext):
+        """Patch in audio generation as a finishing step for text output.
+
+        Text is spoken a sentence at a time: the sentences are synthesized concurrently, and each is emitted as
+        soon as it and the sentences before it are ready (see `speech.SpeechPipeline`).
+        """
 
         speech = GenerateSpeechTool()
         speech.generator_plugin_config = {
             "voice_id": "pNInz6obpgDQGcFmaJgB"  # Adam on ElevenLabs
         }
 
-        def to_speech_if_text(block: Block):
-            nonlocal speech
-            if not block.is_text():
-                return block
-
-            output_blocks = speech.run([block], context)
+        def to_speech(text: str) -> Block:
+            # Phrases spoken before in this voice are reused from the speech cache, at no synthesis cost.
+            key = speech_key(
+                self.client.config.workspace_id or self.client.config.workspace_handle,
+                speech.generator_plugin_handle,
+                speech.generator_plugin_config,
+                text,
+            )
+            cached = SPEECH_CACHE.get(key) if SPEECH_CACHE is not None else None
+            if cached is not None:
+                return cached
+
+            with METRICS.span("speech.synthesize", chars=len(text)):
+                output_blocks = CASSETTE.run_tool(speech, [Block(text=text)], context)
+            if SPEECH_CACHE is not None:
+                SPEECH_CACHE.put(key, output_blocks[0])
             return output_blocks[0]
 
         # Note: EmitFunc is Callable[[List[Block], Metadata], None]
-        def wrap_emit(emit_func: EmitFunc):
-            def wrapper(blocks: List[Block], metadata: Metadata):
-                blocks = [to_speech_if_text(block) for block in blocks]
-                return emit_func(blocks, metadata)
+        # Speech is synthesized once and fanned out to every emit func.
+        emit_funcs = context.emit_funcs
+
+        def emit_speech(blocks: List[Block], metadata: Metadata):
+            SPEECH_PIPELINE.emit(blocks, to_speech, emit_funcs, metadata)
 
-            return wrapper
+        context.emit_funcs = [emit_speech]
 
-        context.emit_funcs = [wrap_emit(emit_func) for emit_func in context.emit_funcs]
+    @get("speech_stats")
+    def speech_stats(self) -> dict:
+        """Segments spoken, the mean time to first audio of the requests answered with speech, and speech cache hits."""
+        return {
+            **SPEECH_PIPELINE.stats(),
+            "cache": SPEECH_CACHE.stats() if SPEECH_CACHE is not None else None,
+        }
+
+    def run_agent(self, agent: Agent, context: AgentContext):
+        """Override run-agent to patch in audio generation as a finishing step for text output."""
+        self.add_speech_to_emit_funcs(context)
         super().run_agent(agent, context)
 
+    async def run_agent_async(self, agent: Agent, context: AgentContext):
+        self.add_speech_to_emit_funcs(context)
+        await super().run_agent_async(agent, context)
+
     @post("prompt")
-    def prompt(self, prompt: str) -> str:
-        """Run an agent with the provided text as the input."""
+    @METRICS.traced("prompt")
+    def prompt(self, prompt: str, session_id: Optional[str] = None) -> str:
+        """Run an agent with the provided text as the input.
+
+        Pass the same `session_id` on every turn of a conversation to continue its chat history.
+        """
 
         # AgentContexts serve to allow the AgentService to run agents
         # with appropriate information about the desired tasking.
-        # Here, we create a new context on each prompt, and append the
-        # prompt to the message history stored in the context.
-        context_id = uuid.uuid4()
-        context = AgentContext.get_or_create(self.client, {"id": f"{context_id}"})
-        context.chat_history.append_user_message(prompt)
-        # Add the LLM
-        context = with_llm(context=context, llm=OpenAI(client=self.client))
+        # Here, we get a context for this prompt (the warm, pooled one of
+        # its session, if it has one), append the prompt to the message
+        # history stored in the context, and add the LLM.
+        context = self.create_context(prompt, session_id)
 
         # AgentServices provide an emit function hook to access the output of running
         # agents and tools. The emit functions fire at after the supplied agent emits
@@ -180,8 +210,9 @@ class StarTrekCaptainWithVoice(AgentService):
 
 
 if __name__ == "__main__":
-    AgentREPL(
+    run_repl(
+        AgentREPL,
         StarTrekCaptainWithVoice,
         method="prompt",
         agent_package_config={"botToken": "not-a-real-token-for-local-testing"},
-    ).run()
+    )
@@ -1,22 +1,46 @@
-import uuid
+from dataclasses import asdict
 from typing import List, Optional
 
-from steamship import Block, Task
-from steamship.agents.llms.openai import OpenAI
+from steamship import Block, SteamshipError, Task
 from steamship.agents.mixins.transports.steamship_widget import SteamshipWidgetTransport
-from steamship.agents.react import ReACTAgent
 from steamship.agents.schema import AgentContext, Action, FinishAction
 from steamship.agents.schema.context import Metadata
-from steamship.agents.service.agent_service import AgentService
-from steamship.agents.utils import with_llm
-from steamship.invocable import post
+from steamship.invocable import get, post
 from steamship.invocable.mixins.indexer_pipeline_mixin import IndexerPipelineMixin
 from steamship.utils.repl import AgentREPL
 
+from answer_cache import ANSWER_CACHE, DEFAULT_INDEX_HANDLE, bump_index_version
+from async_agents import AsyncAgentService, AsyncReACTAgent
+from cassette import run_repl
 from example_tools.vector_search_qa_tool import VectorSearchQATool
+from history_window import HistoryPolicy
+from index_manifest import (
+    UNCHANGED,
+    ConditionalFetcher,
+    FetchResult,
+    SourceRecord,
+    fetch_if_modified,
+    get_manifest,
+    manifest_root,
+    reindex_url_locally,
+    reindex_url_remotely,
+)
+from ingestion import INGESTER
+from llm_cache import default_llm
+from local_index import Embedder, get_local_index, local_index_root
+from metrics import METRICS
+from rate_limit import BATCH, scheduler_for
+from routing import QUESTION_ROUTER, route_to_tool
 
 
-class ReACTAgentThatAlwaysUsesToolOutput(ReACTAgent):
+# The upstream that remote indexing calls, for its rate limits.
+REMOTE_INDEX_UPSTREAM = "steamship-index"
+
+
+class ReACTAgentThatAlwaysUsesToolOutput(AsyncReACTAgent):
+    # Send question-shaped input straight to the first tool, without asking the LLM which tool to use.
+    route_questions: bool = True
+
     def next_action(self, context: AgentContext) -> Action:
         """Small wrapper around ReACTAgent that ALWAYS uses the output of a tool if available.
 
@@ -26,10 +50,21 @@ class ReACTAgentThatAlwaysUsesToolOutput(ReACTAgent):
         if context.completed_steps and len(context.completed_steps):
             last_step = context.completed_steps[-1]
             return FinishAction(output=last_step.output, context=context)
-        return super().next_action(context)
+        return self.routed_action(context) or super().next_action(context)
+
+    async def anext_action(self, context: AgentContext) -> Action:
+        if context.completed_steps and len(context.completed_steps):
+            last_step = context.completed_steps[-1]
+            return FinishAction(output=last_step.output, context=context)
+        return self.routed_action(context) or await super().anext_action(context)
+
+    def routed_action(self, context: AgentContext) -> Optional[Action]:
+        if not self.route_questions:
+            return None
+        return route_to_tool(QUESTION_ROUTER, self.tools[0], context)
 
 
-class ExampleDocumentQAService(AgentService):
+class ExampleDocumentQAService(AsyncAgentService):
     """ExampleDocumentQAService is an example bot you can deploy for PDF and Video Q&A.  # noqa: RST201
 
     To use this example:
@@ -54,9 +89,15 @@ class ExampleDocumentQAService(AgentService):
 
     indexer_mixin: IndexerPipelineMixin
 
-    def __init__(self, **kwargs):
+    # Answers come from the indexed documents, not the conversation, so older turns are forgotten, not summarized.
+    history_policy = HistoryPolicy(window_turns=2, summarize=False)
+
+    def __init__(self, local_embedder: Optional[Embedder] = None, **kwargs):
         super().__init__(**kwargs)
 
+        # Embeds documents and questions when LOCAL_EMBEDDING_INDEX_PATH is set; a HashingEmbedder if None.
+        self.local_embedder = local_embedder
+
         # This Mixin provides HTTP endpoints that coordinate the learning of documents.
         #
         # It adds the `/learn_url` endpoint which will:
@@ -83,10 +124,12 @@ class ExampleDocumentQAService(AgentService):
                         "Whenever the input is a question, ALWAYS use this tool. "
                         "The input is the question. "
                         "The output is the answer. "
-                    )
+                    ),
+                    local_embedder=local_embedder,
                 )
             ],
-            llm=OpenAI(self.client),
+            # With LLM_TEMPERATURE=0, repeated planner prompts are answered from the completion cache (see `llm_cache`).
+            llm=default_llm(self.client),
         )
 
         # This Mixin provides HTTP endpoints that connects this agent to a web client
@@ -104,23 +147,176 @@ class ExampleDocumentQAService(AgentService):
         index_handle: Optional[str] = None,
         mime_type: Optional[str] = None,
     ) -> Task:
-        return self.indexer_mixin.index_url(
-            url=url, metadata=metadata, index_handle=index_handle, mime_type=mime_type
-        )
+        return self.reindex(url, metadata, index_handle, mime_type)
+
+    @post("/index_urls")
+    def index_urls(
+        self,
+        urls: List[str],
+        metadata: Optional[dict] = None,
+        index_handle: Optional[str] = None,
+        mime_type: Optional[str] = None,
+        wait: bool = False,
+    ) -> dict:
+        """Index a batch of URLs concurrently, returning a job handle with per-item progress.
+
+        Poll `/index_urls_status` with the returned `job_id`, or pass `wait=True` to return once every URL has
+        been processed. With the remote index, an item is done once its indexing Task has been scheduled.
+        """
+        if local_index_root():
+            # The local index embeds in-process, so there is no upstream to pace. Its content is fetched by the
+            # ingester, which skips URLs whose content was already indexed, and indexed without fetching it again.
+            def index_document(
+                url: str, content: Optional[bytes], fetched_mime_type: Optional[str]
+            ) -> Task:
+                def already_fetched(url: str, previous) -> FetchResult:
+                    return FetchResult(content=content, mime_type=fetched_mime_type)
+
+                return self.reindex(
+                    url, metadata, index_handle, mime_type, already_fetched
+                )
+
+            job = INGESTER.start(urls, index_document)
+        else:
+            # Steamship downloads each URL itself, so the ingester does not fetch it too. Remote indexing embeds
+            # the content at Steamship, so it is paced as batch work for that upstream (see `rate_limit`).
+            def index_document(
+                url: str, content: Optional[bytes], fetched_mime_type: Optional[str]
+            ) -> Task:
+                return scheduler_for(REMOTE_INDEX_UPSTREAM).call(
+                    lambda: self.reindex(url, metadata, index_handle, mime_type),
+                    priority=BATCH,
+                )
+
+            job = INGESTER.start(urls, index_document, fetcher=None)
+        if wait:
+            job.wait()
+        return job.to_dict()
+
+    def reindex(
+        self,
+        url: str,
+        metadata: Optional[dict] = None,
+        index_handle: Optional[str] = None,
+        mime_type: Optional[str] = None,
+        fetcher: ConditionalFetcher = fetch_if_modified,
+    ) -> Task:
+        """(Re-)index a URL, skipping the work that its manifest shows was already done."""
+        handle = index_handle or DEFAULT_INDEX_HANDLE
+        local_root = local_index_root()
+        remote_manifest_root = manifest_root()
+        if local_root:
+            # Index into the local, in-process embedding index that VectorSearchQATool also reads from.
+            task, report = reindex_url_locally(
+                get_local_index(local_root, handle, self.local_embedder),
+                get_manifest(local_root, handle),
+                url=url,
+                metadata=metadata,
+                mime_type=mime_type,
+                fetcher=fetcher,
+            )
+        elif remote_manifest_root:
+            task, report = reindex_url_remotely(
+                get_manifest(remote_manifest_root, handle),
+                url=url,
+                index_url=lambda: self.indexer_mixin.index_url(
+                    url=url,
+                    metadata=metadata,
+                    index_handle=index_handle,
+                    mime_type=mime_type,
+                ),
+                # Recorded in the manifest (and answers invalidated) by `index_finished`, once indexing succeeds.
+                confirm=lambda task, record: self.invoke_later(
+                    method="index_finished",
+                    wait_on_tasks=[task],
+                    arguments={
+                        "index_handle": index_handle,
+                        "url": url,
+                        "record": asdict(record),
+                    },
+                ),
+                metadata=metadata,
+                fetcher=fetcher,
+            )
+        else:
+            task, report = (
+                self.indexer_mixin.index_url(
+                    url=url,
+                    metadata=metadata,
+                    index_handle=index_handle,
+                    mime_type=mime_type,
+                ),
+                None,
+            )
+        if report is not None and report.status == UNCHANGED:
+            return task
+        if local_root:
+            # New content invalidates every answer cached against the previous contents of this index.
+            bump_index_version(index_handle)
+        elif report is None:
+            # The remote index is only updated once the scheduled `index_file` step has run. Until then questions
+            # are still answered from the previous contents, so their answers are invalidated after it.
+            self.invoke_later(
+                method="index_finished",
+                wait_on_tasks=[task],
+                arguments={"index_handle": index_handle},
+            )
+        return task
+
+    @post("/index_finished")
+    def index_finished(
+        self,
+        index_handle: Optional[str] = None,
+        url: Optional[str] = None,
+        record: Optional[dict] = None,
+    ) -> bool:
+        """Scheduled after a remote indexing task succeeds: records the source in the manifest, if one is kept, and
+        invalidates the answers cached against the previous content.
+
+        Only the answers cached by the process that runs this are invalidated. Other workers keep theirs until they
+        expire (see `answer_cache`).
+        """
+        remote_manifest_root = manifest_root()
+        if url and record and remote_manifest_root:
+            manifest = get_manifest(
+                remote_manifest_root, index_handle or DEFAULT_INDEX_HANDLE
+            )
+            manifest.put(url, SourceRecord(**record))
+        bump_index_version(index_handle)
+        return True
+
+    @get("/index_urls_status")
+    def index_urls_status(self, job_id: str) -> dict:
+        """Progress of an `/index_urls` job."""
+        job = INGESTER.get(job_id)
+        if job is None:
+            raise SteamshipError(message=f"Unknown (or long finished) job {job_id}.")
+        return job.to_dict()
+
+    @get("answer_cache_stats")
+    def answer_cache_stats(self) -> dict:
+        """Hit/miss counters for the question answering cache."""
+        return ANSWER_CACHE.stats()
+
+    @get("router_stats")
+    def router_stats(self) -> dict:
+        """How many planner LLM calls the question router has skipped."""
+        return QUESTION_ROUTER.stats()
 
     @post("prompt")
-    def prompt(self, prompt: str) -> str:
-        """Run an agent with the provided text as the input."""
+    @METRICS.traced("prompt")
+    def prompt(self, prompt: str, session_id: Optional[str] = None) -> str:
+        """Run an agent with the provided text as the input.
+
+        Pass the same `session_id` on every turn of a conversation to continue its chat history.
+        """
 
         # AgentContexts serve to allow the AgentService to run agents
         # with appropriate information about the desired tasking.
-        # Here, we create a new context on each prompt, and append the
-        # prompt to the message history stored in the context.
-        context_id = uuid.uuid4()
-        context = AgentContext.get_or_create(self.client, {"id": f"{context_id}"})
-        context.chat_history.append_user_message(prompt)
-        # Add the LLM
-        context = with_llm(context=context, llm=OpenAI(client=self.client))
+        # Here, we get a context for this prompt (the warm, pooled one of
+        # its session, if it has one), append the prompt to the message
+        # history stored in the context, and add the LLM.
+        context = self.create_context(prompt, session_id)
 
         # AgentServices provide an emit function hook to access the output of running
         # agents and tools. The emit functions fire at after the supplied agent emits
@@ -147,4 +343,5 @@ if __name__ == "__main__":
     # AgentREPL provides a mechanism for local execution of an AgentService method.
     # This is used for simplified debugging as agents and tools are developed and
     # added.
-    AgentREPL(ExampleDocumentQAService, "prompt", agent_package_config={}).run()
+    # With CASSETTE_MODE=replay, it runs offline against a recorded cassette (see `cassette`).
+    run_repl(AgentREPL, ExampleDocumentQAService, "prompt", agent_package_config={})
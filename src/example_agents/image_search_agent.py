@@ -1,21 +1,22 @@
-import uuid
-from typing import List
+from typing import List, Optional
 
 from steamship import Block
 from steamship.agents.mixins.transports.steamship_widget import SteamshipWidgetTransport
-from steamship.agents.schema import AgentContext, Metadata
+from steamship.agents.schema import Metadata
 from steamship.agents.llms import OpenAI
-from steamship.agents.react import ReACTAgent
-from steamship.agents.service.agent_service import AgentService
 
 from steamship.agents.tools.image_generation.google_image_search import (
     GoogleImageSearchTool,
 )
 from steamship.agents.tools.search.search import SearchTool
-from steamship.agents.utils import with_llm
 from steamship.invocable import post
 from steamship.utils.repl import AgentREPL
 
+from async_agents import AsyncAgentService, AsyncReACTAgent
+from cassette import run_repl
+from history_window import HistoryPolicy
+from metrics import METRICS
+from search_cache import cached_search
 from utils import print_blocks
 
 SYSTEM_PROMPT = """You are Assistant, an assistant who helps search the web.
@@ -52,7 +53,7 @@ Action Input: the input to the action
 Observation: the result of the action
 ```
 
-Some Tools will return Observations in the format of `Block(<identifier>)`. `Block(<identifier>)` represents a successful
+{parallel_actions}Some Tools will return Observations in the format of `Block(<identifier>)`. `Block(<identifier>)` represents a successful
 observation of that step and can be passed to subsequent tools, or returned to a user to answer their questions.
 `Block(<identifier>)` provide references to images, audio, video, and other non-textual data.
 
@@ -81,24 +82,29 @@ Make sure to use all observations to come up with your final response.
 
 Begin!
 
-New input: {input}
+{history}New input: {input}
 {scratchpad}"""
 
 
-class ImageSearchBot(AgentService):
+class ImageSearchBot(AsyncAgentService):
     """Deployable Multimodal Agent that lets you talk to Google Search & Google Images.
 
     NOTE: To extend and deploy this agent, copy and paste the code into api.py.
 
     """
 
+    # Searches rarely depend on more than the previous request, so keep a short window and summary.
+    history_policy = HistoryPolicy(window_turns=2, summary_max_tokens=128)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
         # The agent's planner is responsible for making decisions about what to do for a given input.
-        self._agent = ReACTAgent(
-            tools=[SearchTool(), GoogleImageSearchTool()],
+        self._agent = AsyncReACTAgent(
+            tools=[cached_search(SearchTool()), cached_search(GoogleImageSearchTool())],
             llm=OpenAI(self.client),
+            # Searching for facts and finding a picture do not depend on each other, so do both at once.
+            max_parallel_actions=2,
         )
         self._agent.PROMPT = SYSTEM_PROMPT
 
@@ -110,18 +116,19 @@ class ImageSearchBot(AgentService):
         )
 
     @post("prompt")
-    def prompt(self, prompt: str) -> str:
-        """Run an agent with the provided text as the input."""
+    @METRICS.traced("prompt")
+    def prompt(self, prompt: str, session_id: Optional[str] = None) -> str:
+        """Run an agent with the provided text as the input.
+
+        Pass the same `session_id` on every turn of a conversation to continue its chat history.
+        """
 
         # AgentContexts serve to allow the AgentService to run agents
         # with appropriate information about the desired tasking.
-        # Here, we create a new context on each prompt, and append the
-        # prompt to the message history stored in the context.
-        context_id = uuid.uuid4()
-        context = AgentContext.get_or_create(self.client, {"id": f"{context_id}"})
-        context.chat_history.append_user_message(prompt)
-        # Add the LLM
-        context = with_llm(context=context, llm=OpenAI(client=self.client))
+        # Here, we get a context for this prompt (the warm, pooled one of
+        # its session, if it has one), append the prompt to the message
+        # history stored in the context, and add the LLM.
+        context = self.create_context(prompt, session_id)
 
         # AgentServices provide an emit function hook to access the output of running
         # agents and tools. The emit functions fire at after the supplied agent emits
@@ -145,8 +152,9 @@ class ImageSearchBot(AgentService):
 
 
 if __name__ == "__main__":
-    AgentREPL(
+    run_repl(
+        AgentREPL,
         ImageSearchBot,
         method="prompt",
         agent_package_config={"botToken": "not-a-real-token-for-local-testing"},
-    ).run()
+    )
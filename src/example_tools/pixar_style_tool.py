@@ -1,14 +1,107 @@
 """Tool for generating images."""
-from typing import List, Union, Any
+import threading
+from typing import Any, Dict, List, Union
 
-from steamship import Block, Task
-from steamship.agents.schema import AgentContext
+from pydantic import Field, PrivateAttr
+from steamship import Block, PluginInstance, Steamship, Task
+from steamship.agents.schema import AgentContext, Tool
 from steamship.agents.tools.base_tools import ImageGeneratorTool
 from steamship.agents.tools.image_generation.stable_diffusion import StableDiffusionTool
 from steamship.utils.repl import ToolREPL
 
+from image_cache import IMAGE_CACHE, image_key
 
-class PixarStyleTool(ImageGeneratorTool):
+
+class CachedImageTool(Tool):
+    """Runs an image generator tool on prompts made from `prompt_template`, reusing images from the image cache."""
+
+    name: str = "CachedImageTool"
+    human_description: str = "Generates an image from text."
+    agent_description = (
+        "Used to generate images from text prompts. Only use if the user has asked directly for an image. "
+        "When using this tool, the input should be a plain text string that describes, "
+        "in detail, the desired image."
+    )
+
+    prompt_template = "{subject}"
+
+    # The tool we wrap. It lives as long as this tool, and its plugin instance is loaded once per workspace.
+    image_generator: ImageGeneratorTool = Field(default_factory=StableDiffusionTool)
+
+    # Reuse the images of a prompt generated before (by any tool wrapping the same generator) instead of
+    # generating them again.
+    cache_images: bool = True
+
+    _plugin_instances: Dict[str, PluginInstance] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def generator(self, client: Steamship) -> PluginInstance:
+        """The wrapped tool's generator plugin instance in the workspace of `client`."""
+        workspace = client.config.workspace_id or client.config.workspace_handle
+        with self._lock:
+            if workspace not in self._plugin_instances:
+                self._plugin_instances[workspace] = client.use_plugin(
+                    plugin_handle=self.image_generator.generator_plugin_handle,
+                    instance_handle=self.image_generator.generator_plugin_instance_handle,
+                    config=self.image_generator.generator_plugin_config,
+                )
+            return self._plugin_instances[workspace]
+
+    def image_key(self, client: Steamship, prompt: str) -> str:
+        return image_key(
+            client.config.workspace_id or client.config.workspace_handle,
+            self.image_generator.generator_plugin_instance_handle
+            or self.image_generator.generator_plugin_handle,
+            self.image_generator.generator_plugin_config,
+            prompt,
+        )
+
+    def generate(self, prompts: List[str], context: AgentContext) -> List[Block]:
+        """Generate the images for a batch of prompts, in order.
+
+        Cached prompts are answered immediately. Every other distinct prompt is generated once, all of them
+        concurrently.
+        """
+        keys = [self.image_key(context.client, prompt) for prompt in prompts]
+        images: Dict[str, List[Block]] = {}
+        if self.cache_images:
+            for key in dict.fromkeys(keys):
+                cached = IMAGE_CACHE.get(key)
+                if cached is not None:
+                    images[key] = cached
+
+        pending = {
+            key: prompt for key, prompt in zip(keys, prompts) if key not in images
+        }
+        if pending:
+            generator = self.generator(context.client)
+            tasks = {
+                key: generator.generate(text=prompt, append_output_to_file=True)
+                for key, prompt in pending.items()
+            }
+            for key, task in tasks.items():
+                task.wait()
+                images[key] = self.image_generator.post_process(task, context)
+                if self.cache_images:
+                    IMAGE_CACHE.put(key, images[key])
+
+        return [block for key in keys for block in images[key]]
+
+    def run(
+        self, tool_input: List[Block], context: AgentContext
+    ) -> Union[List[Block], Task[Any]]:
+        # Modify the tool inputs by interpolating them with stored prompt here
+        prompts = [
+            self.prompt_template.format(subject=block.text)
+            for block in tool_input
+            if block.is_text()
+        ]
+
+        # Now return the results of running the wrapped generator on those modified prompts.
+        return self.generate(prompts, context)
+
+
+class PixarStyleTool(CachedImageTool):
     """Tool to generate a Pixar-style image.
 
     This example illustrates wrapping a tool (StableDiffusionTool) with a fixed prompt template that is combined with user input.
@@ -29,20 +122,18 @@ class PixarStyleTool(ImageGeneratorTool):
         "photo, octane render, 24mm, 4k, 24mm, DSLR, high quality, 60 fps, ultra realistic"
     )
 
-    def run(
-        self, tool_input: List[Block], context: AgentContext
-    ) -> Union[List[Block], Task[Any]]:
-        # Modify the tool inputs by interpolating them with stored prompt here
-        modified_inputs = [
-            Block(text=self.prompt_template.format(subject=block.text))
-            for block in tool_input
-        ]
 
-        # Create the Stable Diffusion tool we want to wrap
-        stable_diffusion_tool = StableDiffusionTool()
+def cached_images(tool: ImageGeneratorTool) -> CachedImageTool:
+    """`tool` behind the shared image cache, passing its input through as the prompt.
 
-        # Now return the results of running Stable Diffusion on those modified prompts.
-        return stable_diffusion_tool.run(modified_inputs, context)
+    The wrapper has the name and descriptions of `tool`, so planners see no difference.
+    """
+    return CachedImageTool(
+        name=tool.name,
+        human_description=tool.human_description,
+        agent_description=tool.agent_description,
+        image_generator=tool,
+    )
 
 
 if __name__ == "__main__":
@@ -1,15 +1,35 @@
 """Answers questions with the assistance of a VectorSearch plugin."""
-from typing import Any, List, Optional, Union
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Union
 
-from steamship import Block, Tag, Task
+from steamship import Block, Steamship, Tag, Task
 from steamship.agents.llms import OpenAI
 from steamship.agents.schema import AgentContext
 from steamship.agents.tools.question_answering.vector_search_tool import (
     VectorSearchTool,
 )
 from steamship.agents.utils import get_llm, with_llm
+from steamship.data.plugin.index_plugin_instance import (
+    EmbeddingIndexPluginInstance,
+    SearchResults,
+)
 from steamship.utils.repl import ToolREPL
 
+from answer_cache import ANSWER_CACHE, DEFAULT_SIMILARITY_THRESHOLD, get_index_version
+from async_agents import complete_async, run_sync, wait_task
+from cassette import CASSETTE, encode_model
+from context_packing import pack_context
+from local_index import (
+    Embedder,
+    LocalEmbeddingIndex,
+    completed_task,
+    get_local_index,
+    local_index_root,
+)
+from metrics import METRICS
+
 DEFAULT_QUESTION_ANSWERING_PROMPT = (
     "Use the following pieces of memory to answer the question at the end. "
     """If these pieces of memory don't contain the answer, just say that you don't know; don't try to make up an answer.
@@ -24,6 +44,13 @@ Helpful Answer:"""
 
 DEFAULT_SOURCE_DOCUMENT_PROMPT = "Source Document: {text}"
 
+NOTHING_FOUND_ANSWER = (
+    "Sorry, I didn't find anything in my document memory related to this question."
+)
+
+# The answer to a question that could not be answered because of an error. The error itself is only logged.
+ERROR_ANSWER = "Sorry, I wasn't able to answer this question."
+
 
 class VectorSearchQATool(VectorSearchTool):
     """Tool to answer questions with the assistance of a vector search plugin."""
@@ -39,30 +66,307 @@ class VectorSearchQATool(VectorSearchTool):
     source_document_prompt: Optional[str] = DEFAULT_SOURCE_DOCUMENT_PROMPT
     load_docs_count: int = 2
 
-    def answer_question(self, question: str, context: AgentContext) -> List[Block]:
-        index = self.get_embedding_index(context.client)
-        task = index.search(question, k=self.load_docs_count)
-        task.wait()
+    # When set, over-fetch `context_candidate_count` passages and pack as many as fit in this many prompt tokens
+    # (best-scoring first, near-duplicates dropped, trimmed at sentence boundaries) instead of `load_docs_count`.
+    context_token_budget: Optional[int] = 600
+    context_candidate_count: int = 8
+    context_duplicate_threshold: float = 0.8
+    answer_cache_enabled: bool = True
+    # Minimum trigram similarity for a previously asked question to be reused; 1.0 means exact matches only.
+    # Lower values also require the same content words, numbers and negations (see `answer_cache.content_words`).
+    answer_cache_similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD
+
+    # When more than one question arrives in a single `run`, submit the index searches for all of them up front,
+    # then wait for their results and complete their answers on a pool of at most `max_concurrent_answers` workers.
+    batch_questions: bool = True
+    max_concurrent_answers: int = 4
+
+    # Directory of a local embedding index to search instead of the Steamship embedding index.
+    # Defaults to the LOCAL_EMBEDDING_INDEX_PATH environment variable; if neither is set, the remote index is used.
+    local_index_path: Optional[str] = None
+    # Embeds the local index's passages and queries; a HashingEmbedder if unset. See `local_index.get_local_index`.
+    local_embedder: Optional[Embedder] = None
+
+    # A cassette (see `cassette`) records this tool's index searches and completions rather than its whole run, so
+    # that replaying it still exercises the caching, packing and prompting in between.
+    replay_inner_calls: bool = True
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def get_embedding_index(
+        self, client: Steamship
+    ) -> Union[EmbeddingIndexPluginInstance, LocalEmbeddingIndex]:
+        root = self.local_index_path or local_index_root()
+        if root:
+            return get_local_index(
+                root, self.embedding_index_instance_handle, self.local_embedder
+            )
+        return super().get_embedding_index(client)
+
+    def cached_answer(self, question: str) -> Optional[List[Block]]:
+        """Return a previously computed answer to `question`, if one is cached."""
+        if not self.answer_cache_enabled:
+            return None
+        return ANSWER_CACHE.get(
+            question,
+            index_handle=self.embedding_index_instance_handle,
+            similarity_threshold=self.answer_cache_similarity_threshold,
+        )
 
+    def search(
+        self,
+        question: str,
+        index: Union[EmbeddingIndexPluginInstance, LocalEmbeddingIndex],
+    ) -> Task:
+        """Search the index for passages relevant to `question`."""
+        k = self._search_count()
+        with METRICS.span("index.search"):
+            if isinstance(index, LocalEmbeddingIndex):
+                # The local index runs in process, so it is never recorded or replayed.
+                return index.search(question, k=k)
+
+            def search() -> SearchResults:
+                task = index.search(question, k=k)
+                task.wait()
+                return task.output
+
+            return completed_task(
+                CASSETTE.call(
+                    "index_search",
+                    [self.embedding_index_instance_handle, question, k],
+                    search,
+                    encode_model,
+                    SearchResults.parse_obj,
+                )
+            )
+
+    def dispatch_search(
+        self,
+        question: str,
+        index: Union[EmbeddingIndexPluginInstance, LocalEmbeddingIndex],
+    ) -> Callable[[], Task]:
+        """Submit the search for `question` without waiting on it; the returned function waits for its Task.
+
+        Only searches of the Steamship index are submitted at once. Local index searches, and searches that a
+        cassette records or replays, run when the returned function is called.
+        """
+        if CASSETTE.mode is not None or not isinstance(
+            index, EmbeddingIndexPluginInstance
+        ):
+            return lambda: self.search(question, index)
+        with METRICS.span("index.search"):
+            # EmbeddingIndexPluginInstance.search blocks on its own task; submit the raw search instead.
+            task = index.index.search(
+                question, k=self._search_count(), include_metadata=True
+            )
+
+        def wait() -> Task:
+            with METRICS.span("index.wait"):
+                task.wait()
+            return completed_task(SearchResults.from_query_results(task.output))
+
+        return wait
+
+    def _search_count(self) -> int:
+        return (
+            self.context_candidate_count
+            if self.context_token_budget
+            else self.load_docs_count
+        )
+
+    def prompt_from_results(
+        self, question: str, results: SearchResults
+    ) -> Optional[str]:
+        """Build the completion prompt for `question` from search results, or None if nothing was found."""
         source_texts = []
 
-        for item in task.output.items:
-            if item.tag and item.tag.text:
-                item_data = {"text": item.tag.text}
-                source_texts.append(self.source_document_prompt.format(**item_data))
+        if self.context_token_budget:
+            packed = pack_context(
+                [item.tag.text for item in results.items if item.tag and item.tag.text],
+                token_budget=self.context_token_budget,
+                template=self.source_document_prompt,
+                duplicate_threshold=self.context_duplicate_threshold,
+            )
+            logging.info(
+                f"Packed {len(packed.passages)} of {packed.candidates} passages into {packed.tokens_used} tokens "
+                f"({packed.duplicates_dropped} duplicates dropped, {packed.trimmed} trimmed)."
+            )
+            source_texts = packed.passages
+        else:
+            for item in results.items:
+                if item.tag and item.tag.text:
+                    item_data = {"text": item.tag.text}
+                    source_texts.append(self.source_document_prompt.format(**item_data))
 
         if not source_texts:
-            return [
-                Block(
-                    text="Sorry, I didn't find anything in my document memory related to this question."
-                )
-            ]
+            return None
 
-        final_prompt = self.question_answering_prompt.format(
+        return self.question_answering_prompt.format(
             **{"source_text": "\n".join(source_texts), "question": question}
         )
 
-        return get_llm(context).complete(prompt=final_prompt)
+    def remember_answer(self, question: str, answer: List[Block], index_version: int):
+        if self.answer_cache_enabled:
+            ANSWER_CACHE.put(
+                question,
+                answer,
+                index_handle=self.embedding_index_instance_handle,
+                index_version=index_version,
+            )
+
+    def answer_from_search(
+        self, question: str, task: Task, index_version: int, context: AgentContext
+    ) -> List[Block]:
+        """Complete an answer to `question` from the completed Task of `search`."""
+
+        final_prompt = self.prompt_from_results(question, task.output)
+        if final_prompt is None:
+            return [Block(text=NOTHING_FOUND_ANSWER)]
+
+        with METRICS.span("llm.completion"):
+            answer = CASSETTE.complete(get_llm(context), final_prompt)
+        self.remember_answer(question, answer, index_version)
+        return answer
+
+    def answer_question(self, question: str, context: AgentContext) -> List[Block]:
+        cached = self.cached_answer(question)
+        if cached is not None:
+            return cached
+
+        # Read before searching so an answer computed while new content lands is not cached as current.
+        index_version = get_index_version(self.embedding_index_instance_handle)
+        index = self.get_embedding_index(context.client)
+        task = self.search(question, index)
+        return self.answer_from_search(question, task, index_version, context)
+
+    def answer_question_or_apologize(
+        self, question: str, context: AgentContext
+    ) -> List[Block]:
+        """`answer_question`, answering `ERROR_ANSWER` instead if it fails. The failure is logged."""
+        try:
+            return self.answer_question(question, context)
+        except Exception:
+            logging.exception(f"Failed to answer question: {question}")
+            return [Block(text=ERROR_ANSWER)]
+
+    def answer_questions(
+        self, questions: List[str], context: AgentContext
+    ) -> List[List[Block]]:
+        """Answer several questions at once, returning one answer per question in the same order.
+
+        The index searches of every question are submitted first (see `dispatch_search`), so they all run at once.
+        Waiting for their results and completing the answers then run on a thread pool of at most
+        `max_concurrent_answers` workers. A question that fails is logged and answered with `ERROR_ANSWER`, as in
+        `answer_question_or_apologize`.
+        """
+        answers: List[Optional[List[Block]]] = [
+            self.cached_answer(question) for question in questions
+        ]
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        if not pending:
+            return answers
+
+        index_version = get_index_version(self.embedding_index_instance_handle)
+        index = self.get_embedding_index(context.client)
+
+        searches: Dict[int, Callable[[], Task]] = {}
+        for i in pending:
+            try:
+                searches[i] = self.dispatch_search(questions[i], index)
+            except Exception:
+                logging.exception(f"Failed to answer question: {questions[i]}")
+                answers[i] = [Block(text=ERROR_ANSWER)]
+
+        def wait_and_answer(question: str, search: Callable[[], Task]) -> List[Block]:
+            return self.answer_from_search(question, search(), index_version, context)
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.max_concurrent_answers, len(pending)))
+        ) as pool:
+            futures = {
+                i: pool.submit(
+                    METRICS.propagate(wait_and_answer), questions[i], searches[i]
+                )
+                for i in searches
+            }
+
+            for i, future in futures.items():
+                try:
+                    answers[i] = future.result()
+                except Exception:
+                    logging.exception(f"Failed to answer question: {questions[i]}")
+                    answers[i] = [Block(text=ERROR_ANSWER)]
+
+        return answers
+
+    async def search_async(
+        self,
+        question: str,
+        index: Union[EmbeddingIndexPluginInstance, LocalEmbeddingIndex],
+    ) -> SearchResults:
+        """Awaitable `search` that returns the search results themselves."""
+        k = self._search_count()
+        with METRICS.span("index.search"):
+            if isinstance(index, LocalEmbeddingIndex):
+                return (await run_sync(index.search, question, k=k)).output
+
+            async def search() -> SearchResults:
+                if isinstance(index, EmbeddingIndexPluginInstance):
+                    # EmbeddingIndexPluginInstance.search blocks on its own task; submit the raw search and await it.
+                    task = await run_sync(
+                        index.index.search, question, k=k, include_metadata=True
+                    )
+                    await wait_task(task)
+                    return SearchResults.from_query_results(task.output)
+                if hasattr(index, "asearch"):
+                    return await index.asearch(question, k=k)
+                return (await run_sync(index.search, question, k=k)).output
+
+            return await CASSETTE.acall(
+                "index_search",
+                [self.embedding_index_instance_handle, question, k],
+                search,
+                encode_model,
+                SearchResults.parse_obj,
+            )
+
+    async def answer_question_async(
+        self, question: str, context: AgentContext
+    ) -> List[Block]:
+        """Awaitable `answer_question`."""
+        cached = self.cached_answer(question)
+        if cached is not None:
+            return cached
+
+        index_version = get_index_version(self.embedding_index_instance_handle)
+        index = await run_sync(self.get_embedding_index, context.client)
+        results = await self.search_async(question, index)
+
+        final_prompt = self.prompt_from_results(question, results)
+        if final_prompt is None:
+            return [Block(text=NOTHING_FOUND_ANSWER)]
+
+        with METRICS.span("llm.completion"):
+            answer = await complete_async(get_llm(context), prompt=final_prompt)
+        self.remember_answer(question, answer, index_version)
+        return answer
+
+    async def arun(self, tool_input: List[Block], context: AgentContext) -> List[Block]:
+        """Awaitable `run`. Questions are answered concurrently, at most `max_concurrent_answers` at a time."""
+        slots = asyncio.Semaphore(max(1, self.max_concurrent_answers))
+
+        async def answer(question: str) -> List[Block]:
+            async with slots:
+                try:
+                    return await self.answer_question_async(question, context)
+                except Exception:
+                    logging.exception(f"Failed to answer question: {question}")
+                    return [Block(text=ERROR_ANSWER)]
+
+        questions = [block.text for block in tool_input if block.is_text()]
+        answers = await asyncio.gather(*[answer(question) for question in questions])
+        return [block for answer_blocks in answers for block in answer_blocks]
 
     def run(
         self, tool_input: List[Block], context: AgentContext
@@ -82,11 +386,18 @@ class VectorSearchQATool(VectorSearchTool):
             A lit of blocks containing the answers.
         """
 
+        questions = [block.text for block in tool_input if block.is_text()]
+        if self.batch_questions and len(questions) > 1:
+            answers = self.answer_questions(questions, context)
+        else:
+            answers = [
+                self.answer_question_or_apologize(question, context)
+                for question in questions
+            ]
+
         output = []
-        for input_block in tool_input:
-            if not input_block.is_text():
-                continue
-            for output_block in self.answer_question(input_block.text, context):
+        for answer in answers:
+            for output_block in answer:
                 output.append(output_block)
         return output
 
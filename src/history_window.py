@@ -0,0 +1,190 @@
+"""Windowed session chat histories with a rolling summary.
+
+A session (see `context_pool`) keeps its whole chat history in Steamship, but an agent only needs the recent part
+of it. A `HistoryPolicy` keeps the last `window_turns` turns verbatim and folds older messages into a rolling
+summary. The summary is written by the LLM on a background thread after a reply is recorded, so no request waits
+for it, and folded messages are dropped from the in-memory history. That bounds both the memory a session holds
+and the tokens its history adds to each planner prompt: at most `summary_max_tokens` plus `message_max_tokens` for
+each message in the window.
+"""
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+from steamship import Block
+from steamship.agents.memory import ChatHistory
+from steamship.agents.schema import LLM, AgentContext
+from steamship.agents.utils import get_llm
+from steamship.data.tags.tag_constants import RoleTag
+
+from cassette import CASSETTE
+from context_pool import SESSION_KEY
+from metrics import METRICS
+from scratchpad import truncate_tokens
+
+# Key in AgentContext.metadata holding the history policy of the service handling the request.
+HISTORY_POLICY_KEY = "history_policy"
+
+SUMMARY_PROMPT = """Summarize the conversation below for an assistant that will continue it, in at most {max_words} words.
+Keep names, facts, requests and decisions; leave out greetings and small talk.
+
+{summary}{messages}
+
+Summary:"""
+
+
+@dataclass
+class HistoryPolicy:
+    """How much of a session's chat history an agent sees and keeps in memory.
+
+    Set as `history_policy` on an agent service class. With `summarize` off, messages older than the window are
+    simply forgotten.
+    """
+
+    window_turns: int = 4
+    summarize: bool = True
+    summary_max_tokens: int = 256
+    message_max_tokens: int = 256
+    # At most this many of the messages being folded are summarized, newest first; older ones are dropped. Only a
+    # session reloaded from Steamship has more than a turn or two to fold at once.
+    max_fold_messages: int = 24
+
+
+class _SessionSummary:
+    __slots__ = ("text", "folding")
+
+    def __init__(self):
+        self.text = ""
+        self.folding = False
+
+
+def _role(block: Block) -> str:
+    return "Human" if block.chat_role == RoleTag.USER else "AI"
+
+
+class HistoryWindow:
+    """Applies history policies to pooled sessions, writing their summaries on a pool of `max_workers` threads."""
+
+    def __init__(self, max_workers: int = 2):
+        self._summaries: "weakref.WeakKeyDictionary[ChatHistory, _SessionSummary]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="history"
+        )
+        self.folds = 0
+        self.messages_folded = 0
+        self.summary_failures = 0
+
+    def render(self, context: AgentContext) -> str:
+        """The conversation before the latest user message, for the planner prompt: summary, then the window."""
+        policy: Optional[HistoryPolicy] = context.metadata.get(HISTORY_POLICY_KEY)
+        if policy is None or SESSION_KEY not in context.metadata:
+            return ""
+        history = context.chat_history
+        messages = list(history.messages)
+        if messages and messages[-1] is history.last_user_message:
+            messages = messages[:-1]
+        # Messages beyond the window that are still being folded are left out until their summary is ready.
+        window = [
+            message
+            for message in messages[-2 * policy.window_turns :]
+            if message.is_text() and message.chat_role != RoleTag.SYSTEM
+        ]
+        summary = self.summary(history)
+        if not window and not summary:
+            return ""
+
+        lines = ["Conversation so far:"]
+        if summary:
+            lines.append(f"(Summary of earlier conversation: {summary})")
+        lines.extend(
+            f"{_role(message)}: {truncate_tokens(message.text, policy.message_max_tokens)}"
+            for message in window
+        )
+        return "\n".join(lines) + "\n\n"
+
+    def summary(self, history: ChatHistory) -> str:
+        with self._lock:
+            state = self._summaries.get(history)
+            return state.text if state is not None else ""
+
+    def fold(self, context: AgentContext):
+        """Once a reply is recorded, fold the messages that left the window into the summary, in the background."""
+        policy: Optional[HistoryPolicy] = context.metadata.get(HISTORY_POLICY_KEY)
+        if policy is None or SESSION_KEY not in context.metadata:
+            return
+        history = context.chat_history
+        keep = 2 * policy.window_turns
+        with self._lock:
+            state = self._summaries.setdefault(history, _SessionSummary())
+            messages = history.messages
+            if state.folding or len(messages) <= keep:
+                return
+            state.folding = True
+            older = list(messages[: len(messages) - keep])
+        self._pool.submit(self._fold, history, state, older, policy, get_llm(context))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._summaries),
+                "folds": self.folds,
+                "messages_folded": self.messages_folded,
+                "summary_failures": self.summary_failures,
+            }
+
+    def _fold(
+        self,
+        history: ChatHistory,
+        state: _SessionSummary,
+        older: List[Block],
+        policy: HistoryPolicy,
+        llm: Optional[LLM],
+    ):
+        try:
+            text = state.text
+            if policy.summarize and llm is not None:
+                with METRICS.span("history.summarize", messages=len(older)):
+                    text = self._summarize(llm, state.text, older, policy)
+            forget_oldest = getattr(history.file, "forget_oldest", None)
+            with self._lock:
+                state.text = text
+                if forget_oldest is not None:
+                    forget_oldest(len(older))
+                self.folds += 1
+                self.messages_folded += len(older)
+        except Exception as e:
+            # The messages stay in memory, and folding is tried again after the next reply.
+            logging.warning(f"Unable to summarize chat history: {e}")
+            with self._lock:
+                self.summary_failures += 1
+        finally:
+            state.folding = False
+
+    @staticmethod
+    def _summarize(
+        llm: LLM, summary: str, older: List[Block], policy: HistoryPolicy
+    ) -> str:
+        messages = [
+            f"{_role(message)}: {truncate_tokens(message.text, policy.message_max_tokens)}"
+            for message in older[-policy.max_fold_messages :]
+            if message.is_text() and message.chat_role != RoleTag.SYSTEM
+        ]
+        if not messages:
+            return summary
+        prompt = SUMMARY_PROMPT.format(
+            max_words=policy.summary_max_tokens * 3 // 4,
+            summary=f"Summary so far: {summary}\n\n" if summary else "",
+            messages="\n".join(messages),
+        )
+        completion = CASSETTE.complete(llm, prompt)
+        return truncate_tokens(completion[0].text.strip(), policy.summary_max_tokens)
+
+
+# Shared by every agent service in the process.
+HISTORY_WINDOW = HistoryWindow()
@@ -0,0 +1,82 @@
+"""In-process, content-addressed cache of generated images.
+
+Images are keyed on a hash of everything that determines them: the workspace they were generated in (the blocks
+holding them live there), the generator plugin, its configuration, and the final prompt. Generating the same
+prompt again with the same generator returns the blocks of the first generation instead of paying for another.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from steamship import Block
+
+
+def image_key(
+    workspace_id: Optional[str],
+    plugin_handle: str,
+    plugin_config: dict,
+    prompt: str,
+) -> str:
+    """Content address of the images generated for `prompt` by a generator plugin configured with `plugin_config`."""
+    digest = hashlib.sha256()
+    for part in (
+        workspace_id or "",
+        plugin_handle,
+        json.dumps(plugin_config, sort_keys=True),
+        prompt,
+    ):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ImageCache:
+    """LRU cache of generated image blocks by content address (see `image_key`)."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, List[Block]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[List[Block]]:
+        with self._lock:
+            blocks = self._entries.get(key)
+            if blocks is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [block.copy() for block in blocks]
+
+    def put(self, key: str, blocks: List[Block]):
+        with self._lock:
+            self._entries[key] = [block.copy() for block in blocks]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+# Shared by every image tool in the process, so tools wrapping the same generator share its images.
+IMAGE_CACHE = ImageCache()
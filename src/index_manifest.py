@@ -0,0 +1,343 @@
+"""Incremental re-indexing: only embed what changed since a source was last indexed.
+
+An `IndexManifest` records, for each indexed source URL, the hash of its content (and of the metadata it was
+indexed with), its HTTP validators (ETag / Last-Modified), and the hash of every chunk along with the local index
+rows holding it. Re-indexing a source then:
+
+- asks the server for the content only if it changed (a conditional GET), so an unchanged source is not even
+  downloaded when the server supports validators;
+- skips everything when the content hash matches;
+- otherwise embeds only chunks whose hash is new, and deletes the rows of chunks that disappeared.
+
+Each call reports the work saved as a `ReindexReport`.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.error
+import urllib.request
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from steamship import Tag, Task
+
+from local_index import (
+    LocalEmbeddingIndex,
+    chunk_text,
+    completed_task,
+    extract_text,
+)
+
+INDEX_MANIFEST_PATH_ENV = "INDEX_MANIFEST_PATH"
+
+# ReindexReport statuses.
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+@dataclass
+class FetchResult:
+    """Outcome of a conditional fetch. `content` is None when the server reported the source as not modified."""
+
+    content: Optional[bytes]
+    mime_type: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+@dataclass
+class SourceRecord:
+    content_hash: str
+    size: int
+    metadata_hash: str = ""
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # Chunk hash -> rows of the local index holding that chunk. Empty for sources in the remote index.
+    chunks: Dict[str, List[int]] = field(default_factory=dict)
+
+
+@dataclass
+class ReindexReport:
+    url: str
+    status: str
+    chunks: int = 0
+    embedded: int = 0
+    embeddings_skipped: int = 0
+    deleted: int = 0
+    bytes_fetched: int = 0
+    bytes_not_fetched: int = 0
+
+
+ConditionalFetcher = Callable[[str, Optional[SourceRecord]], FetchResult]
+
+
+def fetch_if_modified(url: str, previous: Optional[SourceRecord] = None) -> FetchResult:
+    """GET `url`, sending the validators of the previous fetch so an unchanged source is not downloaded."""
+    request = urllib.request.Request(url)
+    if previous is not None and previous.etag:
+        request.add_header("If-None-Match", previous.etag)
+    if previous is not None and previous.last_modified:
+        request.add_header("If-Modified-Since", previous.last_modified)
+    try:
+        with urllib.request.urlopen(request) as response:  # noqa: S310
+            headers = response.headers
+            return FetchResult(
+                content=response.read(),
+                mime_type=headers.get_content_type(),
+                etag=headers.get("ETag"),
+                last_modified=headers.get("Last-Modified"),
+            )
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return FetchResult(
+                content=None,
+                etag=previous.etag if previous else None,
+                last_modified=previous.last_modified if previous else None,
+            )
+        raise
+
+
+def _hash(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def metadata_hash(metadata: Optional[dict]) -> str:
+    return _hash(json.dumps(metadata or {}, sort_keys=True))
+
+
+def comparable_record(
+    manifest: "IndexManifest", url: str, metadata: Optional[dict]
+) -> Optional[SourceRecord]:
+    """The manifest record of `url` if it was indexed with the same `metadata`, so that it can be reused."""
+    previous = manifest.get(url)
+    if previous is not None and previous.metadata_hash == metadata_hash(metadata):
+        return previous
+    return None
+
+
+def _is_unchanged(previous: Optional[SourceRecord], fetched: FetchResult) -> bool:
+    return previous is not None and (
+        fetched.content is None or previous.content_hash == _hash(fetched.content)
+    )
+
+
+class IndexManifest:
+    """What has been indexed from each source, persisted as an append-only JSON lines journal at `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sources: Dict[str, SourceRecord] = {}
+        self._source_locks: Dict[str, threading.Lock] = {}
+        self._load()
+
+    def source_lock(self, url: str) -> threading.Lock:
+        """Held while a source is being re-indexed, so concurrent updates of one source do not interleave."""
+        with self._lock:
+            return self._source_locks.setdefault(url, threading.Lock())
+
+    def get(self, url: str) -> Optional[SourceRecord]:
+        with self._lock:
+            return self._sources.get(url)
+
+    def put(self, url: str, record: SourceRecord):
+        with self._lock:
+            self._sources[url] = record
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"url": url, **asdict(record)}) + "\n")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sources)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            return
+        lines = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._sources[entry.pop("url")] = SourceRecord(**entry)
+                    lines += 1
+        if lines > 2 * len(self._sources):
+            self._compact()
+
+    def _compact(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for url, record in self._sources.items():
+                f.write(json.dumps({"url": url, **asdict(record)}) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+_manifests: Dict[str, IndexManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def manifest_root() -> Optional[str]:
+    """Where manifests for the remote index are kept (`INDEX_MANIFEST_PATH`), or None to always re-index."""
+    return os.environ.get(INDEX_MANIFEST_PATH_ENV) or None
+
+
+def get_manifest(root: str, index_handle: str) -> IndexManifest:
+    """Return the process-wide manifest of an index handle, loading it on first use."""
+    path = os.path.join(os.path.abspath(root), index_handle, "manifest.jsonl")
+    with _manifests_lock:
+        if path not in _manifests:
+            _manifests[path] = IndexManifest(path)
+        return _manifests[path]
+
+
+def _unchanged_report(
+    url: str, previous: SourceRecord, fetched: FetchResult
+) -> ReindexReport:
+    return ReindexReport(
+        url=url,
+        status=UNCHANGED,
+        chunks=sum(len(rows) for rows in previous.chunks.values()),
+        embeddings_skipped=sum(len(rows) for rows in previous.chunks.values()),
+        bytes_fetched=len(fetched.content or b""),
+        bytes_not_fetched=previous.size if fetched.content is None else 0,
+    )
+
+
+def index_content_incrementally(
+    index: LocalEmbeddingIndex,
+    manifest: IndexManifest,
+    url: str,
+    fetched: FetchResult,
+    metadata: Optional[dict] = None,
+) -> ReindexReport:
+    """Bring the chunks of `url` in a local index up to date with `fetched`, embedding only new chunks."""
+    previous = manifest.get(url)
+    if _is_unchanged(comparable_record(manifest, url, metadata), fetched):
+        return _unchanged_report(url, previous, fetched)
+
+    _metadata = {"source": url}
+    _metadata.update(metadata or {})
+    metadata_key = json.dumps(_metadata, sort_keys=True)
+    chunks: Dict[str, str] = {}
+    for chunk in chunk_text(extract_text(fetched.content, fetched.mime_type)):
+        chunks.setdefault(_hash(chunk, metadata_key), chunk)
+
+    old_chunks = previous.chunks if previous is not None else {}
+    new_hashes = [h for h in chunks if h not in old_chunks]
+    stale_rows = [
+        row for h, rows in old_chunks.items() if h not in chunks for row in rows
+    ]
+
+    rows = index.insert(
+        [Tag(text=chunks[h], value=dict(_metadata)) for h in new_hashes]
+    )
+    index.delete(stale_rows)
+
+    kept = {h: old_chunks[h] for h in chunks if h in old_chunks}
+    kept.update({h: [row] for h, row in zip(new_hashes, rows)})
+    manifest.put(
+        url,
+        SourceRecord(
+            content_hash=_hash(fetched.content),
+            size=len(fetched.content),
+            metadata_hash=metadata_hash(metadata),
+            etag=fetched.etag,
+            last_modified=fetched.last_modified,
+            chunks=kept,
+        ),
+    )
+    return ReindexReport(
+        url=url,
+        status=NEW if previous is None else CHANGED,
+        chunks=len(chunks),
+        embedded=len(new_hashes),
+        embeddings_skipped=len(chunks) - len(new_hashes),
+        deleted=len(stale_rows),
+        bytes_fetched=len(fetched.content),
+    )
+
+
+def reindex_url_locally(
+    index: LocalEmbeddingIndex,
+    manifest: IndexManifest,
+    url: str,
+    metadata: Optional[dict] = None,
+    mime_type: Optional[str] = None,
+    fetcher: ConditionalFetcher = fetch_if_modified,
+) -> Tuple[Task, ReindexReport]:
+    """Incrementally (re-)index `url` into a local index. Returns a completed Task and the work report."""
+    with manifest.source_lock(url):
+        fetched = fetcher(url, comparable_record(manifest, url, metadata))
+        if mime_type:
+            fetched.mime_type = mime_type
+        report = index_content_incrementally(index, manifest, url, fetched, metadata)
+    logging.info(f"Re-indexed {url}: {report}")
+    return completed_task(asdict(report)), report
+
+
+def reindex_url_remotely(
+    manifest: IndexManifest,
+    url: str,
+    index_url: Callable[[], Task],
+    confirm: Callable[[Task, SourceRecord], None],
+    metadata: Optional[dict] = None,
+    fetcher: ConditionalFetcher = fetch_if_modified,
+) -> Tuple[Task, ReindexReport]:
+    """Skip a remote re-index of `url` when its content is unchanged; otherwise run `index_url()`.
+
+    `index_url()` only schedules the indexing, so the new manifest record is handed to `confirm` with its Task
+    instead of being written at once; `confirm` must write it with `manifest.put` once the Task has succeeded. A
+    source whose indexing failed is then re-indexed next time rather than skipped as unchanged.
+
+    The Steamship index cannot delete individual entries, so a changed source is indexed in full and its stale
+    chunks remain searchable.
+    """
+    with manifest.source_lock(url):
+        return _reindex_remotely(manifest, url, index_url, confirm, metadata, fetcher)
+
+
+def _reindex_remotely(
+    manifest: IndexManifest,
+    url: str,
+    index_url: Callable[[], Task],
+    confirm: Callable[[Task, SourceRecord], None],
+    metadata: Optional[dict],
+    fetcher: ConditionalFetcher,
+) -> Tuple[Task, ReindexReport]:
+    previous = comparable_record(manifest, url, metadata)
+    fetched = fetcher(url, previous)
+    if _is_unchanged(previous, fetched):
+        report = ReindexReport(
+            url=url,
+            status=UNCHANGED,
+            bytes_fetched=len(fetched.content or b""),
+            bytes_not_fetched=previous.size if fetched.content is None else 0,
+        )
+        logging.info(f"Skipped re-indexing unchanged {url}: {report}")
+        return completed_task(asdict(report)), report
+
+    status = NEW if manifest.get(url) is None else CHANGED
+    task = index_url()
+    confirm(
+        task,
+        SourceRecord(
+            content_hash=_hash(fetched.content),
+            size=len(fetched.content),
+            metadata_hash=metadata_hash(metadata),
+            etag=fetched.etag,
+            last_modified=fetched.last_modified,
+        ),
+    )
+    report = ReindexReport(
+        url=url,
+        status=status,
+        bytes_fetched=len(fetched.content),
+    )
+    return task, report
@@ -0,0 +1,260 @@
+"""Bulk, concurrent ingestion of many URLs into an index.
+
+`BulkIngester.start` turns a batch of URLs into an `IngestionJob` and returns at once. URLs are de-duplicated up
+front; each remaining URL is fetched on a bounded, shared thread pool, de-duplicated again by content hash, and
+handed to an indexing function. Without a fetcher (when the indexer downloads URLs itself), URLs are handed over
+unfetched and only de-duplicated by URL. Failures are retried with jittered exponential backoff, and every item records
+its status, attempts and failure reason, so the job doubles as a progress report.
+"""
+import hashlib
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from steamship import Task
+
+from local_index import fetch_url
+
+# Item states. "duplicate" items were skipped because an earlier item had the same URL or content.
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+
+# Fetches a URL, returning its content and mime type.
+Fetcher = Callable[[str], Tuple[bytes, str]]
+# Indexes fetched content: (url, content, mime_type) -> Task whose output may carry a "chunks" count. Content and
+# mime type are None for jobs started without a fetcher.
+IndexDocument = Callable[[str, Optional[bytes], Optional[str]], Task]
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a URL for de-duplication: trimmed, scheme and host lowercased, fragment dropped."""
+    parts = urlsplit(url.strip())
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, "")
+    )
+
+
+@dataclass
+class IngestionItem:
+    url: str
+    status: str = PENDING
+    attempts: int = 0
+    error: Optional[str] = None
+    content_hash: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    bytes_fetched: int = 0
+    chunks: Optional[int] = None
+    task_id: Optional[str] = None
+    elapsed_ms: float = 0.0
+
+
+@dataclass
+class IngestionJob:
+    """A batch of URLs being ingested. `to_dict()` is the job handle returned to callers."""
+
+    job_id: str
+    items: List[IngestionItem]
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: Optional[float] = None
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._finished = threading.Event()
+        # Content hash -> the item indexing that content. An item that fails gives its content up.
+        self._content_owners: Dict[str, IngestionItem] = {}
+        self._unfinished = sum(1 for item in self.items if item.status == PENDING)
+        if not self._unfinished:
+            self._finish()
+
+    @property
+    def done(self) -> bool:
+        return self._finished.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until every item has finished; returns False if `timeout` elapsed first."""
+        return self._finished.wait(timeout)
+
+    def progress(self) -> dict:
+        with self._lock:
+            counts = {state: 0 for state in (PENDING, RUNNING, DONE, DUPLICATE, FAILED)}
+            for item in self.items:
+                counts[item.status] += 1
+            elapsed = (self.finished_at or time.perf_counter()) - self.started_at
+            return {
+                **counts,
+                "total": len(self.items),
+                "elapsed_s": elapsed,
+                "docs_per_min": counts[DONE] * 60 / elapsed if elapsed > 0 else 0.0,
+            }
+
+    def to_dict(self) -> dict:
+        progress = self.progress()
+        with self._lock:
+            items = [asdict(item) for item in self.items]
+        return {
+            "job_id": self.job_id,
+            "done": self.done,
+            "progress": progress,
+            "items": items,
+        }
+
+    def claim_content(self, item: IngestionItem, content_hash: str) -> Optional[str]:
+        """Claim the indexing of `item`'s content; returns the URL of an earlier item that indexed it, if any.
+
+        If another item with the same content is still being indexed, waits for it to finish. Should that item
+        fail, `item` claims the content in its place.
+        """
+        with self._changed:
+            item.content_hash = content_hash
+            while True:
+                owner = self._content_owners.setdefault(content_hash, item)
+                if owner is item:
+                    return None
+                if owner.status == DONE:
+                    return owner.url
+                self._changed.wait()
+
+    def set_status(self, item: IngestionItem, status: str):
+        with self._changed:
+            item.status = status
+            if status not in (DONE, DUPLICATE, FAILED):
+                return
+            if status == FAILED and self._content_owners.get(item.content_hash) is item:
+                del self._content_owners[item.content_hash]
+            self._changed.notify_all()
+            self._unfinished -= 1
+            if self._unfinished == 0:
+                self._finish()
+
+    def _finish(self):
+        self.finished_at = time.perf_counter()
+        self._finished.set()
+
+
+class BulkIngester:
+    """Runs ingestion jobs on one pool of `max_workers` threads, shared by all jobs in the process.
+
+    The last `max_jobs` jobs are kept for status lookups.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        max_attempts: int = 3,
+        backoff_s: float = 0.5,
+        max_jobs: int = 100,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.max_jobs = max_jobs
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ingestion"
+        )
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(
+        self,
+        urls: List[str],
+        index_document: IndexDocument,
+        fetcher: Optional[Fetcher] = fetch_url,
+    ) -> IngestionJob:
+        """Queue `urls` for ingestion and return the job tracking them.
+
+        Pass `fetcher=None` if `index_document` downloads URLs itself, so they are not downloaded twice.
+        """
+        items = []
+        seen: Dict[str, IngestionItem] = {}
+        for url in urls:
+            item = IngestionItem(url=url)
+            first = seen.setdefault(normalize_url(url), item)
+            if first is not item:
+                item.status, item.duplicate_of = DUPLICATE, first.url
+            items.append(item)
+
+        job = IngestionJob(job_id=f"{uuid.uuid4()}", items=items)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+        for item in items:
+            if item.status == PENDING:
+                self._pool.submit(self._ingest, job, item, index_document, fetcher)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _ingest(
+        self,
+        job: IngestionJob,
+        item: IngestionItem,
+        index_document: IndexDocument,
+        fetcher: Optional[Fetcher],
+    ):
+        start = time.perf_counter()
+        job.set_status(item, RUNNING)
+        status = FAILED
+        while item.attempts < self.max_attempts:
+            item.attempts += 1
+            try:
+                status = self._ingest_once(job, item, index_document, fetcher)
+                item.error = None
+                break
+            except Exception as e:
+                item.error = f"{type(e).__name__}: {e}"
+                logging.warning(
+                    f"Ingesting {item.url} failed (attempt {item.attempts}): {item.error}"
+                )
+                if item.attempts < self.max_attempts:
+                    delay = self.backoff_s * 2 ** (item.attempts - 1)
+                    time.sleep(delay * random.uniform(0.5, 1.5))  # noqa: S311
+        item.elapsed_ms = (time.perf_counter() - start) * 1000
+        job.set_status(item, status)
+
+    def _ingest_once(
+        self,
+        job: IngestionJob,
+        item: IngestionItem,
+        index_document: IndexDocument,
+        fetcher: Optional[Fetcher],
+    ) -> str:
+        if fetcher is None:
+            return self._index(item, index_document, None, None)
+        content, mime_type = fetcher(item.url)
+        item.bytes_fetched = len(content)
+        first = job.claim_content(item, hashlib.sha256(content).hexdigest())
+        if first is not None:
+            item.duplicate_of = first
+            return DUPLICATE
+        return self._index(item, index_document, content, mime_type)
+
+    @staticmethod
+    def _index(
+        item: IngestionItem,
+        index_document: IndexDocument,
+        content: Optional[bytes],
+        mime_type: Optional[str],
+    ) -> str:
+        task = index_document(item.url, content, mime_type)
+        item.task_id = task.task_id
+        if isinstance(task.output, dict):
+            item.chunks = task.output.get("chunks")
+        return DONE
+
+
+# Shared by the services in the process, so concurrent jobs together stay within one pool.
+INGESTER = BulkIngester()
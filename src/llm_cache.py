@@ -0,0 +1,254 @@
+"""Persistent cache of LLM completions.
+
+Agents send the same prompts again and again: a planner prompt with the same system prompt, input and empty
+scratchpad, or a question answering prompt over the same passages. `CachingLLM` wraps an LLM and answers prompts it
+has completed before from a SQLite database, keyed on a hash of the model, temperature, stop sequence and prompt.
+Only deterministic completions (temperature 0, by default) are cached; others always go to the model. Entries expire
+after `ttl_seconds`, and the least recently used entries are evicted beyond `max_entries`.
+
+OpenAI LLMs default to temperature 0.4, so nothing is cached unless a deployment opts in: `default_llm` gives the
+document QA planner, question answering and history summaries the temperature in `LLM_TEMPERATURE`, when set.
+
+The database may be shared by several worker processes. The cache never fails a completion: a database error
+(such as a lock held too long by another process) is logged and counted, and the completion goes to the model.
+Lookups only read; the times entries were last used are written in batches.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from steamship import Block
+from steamship.agents.llms.openai import OpenAI
+from steamship.agents.schema import LLM
+
+from cassette import CASSETTE, decode_blocks, encode_blocks, llm_settings
+
+COMPLETION_CACHE_PATH_ENV = "COMPLETION_CACHE_PATH"
+LLM_TEMPERATURE_ENV = "LLM_TEMPERATURE"
+
+# Last-use times are written once this many lookups have hit, if no `put` has written them before.
+_TOUCH_BATCH = 256
+
+
+def completion_key(
+    model: Optional[str], temperature: float, prompt: str, stop: Optional[str]
+) -> str:
+    digest = hashlib.sha256()
+    for part in (model or "", repr(float(temperature)), stop or "", prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class CompletionCache:
+    """On-disk LRU + TTL cache of completions, by `completion_key`."""
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 10000,
+        ttl_seconds: float = 7 * 24 * 3600.0,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Wait only briefly for another process's lock; a cache that is busy is a miss.
+        self._db = sqlite3.connect(path, timeout=0.5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, blocks TEXT NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS completions_used_at ON completions (used_at)"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+        # Key -> when it was last used, not yet written to the database.
+        self._touched: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def get(self, key: str) -> Optional[List[Block]]:
+        """The cached completion of `key`, or None. Expired entries are misses, and removed by the next `put`."""
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT blocks, created_at FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                self._error("read", e)
+                row = None
+            if row is None or row[1] + self.ttl_seconds <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = now
+            if len(self._touched) >= _TOUCH_BATCH:
+                try:
+                    self._write_touched()
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    self._error("write", e)
+        return decode_blocks(json.loads(row[0]))
+
+    def put(self, key: str, blocks: List[Block]):
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(encode_blocks(blocks)), now, now),
+                )
+                self._write_touched()
+                self.expirations += self._db.execute(
+                    "DELETE FROM completions WHERE created_at <= ?",
+                    (now - self.ttl_seconds,),
+                ).rowcount
+                self.evictions += self._db.execute(
+                    "DELETE FROM completions WHERE key IN "
+                    "(SELECT key FROM completions ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+                self._db.commit()
+            except sqlite3.Error as e:
+                self._error("write", e)
+
+    def skip(self):
+        """Count a completion that could not be cached, because its model is not deterministic."""
+        with self._lock:
+            self.uncacheable += 1
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._db.execute("DELETE FROM completions")
+            self._db.commit()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size. `hit_rate` is over cacheable completions only."""
+        with self._lock:
+            try:
+                entries = self._db.execute(
+                    "SELECT COUNT(*) FROM completions"
+                ).fetchone()[0]
+            except sqlite3.Error as e:
+                self._error("read", e)
+                entries = None
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "uncacheable": self.uncacheable,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "entries": entries,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+    def _write_touched(self):
+        """Write the pending last-use times, in the caller's transaction. Called with the lock held."""
+        if self._touched:
+            self._db.executemany(
+                "UPDATE completions SET used_at = ? WHERE key = ?",
+                [(used_at, key) for key, used_at in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _error(self, operation: str, e: sqlite3.Error):
+        """Count and log a database error; the lookup or write it interrupted is skipped. Called with the lock held."""
+        self.errors += 1
+        if self._db.in_transaction:
+            self._db.rollback()
+        logging.warning(f"Completion cache {self.path}: {operation} failed: {e}")
+
+
+class CachingLLM(LLM):
+    """Completes prompts with `llm`, reusing earlier completions from `cache` when `llm` is deterministic."""
+
+    llm: LLM
+    cache: CompletionCache
+    # Completions at a higher temperature than this vary from call to call, so they are never cached.
+    max_temperature: float = 0.0
+    # A cassette (see `cassette`) records the wrapped LLM's completions, not cache hits.
+    replay_inner_calls: bool = True
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def key(self, prompt: str, stop: Optional[str] = None) -> Optional[str]:
+        """The cache key of a completion, or None if it cannot be cached."""
+        model, temperature = llm_settings(self.llm)
+        if temperature is None or temperature > self.max_temperature:
+            return None
+        return completion_key(model, temperature, prompt, stop)
+
+    def complete(self, prompt: str, stop: Optional[str] = None) -> List[Block]:
+        key = self.key(prompt, stop)
+        if key is None:
+            self.cache.skip()
+            return CASSETTE.complete(self.llm, prompt, stop)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        blocks = CASSETTE.complete(self.llm, prompt, stop)
+        self.cache.put(key, blocks)
+        return blocks
+
+    async def acomplete(self, prompt: str, stop: Optional[str] = None) -> List[Block]:
+        # Imported here, as async_agents wraps its LLMs with this module.
+        from async_agents import complete_async
+
+        key = self.key(prompt, stop)
+        if key is None:
+            self.cache.skip()
+            return await complete_async(self.llm, prompt, stop)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        blocks = await complete_async(self.llm, prompt, stop)
+        self.cache.put(key, blocks)
+        return blocks
+
+
+def cached_llm(llm: LLM) -> LLM:
+    """`llm` behind the shared completion cache, or `llm` itself if the cache is disabled."""
+    if COMPLETION_CACHE is None:
+        return llm
+    return CachingLLM(llm=llm, cache=COMPLETION_CACHE)
+
+
+def default_llm(client) -> LLM:
+    """OpenAI at `LLM_TEMPERATURE` (its own default, 0.4, if unset) behind the shared completion cache.
+
+    Set `LLM_TEMPERATURE` to 0 to make completions deterministic, and so cacheable.
+    """
+    temperature = os.environ.get(LLM_TEMPERATURE_ENV)
+    if temperature:
+        return cached_llm(OpenAI(client=client, temperature=float(temperature)))
+    return cached_llm(OpenAI(client=client))
+
+
+def _default_cache() -> Optional[CompletionCache]:
+    path = os.environ.get(
+        COMPLETION_CACHE_PATH_ENV,
+        os.path.join(tempfile.gettempdir(), "completion-cache.sqlite3"),
+    )
+    return CompletionCache(path) if path else None
+
+
+# Shared by every agent service in the process. Set COMPLETION_CACHE_PATH to an empty string to disable it.
+COMPLETION_CACHE = _default_cache()
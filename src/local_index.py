@@ -0,0 +1,512 @@
+"""Local, in-process embedding index that can stand in for the Steamship embedding index.
+
+Embeddings are stored as a float32 matrix in a memory-mapped file next to a JSON-lines file of the tags they
+were computed from. Search is either brute force (one matrix-vector product) or an inverted file (IVF) index
+that only scores the rows in the clusters nearest the query.
+
+Set the `LOCAL_EMBEDDING_INDEX_PATH` environment variable (or `VectorSearchQATool.local_index_path`) to make the
+question answering tool and the `/index_url` endpoint use a local index instead of the remote one.
+"""
+
+import hashlib
+import html
+import json
+import os
+import re
+import threading
+import urllib.request
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from steamship import SteamshipError, Tag, Task, TaskState
+from steamship.data.plugin.index_plugin_instance import SearchResult, SearchResults
+
+LOCAL_INDEX_PATH_ENV = "LOCAL_EMBEDDING_INDEX_PATH"
+
+# Chunks are about as long as the windows of Steamship's IndexerMixin, so local and remote passages are alike.
+CONTEXT_WINDOW_SIZE = 200
+CHUNK_MIN_SIZE = 50
+CHUNK_MAX_SIZE = 2 * CONTEXT_WINDOW_SIZE
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class Embedder(ABC):
+    """Turns texts into unit-length embedding vectors."""
+
+    dimensionality: int
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return a float32 array of shape (len(texts), dimensionality) with L2-normalized rows."""
+        raise NotImplementedError()
+
+
+class HashingEmbedder(Embedder):
+    """Deterministic, dependency-free embedder for offline use and tests.
+
+    Words and word bigrams are hashed into a fixed number of signed buckets. Texts that share vocabulary end up
+    close together, which is enough to exercise retrieval without a network connection.
+    """
+
+    def __init__(self, dimensionality: int = 256):
+        self.dimensionality = dimensionality
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensionality), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = _TOKEN_PATTERN.findall((text or "").lower())
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                bucket, sign = _hash_feature(feature, self.dimensionality)
+                vectors[row, bucket] += sign
+        return _normalize(vectors)
+
+
+@lru_cache(maxsize=65536)
+def _hash_feature(feature: str, dimensionality: int) -> Tuple[int, float]:
+    digest = int.from_bytes(
+        hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+    return digest % dimensionality, 1.0 if (digest >> 63) & 1 else -1.0
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+class LocalEmbeddingIndex:
+    """File-backed embedding index with the same `insert` / `search` surface as EmbeddingIndexPluginInstance.
+
+    `search_mode` is one of "brute", "ivf" or "auto" (IVF once the index holds at least `ivf_min_rows` rows).
+    Rows inserted after the IVF clustering was built join their nearest cluster; the clustering itself is rebuilt
+    (on the next IVF search) only once the index has grown by `ivf_rebuild_growth` since, so that interleaved
+    ingestion does not rerun k-means before every query.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        embedder: Optional[Embedder] = None,
+        search_mode: str = "auto",
+        ivf_min_rows: int = 20000,
+        ivf_lists: Optional[int] = None,
+        ivf_probes: int = 8,
+        ivf_rebuild_growth: float = 0.25,
+    ):
+        if search_mode not in ("brute", "ivf", "auto"):
+            raise SteamshipError(
+                message=f"Unknown local index search mode: {search_mode}"
+            )
+        self.path = path
+        self.embedder = embedder or HashingEmbedder()
+        self.search_mode = search_mode
+        self.ivf_min_rows = ivf_min_rows
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self.ivf_rebuild_growth = ivf_rebuild_growth
+
+        self._lock = threading.RLock()
+        self._tags: List[dict] = []
+        self._deleted: Set[int] = set()
+        self._deleted_mask: Optional[np.ndarray] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._ivf: Optional[Tuple[np.ndarray, List[np.ndarray]]] = None
+        # Rows in the index when the IVF clustering was last built.
+        self._ivf_rows = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @property
+    def embeddings_path(self) -> str:
+        return os.path.join(self.path, "embeddings.f32")
+
+    @property
+    def tags_path(self) -> str:
+        return os.path.join(self.path, "tags.jsonl")
+
+    @property
+    def deleted_path(self) -> str:
+        return os.path.join(self.path, "deleted.txt")
+
+    @property
+    def count(self) -> int:
+        """Rows in the index, including deleted ones (which are never returned by search)."""
+        return len(self._tags)
+
+    @property
+    def live_count(self) -> int:
+        return len(self._tags) - len(self._deleted)
+
+    def insert(self, tags: List[Tag]) -> List[int]:
+        """Embed and append tags to the index. Returns the rows they were stored at."""
+        if isinstance(tags, Tag):
+            tags = [tags]
+        for tag in tags:
+            if not tag.text:
+                raise SteamshipError(
+                    message="Please set the `text` field of your Tag before inserting it into an index."
+                )
+        if not tags:
+            return []
+        return self.insert_embeddings(
+            self.embedder.embed([tag.text for tag in tags]),
+            [{"text": tag.text, "value": tag.value or {}} for tag in tags],
+        )
+
+    def insert_embeddings(
+        self, embeddings: np.ndarray, records: List[dict]
+    ) -> List[int]:
+        """Append precomputed embeddings along with the records (text and value) they belong to.
+
+        Returns the rows they were stored at.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.shape != (len(records), self.embedder.dimensionality):
+            raise SteamshipError(
+                message=f"Expected embeddings of shape {(len(records), self.embedder.dimensionality)}, "
+                f"got {embeddings.shape}."
+            )
+        with self._lock:
+            with open(self.embeddings_path, "ab") as f:
+                f.write(embeddings.tobytes())
+            with open(self.tags_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            first_row = len(self._tags)
+            self._tags.extend(records)
+            self._matrix = None
+            self._deleted_mask = None
+            self._add_to_ivf(embeddings, first_row)
+            return list(range(first_row, len(self._tags)))
+
+    def delete(self, rows: Iterable[int]):
+        """Remove rows from search results. Their storage is kept; row numbers of other rows do not change."""
+        with self._lock:
+            rows = [int(row) for row in rows if int(row) not in self._deleted]
+            if not rows:
+                return
+            with open(self.deleted_path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{row}\n" for row in rows))
+            self._deleted.update(rows)
+            self._deleted_mask = None
+
+    def search(self, query: str, k: Optional[int] = None) -> Task[SearchResults]:
+        """Return the `k` most similar tags as an already-completed Task, like the remote index does."""
+        if query is None or len(query.strip()) == 0:
+            raise SteamshipError(message="Query field must be non-empty.")
+        return completed_task(self.search_embedding(self.embedder.embed([query])[0], k))
+
+    def search_embedding(
+        self, query_vector: np.ndarray, k: Optional[int] = None
+    ) -> SearchResults:
+        """Return the `k` tags whose embeddings are most similar to `query_vector`."""
+        k = k or 1
+        with self._lock:
+            matrix = self._get_matrix()
+            if matrix is None:
+                rows, scores = np.zeros(0, dtype=np.int64), np.zeros(
+                    0, dtype=np.float32
+                )
+            elif self._use_ivf():
+                rows, scores = self._search_ivf(matrix, query_vector, k)
+            else:
+                rows, scores = _top_k(self._mask_deleted(matrix @ query_vector), k)
+            if self._deleted:
+                live = np.isfinite(scores)
+                rows, scores = rows[live], scores[live]
+            items = [
+                SearchResult(
+                    tag=Tag(
+                        text=self._tags[row]["text"], value=self._tags[row]["value"]
+                    ),
+                    score=float(score),
+                )
+                for row, score in zip(rows, scores)
+            ]
+        return SearchResults(items=items)
+
+    def build_ivf(self):
+        """(Re)build the IVF clustering. Called lazily on the first IVF search, and after enough growth."""
+        with self._lock:
+            matrix = self._get_matrix()
+            if matrix is None:
+                return
+            n_lists = self.ivf_lists or max(1, int(np.sqrt(matrix.shape[0])))
+            centroids = _kmeans(matrix, n_lists)
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            lists = [
+                np.flatnonzero(assignments == i) for i in range(centroids.shape[0])
+            ]
+            self._ivf = (centroids, lists)
+            self._ivf_rows = matrix.shape[0]
+
+    def _add_to_ivf(self, embeddings: np.ndarray, first_row: int):
+        """Assign new rows to their nearest IVF clusters, or drop the clustering once it is due a rebuild."""
+        if self._ivf is None:
+            return
+        if len(self._tags) > self._ivf_rows * (1 + self.ivf_rebuild_growth):
+            self._ivf = None
+            return
+        centroids, lists = self._ivf
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+        lists = list(lists)
+        for i in np.unique(assignments):
+            lists[i] = np.concatenate(
+                [lists[i], first_row + np.flatnonzero(assignments == i)]
+            )
+        self._ivf = (centroids, lists)
+
+    def _use_ivf(self) -> bool:
+        if self.search_mode == "ivf":
+            return True
+        return self.search_mode == "auto" and self.count >= self.ivf_min_rows
+
+    def _search_ivf(
+        self, matrix: np.ndarray, query_vector: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        if self._ivf is None:
+            self.build_ivf()
+        centroids, lists = self._ivf
+        probes, _ = _top_k(centroids @ query_vector, self.ivf_probes)
+        candidates = np.concatenate([lists[probe] for probe in probes])
+        if candidates.size == 0:
+            return candidates, np.zeros(0, dtype=np.float32)
+        scores = matrix[candidates] @ query_vector
+        if self._deleted:
+            scores[self._get_deleted_mask()[candidates]] = -np.inf
+        local_rows, scores = _top_k(scores, k)
+        return candidates[local_rows], scores
+
+    def _mask_deleted(self, scores: np.ndarray) -> np.ndarray:
+        if self._deleted:
+            scores[self._get_deleted_mask()] = -np.inf
+        return scores
+
+    def _get_deleted_mask(self) -> np.ndarray:
+        if self._deleted_mask is None:
+            mask = np.zeros(len(self._tags), dtype=bool)
+            mask[list(self._deleted)] = True
+            self._deleted_mask = mask
+        return self._deleted_mask
+
+    def _get_matrix(self) -> Optional[np.ndarray]:
+        if self._matrix is None and self._tags:
+            self._matrix = np.memmap(
+                self.embeddings_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self._tags), self.embedder.dimensionality),
+            )
+        return self._matrix
+
+    def _load(self):
+        if not os.path.exists(self.tags_path):
+            return
+        with open(self.tags_path, encoding="utf-8") as f:
+            self._tags = [json.loads(line) for line in f if line.strip()]
+        if os.path.exists(self.deleted_path):
+            with open(self.deleted_path, encoding="utf-8") as f:
+                self._deleted = {int(line) for line in f if line.strip()}
+        expected_bytes = len(self._tags) * self.embedder.dimensionality * 4
+        if os.path.getsize(self.embeddings_path) != expected_bytes:
+            raise SteamshipError(
+                message=f"Local index at {self.path} is corrupt or was built with a different embedder."
+            )
+
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return top, scores[top]
+
+
+def _kmeans(
+    matrix: np.ndarray, n_lists: int, iterations: int = 10, sample_size: int = 50000
+) -> np.ndarray:
+    """Spherical k-means on a sample of rows; deterministic for a given matrix."""
+    rng = np.random.default_rng(0)
+    sample = matrix
+    if matrix.shape[0] > sample_size:
+        sample = matrix[
+            np.sort(rng.choice(matrix.shape[0], sample_size, replace=False))
+        ]
+    sample = np.asarray(sample)
+    n_lists = min(n_lists, sample.shape[0])
+    centroids = sample[rng.choice(sample.shape[0], n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignments == i]
+            if len(members):
+                centroids[i] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+    return centroids
+
+
+def completed_task(output) -> Task:
+    """Wrap a locally computed result in a Task that is already complete, so `task.wait()` returns at once."""
+    return Task(state=TaskState.succeeded, output=output)
+
+
+_indexes: Dict[Tuple[str, str], LocalEmbeddingIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def local_index_root() -> Optional[str]:
+    """The directory local indexes live under, or None if the remote index should be used."""
+    return os.environ.get(LOCAL_INDEX_PATH_ENV) or None
+
+
+def get_local_index(
+    root: str, index_handle: str, embedder: Optional[Embedder] = None
+) -> LocalEmbeddingIndex:
+    """Return the process-wide LocalEmbeddingIndex for an index handle, opening it on first use.
+
+    The index is opened with `embedder` (by default a HashingEmbedder). Every caller must then use the same kind
+    of embedder, since the stored embeddings were computed with it.
+    """
+    key = (os.path.abspath(root), index_handle)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = LocalEmbeddingIndex(
+                os.path.join(key[0], index_handle), embedder=embedder
+            )
+        index = _indexes[key]
+    if embedder is not None and (
+        type(embedder) is not type(index.embedder)
+        or embedder.dimensionality != index.embedder.dimensionality
+    ):
+        raise SteamshipError(
+            message=f"Local index {index_handle} is already open with a {index.embedder.dimensionality}-dimensional "
+            f"{type(index.embedder).__name__}, not a {embedder.dimensionality}-dimensional {type(embedder).__name__}."
+        )
+    return index
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def fetch_url(url: str) -> Tuple[bytes, str]:
+    """Download a URL, returning its content and mime type."""
+    with urllib.request.urlopen(url) as response:  # noqa: S310
+        return response.read(), response.headers.get_content_type()
+
+
+def extract_text(content: bytes, mime_type: Optional[str]) -> str:
+    """Convert downloaded content to plain text. Only text and HTML can be converted locally."""
+    if mime_type and not (
+        mime_type.startswith("text/")
+        or mime_type in ("application/json", "application/xml")
+    ):
+        raise SteamshipError(
+            message=f"Content of type {mime_type} can only be indexed with the remote Steamship index."
+        )
+    text = content.decode("utf-8", errors="replace")
+    if mime_type == "text/html":
+        extractor = _TextExtractor()
+        extractor.feed(text)
+        text = html.unescape(" ".join(extractor.parts))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _chunk_units(text: str) -> Iterable[str]:
+    """The sentences of whitespace-normalized text; sentences too long for one chunk are split into words."""
+    for sentence in _SENTENCE_END.split(text):
+        if len(sentence) <= CHUNK_MAX_SIZE:
+            yield sentence
+            continue
+        for word in sentence.split(" "):
+            for i in range(0, len(word), CHUNK_MAX_SIZE):
+                yield word[i : i + CHUNK_MAX_SIZE]
+
+
+def _ends_chunk(unit: str) -> bool:
+    """Whether a chunk ends after `unit`: decided by its text alone, with odds that make chunks about
+    CONTEXT_WINDOW_SIZE characters long on average."""
+    digest = hashlib.sha1(unit.encode("utf-8")).digest()  # noqa: S324
+    return int.from_bytes(digest[:4], "big") % CONTEXT_WINDOW_SIZE < len(unit)
+
+
+def chunk_text(text: str) -> List[str]:
+    """Split whitespace-normalized text into chunks at content-defined boundaries.
+
+    Chunks end after a sentence (or a word of a very long sentence) picked by a hash of its text, once they hold
+    at least CHUNK_MIN_SIZE characters, and never exceed CHUNK_MAX_SIZE. Where a chunk ends therefore depends on
+    the text around it, not on its offset, so an edit changes only the chunks it touches and the others keep their
+    hashes (see `index_manifest`).
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for unit in _chunk_units(text):
+        if not unit:
+            continue
+        if current and size + 1 + len(unit) > CHUNK_MAX_SIZE:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+        size += len(unit) + (1 if current else 0)
+        current.append(unit)
+        if size >= CHUNK_MIN_SIZE and _ends_chunk(unit):
+            chunks.append(" ".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def index_url_locally(
+    index: LocalEmbeddingIndex,
+    url: str,
+    metadata: Optional[dict] = None,
+    mime_type: Optional[str] = None,
+    fetcher: Callable[[str], Tuple[bytes, str]] = fetch_url,
+) -> Task:
+    """Fetch, convert, chunk and insert a URL into a local index. Returns a completed Task."""
+    content, fetched_mime_type = fetcher(url)
+    return index_content_locally(
+        index, url, content, mime_type or fetched_mime_type, metadata
+    )
+
+
+def index_content_locally(
+    index: LocalEmbeddingIndex,
+    url: str,
+    content: bytes,
+    mime_type: Optional[str],
+    metadata: Optional[dict] = None,
+) -> Task:
+    """Convert, chunk and insert already downloaded content into a local index. Returns a completed Task."""
+    text = extract_text(content, mime_type)
+    _metadata = {"source": url}
+    _metadata.update(metadata or {})
+    tags = [Tag(text=chunk, value=dict(_metadata)) for chunk in chunk_text(text)]
+    index.insert(tags)
+    return completed_task({"url": url, "chunks": len(tags)})
@@ -0,0 +1,275 @@
+"""Per-stage timing of agent requests.
+
+Slow work is wrapped in `METRICS.span(name)`: loading a session's context, planner LLM calls, tool runs, index
+searches, completions, speech synthesis, block publishing. A span opened while another is open becomes its child,
+so each request (a root span opened with `METRICS.request`) builds a tree of where its time went. Every span's
+duration is also added to an in-process histogram for its name, which the agent services serve, with call and error
+counts, from `/metrics`.
+
+A request that takes at least `SLOW_REQUEST_SECONDS` is logged with its whole span tree, and the most recent of
+them are kept for `/metrics`. Set `METRICS_ENABLED=0` to turn all of this off: `span` then hands back a shared
+no-op context manager.
+"""
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Callable, Deque, Dict, List, Optional, Sequence
+
+METRICS_ENABLED_ENV = "METRICS_ENABLED"
+SLOW_REQUEST_SECONDS_ENV = "SLOW_REQUEST_SECONDS"
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The span open in the current thread or asyncio task, if any.
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+_NO_SPAN = nullcontext()
+
+
+class Histogram:
+    """Call count, error count, total and bucketed distribution of one stage's durations."""
+
+    def __init__(self, bounds: Sequence[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def observe(self, seconds: float, error: bool = False):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.errors += error
+        self.total_s += seconds
+        self.max_s = max(self.max_s, seconds)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile, or the longest duration seen if that is lower."""
+        cumulative = 0
+        for i, count in enumerate(self.buckets):
+            cumulative += count
+            if count and cumulative >= q * self.count:
+                return (
+                    min(self.bounds[i], self.max_s)
+                    if i < len(self.bounds)
+                    else self.max_s
+                )
+        return 0.0
+
+    def to_dict(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.bounds, self.buckets):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_s": self.total_s,
+            "mean_s": self.total_s / self.count if self.count else 0.0,
+            "max_s": self.max_s,
+            "p50_s": self.quantile(0.5),
+            "p95_s": self.quantile(0.95),
+            "p99_s": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class Span:
+    """One timed stage of a request, with the stages it contains."""
+
+    __slots__ = ("name", "attributes", "started_at", "duration_s", "error", "children")
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = 0.0
+        self.duration_s: Optional[float] = None
+        self.error: Optional[str] = None
+        self.children: List[Span] = []
+
+    def to_dict(self, origin: Optional[float] = None) -> dict:
+        """The span tree, with start times in milliseconds since the start of the root span."""
+        origin = self.started_at if origin is None else origin
+        result = {
+            "name": self.name,
+            "start_ms": (self.started_at - origin) * 1000,
+            "duration_ms": (self.duration_s or 0.0) * 1000,
+        }
+        if self.attributes:
+            result["attributes"] = self.attributes
+        if self.error:
+            result["error"] = self.error
+        if self.children:
+            result["children"] = [child.to_dict(origin) for child in self.children]
+        return result
+
+    def format(self, depth: int = 0) -> str:
+        """The span tree as indented lines of name, duration and attributes."""
+        duration = (
+            f"{self.duration_s * 1000:.0f} ms"
+            if self.duration_s is not None
+            else "unfinished"
+        )
+        line = f"{'  ' * depth}{self.name} {duration}"
+        if self.attributes:
+            line += " " + " ".join(f"{k}={v}" for k, v in self.attributes.items())
+        if self.error:
+            line += f" error={self.error}"
+        return "\n".join(
+            [line] + [child.format(depth + 1) for child in list(self.children)]
+        )
+
+
+class _SpanScope:
+    """Context manager that opens a span on entry and records it on exit."""
+
+    __slots__ = ("metrics", "span", "is_request", "token")
+
+    def __init__(self, metrics: "Metrics", span: Span, is_request: bool):
+        self.metrics = metrics
+        self.span = span
+        self.is_request = is_request
+
+    def __enter__(self) -> Span:
+        parent = _current_span.get()
+        if parent is not None:
+            # A request made while another is open (one service calling another) is a stage of the outer one.
+            parent.children.append(self.span)
+            self.is_request = False
+        self.token = _current_span.set(self.span)
+        self.span.started_at = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        span = self.span
+        span.duration_s = time.perf_counter() - span.started_at
+        if exc_type is not None:
+            span.error = exc_type.__name__
+        _current_span.reset(self.token)
+        self.metrics.record(span, self.is_request)
+        return False
+
+
+class Metrics:
+    """Counters, per-stage latency histograms and slow request span trees, aggregated in process."""
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        slow_request_s: Optional[float] = None,
+        max_slow_requests: int = 20,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.enabled = enabled
+        self.slow_request_s = slow_request_s
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._slow_requests: Deque[dict] = deque(maxlen=max_slow_requests)
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **attributes):
+        """Time the enclosed block as stage `name`, as a child of the span open in this thread or task."""
+        if not self.enabled:
+            return _NO_SPAN
+        return _SpanScope(self, Span(name, attributes), False)
+
+    def request(self, name: str, **attributes):
+        """Time the enclosed block as a whole request: the root of a span tree, checked against the slow log."""
+        if not self.enabled:
+            return _NO_SPAN
+        return _SpanScope(self, Span(name, attributes), True)
+
+    def traced(self, name: str) -> Callable[[Callable], Callable]:
+        """Decorator timing each call of a (synchronous) endpoint as a request named `name`."""
+
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.request(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def propagate(self, func: Callable) -> Callable:
+        """`func`, bound to the current span so that it adds its spans to this request's tree on any thread.
+
+        Threads in a pool do not inherit the context of the thread that submits work to them; wrap the callable
+        when submitting it.
+        """
+        if not self.enabled or _current_span.get() is None:
+            return func
+        return functools.partial(contextvars.copy_context().run, func)
+
+    def increment(self, name: str, count: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def record(self, span: Span, is_request: bool = False):
+        """Add a finished span to its stage's histogram, and log it if it is a slow request."""
+        with self._lock:
+            histogram = self._histograms.get(span.name)
+            if histogram is None:
+                histogram = self._histograms[span.name] = Histogram(self.buckets)
+            histogram.observe(span.duration_s, span.error is not None)
+        if (
+            is_request
+            and self.slow_request_s is not None
+            and span.duration_s >= self.slow_request_s
+        ):
+            self.increment("slow_requests")
+            with self._lock:
+                self._slow_requests.append(span.to_dict())
+            logging.warning(
+                f"Slow request ({span.duration_s:.2f}s, over {self.slow_request_s:.2f}s):\n{span.format()}"
+            )
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "slow_request_s": self.slow_request_s,
+                "counters": dict(self._counters),
+                "stages": {
+                    name: histogram.to_dict()
+                    for name, histogram in sorted(self._histograms.items())
+                },
+                "slow_requests": list(self._slow_requests),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._slow_requests.clear()
+
+
+def _default_metrics() -> Metrics:
+    slow_request_s = os.environ.get(SLOW_REQUEST_SECONDS_ENV)
+    return Metrics(
+        enabled=os.environ.get(METRICS_ENABLED_ENV, "1").lower()
+        not in ("0", "false", "no", "off"),
+        slow_request_s=float(slow_request_s) if slow_request_s else None,
+    )
+
+
+# Shared by every agent service in the process. SLOW_REQUEST_SECONDS turns on the slow request log.
+METRICS = _default_metrics()
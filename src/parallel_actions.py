@@ -0,0 +1,113 @@
+"""Several independent tool calls in one ReACT step.
+
+A ReACT agent normally picks one tool per planning call, so a request that needs a web search and an image costs
+two planning calls and two tool runs, one after the other. An agent with `max_parallel_actions` above 1 is told
+(through the `{parallel_actions}` placeholder of its prompt) that it may name several independent actions before
+the first observation. `ParallelReACTOutputParser` turns them into one `ParallelAction`, which the agent services
+run concurrently and record in the scratchpad one after the other, in the order the planner named them, as if they
+had been separate steps. `run_actions` runs them, on a thread pool shared by every service in the process.
+"""
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from steamship import Block
+from steamship.agents.react.output_parser import ReACTOutputParser
+from steamship.agents.schema import Action, AgentContext, FinishAction
+
+from metrics import METRICS
+
+PARALLEL_ACTIONS_PROMPT = """If the input needs several tools and none of them needs another's Observation, you may use up to {max_actions} of them at once, naming each with its own Action and Action Input before the first Observation:
+
+```
+Thought: Do I need to use a tool? Yes
+Action: the first action to take
+Action Input: the input to the first action
+Action: the second action to take
+Action Input: the input to the second action
+Observation: the results of the actions
+```
+
+"""
+
+_ACTION = re.compile(r"Action: (.*?)[\n]*Action Input: (.*)")
+
+# Runs the actions of a ParallelAction, for every service in the process.
+_tool_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PARALLEL_TOOL_THREADS", "8")),
+    thread_name_prefix="tools",
+)
+
+
+def parallel_actions_prompt(max_actions: int) -> str:
+    """Text for the `{parallel_actions}` placeholder of a ReACT prompt; empty if only one action is allowed."""
+    if max_actions <= 1:
+        return ""
+    return PARALLEL_ACTIONS_PROMPT.format(max_actions=max_actions)
+
+
+class ParallelAction(Action):
+    """Independent actions chosen in one planning step, to be run concurrently.
+
+    `tool` and `input` are those of the first action, for code that logs them.
+    """
+
+    actions: List[Action]
+
+
+def action_steps(action: Action) -> List[Action]:
+    """The actions of a ParallelAction in the order the planner named them, or else `[action]`."""
+    return action.actions if isinstance(action, ParallelAction) else [action]
+
+
+def run_actions(
+    actions: List[Action],
+    run: Callable[[Action, AgentContext], List[Block]],
+    context: AgentContext,
+) -> List[List[Block]]:
+    """The outputs of `run(action, context)` for each of `actions`, in order. Several actions run concurrently."""
+    if len(actions) == 1:
+        return [run(actions[0], context)]
+    futures = [
+        _tool_pool.submit(METRICS.propagate(run), action, context) for action in actions
+    ]
+    return [future.result() for future in futures]
+
+
+class ParallelReACTOutputParser(ReACTOutputParser):
+    """ReACTOutputParser that accepts up to `max_actions` actions in one step."""
+
+    max_actions: int = 2
+
+    def parse(self, text: str, context: AgentContext) -> Action:
+        action = super().parse(text, context)
+        if isinstance(action, FinishAction):
+            return action
+
+        actions: List[Action] = []
+        seen = set()
+        for match in _ACTION.finditer(text):
+            name, tool_input = match.group(1).strip(), match.group(2).strip()
+            tool = self.tools_lookup_dict.get(name)
+            if tool is None:
+                raise RuntimeError(
+                    f"Could not find tool from action: `{name}`. Known tools: {self.tools_lookup_dict.keys()}"
+                )
+            if (name, tool_input) in seen:
+                continue
+            seen.add((name, tool_input))
+            actions.append(
+                Action(tool=tool, input=[Block(text=tool_input)], context=context)
+            )
+        if len(actions) > self.max_actions:
+            logging.warning(
+                f"Planner chose {len(actions)} actions at once; running the first {self.max_actions}."
+            )
+            actions = actions[: self.max_actions]
+        if len(actions) == 1:
+            return actions[0]
+        return ParallelAction(
+            tool=actions[0].tool, input=actions[0].input, actions=actions
+        )
@@ -0,0 +1,438 @@
+"""Process-wide scheduling of outbound LLM completions and tool runs under rate limits.
+
+Each upstream service has a scheduler of its own, and every call that leaves the process waits for the scheduler
+of its upstream to admit it, so a burst or a 429 at one upstream does not hold up calls to the others.
+`scheduled_complete` and `scheduled_run_tool` make a call through its scheduler; the cassette (see `cassette`)
+records and replays around them. LLM completions go to OpenAI through `SCHEDULER`. Admission takes one request from a token bucket refilled at
+`RATE_LIMIT_RPM` requests per minute and an estimate of the prompt and completion tokens from a bucket refilled at
+`RATE_LIMIT_TPM` tokens per minute. Tool runs go through `scheduler_for(tool_upstream(tool))`, which is unlimited
+unless `RATE_LIMIT_RPM_<UPSTREAM>` is set (for example `RATE_LIMIT_RPM_STABLE_DIFFUSION`). Each bucket holds at
+most `burst_s` seconds of its rate, so a burst of calls is spread out instead of arriving all at once. Calls
+waiting for admission are queued by priority: interactive prompts go before batch work, and calls of the same
+priority go in arrival order.
+
+A call that is rate limited anyway (a 429 from upstream, see `is_rate_limited`) is retried up to `max_attempts` times. The first 429
+pauses its scheduler's admissions for a jittered, exponentially growing delay and empties its buckets, so the queue
+resumes at the configured rate rather than retrying all at once. Queue depth, admissions, 429s and the time calls
+spent waiting, by priority, are served for each upstream from `/rate_limit_stats`.
+"""
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from steamship import Block, SteamshipError
+from steamship.agents.schema import LLM, AgentContext, Tool
+
+from metrics import METRICS, Histogram
+
+RATE_LIMIT_RPM_ENV = "RATE_LIMIT_RPM"
+RATE_LIMIT_TPM_ENV = "RATE_LIMIT_TPM"
+
+# The standard limits of gpt-3.5-turbo, the model the agents use.
+DEFAULT_RPM = 3500
+DEFAULT_TPM = 90000
+
+# The upstream of LLM completions.
+OPENAI = "openai"
+
+# Priorities: lower values are admitted first.
+INTERACTIVE = 0
+BATCH = 10
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+
+# Status codes and error codes with which upstreams report a rate limit.
+_RATE_LIMIT_CODES = {"429", "rate_limit_exceeded"}
+
+# How OpenAI's rate limit errors begin ("Rate limit reached for gpt-3.5-turbo in organization ...").
+_RATE_LIMIT_MESSAGE = "rate limit reached for"
+
+
+def is_rate_limited(e: Exception) -> bool:
+    """Whether `e` reports an upstream rate limit: an HTTP 429 or OpenAI's rate limit error.
+
+    Structured fields are checked first. Steamship has no error code of its own for a rate limit: when its OpenAI
+    plugin is rate limited, the generation task fails with the plugin's error, and waiting on the task raises a
+    SteamshipError with the task's `status_code` (which the plugin does not set to anything we can rely on) and
+    `status_message`. We assume that message, or the error it wraps, carries OpenAI's own text, and look for its
+    opening words. Other messages are not searched, as they often hold ids that happen to contain "429".
+    """
+    if type(e).__name__ == "RateLimitError":
+        return True
+    response = getattr(e, "response", None)
+    if any(
+        str(code) in _RATE_LIMIT_CODES
+        for code in (
+            getattr(e, "code", None),
+            getattr(e, "status_code", None),
+            getattr(e, "http_status", None),
+            getattr(response, "status_code", None),
+        )
+        if code is not None
+    ):
+        return True
+    return isinstance(e, SteamshipError) and any(
+        _RATE_LIMIT_MESSAGE in text.lower()
+        for text in (e.message, e.error)
+        if isinstance(text, str)
+    )
+
+
+class TokenBucket:
+    """Refills at `rate` units per second, holding at most `capacity` units."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units (at most a full bucket) are available."""
+        self._refill(now)
+        shortfall = min(amount, self.capacity) - self.level
+        return shortfall / self.rate if shortfall > 0 else 0.0
+
+    def take(self, amount: float, now: float):
+        """Take `amount` units. A call larger than the bucket leaves it in debt, which later calls wait out."""
+        self._refill(now)
+        self.level -= amount
+
+    def drain(self, now: float):
+        self._refill(now)
+        self.level = min(self.level, 0.0)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "enqueued_at", "grant", "cancelled")
+
+    def __init__(self, priority: int, tokens: int, grant: Callable[[], None]):
+        self.priority = priority
+        self.seq = 0
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.grant = grant
+        self.cancelled = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Scheduler:
+    """Admits outbound calls within request and token rate limits, highest priority first.
+
+    A limit of None (or 0) is not enforced; 429s are still retried with backoff. `name` is the upstream's, for logs.
+    """
+
+    def __init__(
+        self,
+        name: str = OPENAI,
+        requests_per_minute: Optional[float] = DEFAULT_RPM,
+        tokens_per_minute: Optional[float] = DEFAULT_TPM,
+        burst_s: float = 1.0,
+        completion_tokens: int = 256,
+        max_attempts: int = 5,
+        backoff_s: float = 1.0,
+        max_backoff_s: float = 30.0,
+    ):
+        self.name = name
+        self.burst_s = burst_s
+        self.completion_tokens = completion_tokens
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self._cond = threading.Condition()
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[threading.Thread] = None
+        self.configure(requests_per_minute, tokens_per_minute)
+        self.reset_stats()
+
+    def configure(
+        self,
+        requests_per_minute: Optional[float],
+        tokens_per_minute: Optional[float],
+    ):
+        """Change the limits. Buckets start full, and a pause after a 429 is lifted."""
+        with self._cond:
+            self._resume_at = 0.0
+            self._consecutive_limited = 0
+            self.requests_per_minute = requests_per_minute or None
+            self.tokens_per_minute = tokens_per_minute or None
+            self._requests = self._bucket(self.requests_per_minute)
+            self._tokens = self._bucket(self.tokens_per_minute)
+            self._cond.notify()
+
+    def reset_stats(self):
+        with self._cond:
+            self.admitted = 0
+            self.rate_limited = 0
+            self.retries = 0
+            self.failures = 0
+            self.max_queue_depth = len(self._queue)
+            self._waits: Dict[str, Histogram] = {}
+
+    def completion_tokens_for(self, prompt: str) -> int:
+        """Tokens charged for a completion of `prompt`: about four characters per token, plus the completion."""
+        return len(prompt) // 4 + self.completion_tokens
+
+    def call(
+        self, func: Callable[[], Any], tokens: int = 0, priority: int = INTERACTIVE
+    ) -> Any:
+        """`func()`, once admitted, charged one request and `tokens` tokens; retried with backoff when rate limited."""
+        for attempt in itertools.count(1):
+            admitted = threading.Event()
+            if self._admit_or_enqueue(tokens, priority, admitted.set) is not None:
+                with METRICS.span(
+                    "rate_limit.wait", upstream=self.name, priority=self._name(priority)
+                ):
+                    admitted.wait()
+            try:
+                result = func()
+            except Exception as e:
+                if not self._retry(e, attempt):
+                    raise
+            else:
+                self._consecutive_limited = 0
+                return result
+
+    async def acall(
+        self,
+        func: Callable[[], Awaitable[Any]],
+        tokens: int = 0,
+        priority: int = INTERACTIVE,
+    ) -> Any:
+        """Awaitable `call`, for a coroutine function `func`. Waiting for admission does not block the event loop."""
+        loop = asyncio.get_running_loop()
+        for attempt in itertools.count(1):
+            admitted = loop.create_future()
+            waiter = self._admit_or_enqueue(
+                tokens,
+                priority,
+                functools.partial(loop.call_soon_threadsafe, _resolve, admitted),
+            )
+            if waiter is not None:
+                try:
+                    with METRICS.span(
+                        "rate_limit.wait",
+                        upstream=self.name,
+                        priority=self._name(priority),
+                    ):
+                        await admitted
+                except asyncio.CancelledError:
+                    with self._cond:
+                        waiter.cancelled = True
+                    raise
+            try:
+                result = await func()
+            except Exception as e:
+                if not self._retry(e, attempt):
+                    raise
+            else:
+                self._consecutive_limited = 0
+                return result
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self.admitted,
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+                "failures": self.failures,
+                "paused_s": max(0.0, self._resume_at - time.monotonic()),
+                "wait": {
+                    name: histogram.to_dict()
+                    for name, histogram in sorted(self._waits.items())
+                },
+            }
+
+    def _bucket(self, per_minute: Optional[float]) -> Optional[TokenBucket]:
+        if per_minute is None:
+            return None
+        return TokenBucket(per_minute / 60, max(1.0, per_minute / 60 * self.burst_s))
+
+    @staticmethod
+    def _name(priority: int) -> str:
+        return PRIORITY_NAMES.get(priority, str(priority))
+
+    def _delay(self, tokens: int, now: float) -> float:
+        delay = self._resume_at - now
+        if self._requests is not None:
+            delay = max(delay, self._requests.delay(1, now))
+        if self._tokens is not None and tokens:
+            delay = max(delay, self._tokens.delay(tokens, now))
+        return delay
+
+    def _admit(self, priority: int, tokens: int, waited_s: float, now: float):
+        if self._requests is not None:
+            self._requests.take(1, now)
+        if self._tokens is not None:
+            self._tokens.take(tokens, now)
+        self.admitted += 1
+        name = self._name(priority)
+        histogram = self._waits.get(name)
+        if histogram is None:
+            histogram = self._waits[name] = Histogram()
+        histogram.observe(waited_s)
+
+    def _admit_or_enqueue(
+        self, tokens: int, priority: int, grant: Callable[[], None]
+    ) -> Optional[_Waiter]:
+        """Admit the call at once if nothing is queued and the limits allow it; otherwise queue it and return its waiter."""
+        with self._cond:
+            now = time.monotonic()
+            if not self._queue and self._delay(tokens, now) <= 0:
+                self._admit(priority, tokens, 0.0, now)
+                return None
+            waiter = _Waiter(priority, tokens, grant)
+            waiter.seq = next(self._seq)
+            heapq.heappush(self._queue, waiter)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name="rate-limit", daemon=True
+                )
+                self._dispatcher.start()
+            self._cond.notify()
+            return waiter
+
+    def _dispatch(self):
+        """Admit queued calls, highest priority first, as the limits allow."""
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                waiter = self._queue[0]
+                if waiter.cancelled:
+                    heapq.heappop(self._queue)
+                    continue
+                now = time.monotonic()
+                delay = self._delay(waiter.tokens, now)
+                if delay > 0:
+                    # Woken early by a new arrival, which may have a higher priority.
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+                self._admit(
+                    waiter.priority, waiter.tokens, now - waiter.enqueued_at, now
+                )
+                waiter.grant()
+
+    def _retry(self, e: Exception, attempt: int) -> bool:
+        """Whether to retry a call that raised `e` on its `attempt`th try. A 429 pauses every admission for a while."""
+        if not is_rate_limited(e):
+            return False
+        METRICS.increment("rate_limited")
+        with self._cond:
+            self.rate_limited += 1
+            if attempt >= self.max_attempts:
+                self.failures += 1
+                return False
+            self.retries += 1
+            now = time.monotonic()
+            if self._resume_at <= now:
+                # Only the first 429 of a burst sets the pause; the others wait it out with it. The pause grows
+                # with every pause that ends in another 429 rather than a successful call.
+                self._consecutive_limited += 1
+                delay = self.backoff_s * 2 ** (self._consecutive_limited - 1)
+                delay *= random.uniform(0.5, 1.5)  # noqa: S311
+                self._resume_at = now + min(self.max_backoff_s, delay)
+                for bucket in (self._requests, self._tokens):
+                    if bucket is not None:
+                        bucket.drain(now)
+                logging.warning(
+                    f"Rate limited by {self.name}; pausing calls to it for {self._resume_at - now:.1f}s: {e}"
+                )
+            self._cond.notify()
+        return True
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _limit(env: str, default: Optional[float]) -> Optional[float]:
+    value = os.environ.get(env)
+    return float(value) if value else default
+
+
+_schedulers: Dict[str, Scheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(upstream: str) -> Scheduler:
+    """The process-wide scheduler of calls to `upstream`, created on first use.
+
+    Its request limit is `RATE_LIMIT_RPM_<UPSTREAM>` (the name uppercased, with `_` for other characters), if set.
+    """
+    with _schedulers_lock:
+        if upstream not in _schedulers:
+            env = re.sub(r"[^A-Z0-9]+", "_", upstream.upper())
+            _schedulers[upstream] = Scheduler(
+                upstream,
+                requests_per_minute=_limit(f"{RATE_LIMIT_RPM_ENV}_{env}", None),
+                tokens_per_minute=None,
+            )
+        return _schedulers[upstream]
+
+
+def scheduled_complete(
+    llm: LLM, prompt: str, stop: Optional[str] = None
+) -> List[Block]:
+    """`llm.complete`, once `SCHEDULER` admits it."""
+    return SCHEDULER.call(
+        lambda: llm.complete(prompt=prompt, stop=stop),
+        tokens=SCHEDULER.completion_tokens_for(prompt),
+    )
+
+
+def scheduled_run_tool(
+    tool: Tool, tool_input: List[Block], context: AgentContext
+) -> List[Block]:
+    """`tool.run`, once the scheduler of the tool's upstream admits it."""
+    return scheduler_for(tool_upstream(tool)).call(
+        lambda: tool.run(tool_input, context)
+    )
+
+
+def tool_upstream(tool: Any) -> str:
+    """The upstream service a tool calls: its generator plugin, or the tool itself if it has none."""
+    # Image tools (see `CachedImageTool`) call the generator of the tool they wrap.
+    tool = getattr(tool, "image_generator", None) or tool
+    return getattr(tool, "generator_plugin_handle", None) or tool.name
+
+
+def all_stats() -> Dict[str, dict]:
+    """`stats()` of every upstream's scheduler, by upstream."""
+    with _schedulers_lock:
+        schedulers = sorted(_schedulers.items())
+    return {upstream: scheduler.stats() for upstream, scheduler in schedulers}
+
+
+# Shared by every agent service in the process. Set RATE_LIMIT_RPM or RATE_LIMIT_TPM to 0 to lift that limit.
+SCHEDULER = _schedulers[OPENAI] = Scheduler(
+    OPENAI,
+    requests_per_minute=_limit(RATE_LIMIT_RPM_ENV, DEFAULT_RPM),
+    tokens_per_minute=_limit(RATE_LIMIT_TPM_ENV, DEFAULT_TPM),
+)
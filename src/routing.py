@@ -0,0 +1,169 @@
+"""Local routing of question-shaped input straight to a tool, skipping the ReACT planner's LLM call.
+
+The document QA agent sends nearly every user message to its question answering tool, but the ReACT loop still
+pays a full completion to decide that. `QuestionRouter` scores the input with cheap heuristics (and, optionally,
+a small trained classifier) and only defers to the planner when it is not confident the input is a question.
+"""
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import Callable, Iterable, Optional, Tuple
+
+from steamship import Block
+from steamship.agents.schema import Action, AgentContext, Tool
+
+_WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+_QUESTION_WORDS = set("what how why when where which who whom whose".split())
+_AUXILIARY_VERBS = set(
+    "is are was were am do does did can could should would will shall may might must has have had".split()
+)
+_REQUEST_PHRASES = (
+    "tell me",
+    "explain",
+    "describe",
+    "list",
+    "give me",
+    "show me",
+    "define",
+    "compare",
+    "summarize",
+    "summarise",
+    "i want to know",
+    "i need to know",
+)
+_SMALL_TALK = {
+    "hi",
+    "hello",
+    "hey",
+    "thanks",
+    "thank you",
+    "ok",
+    "okay",
+    "bye",
+    "goodbye",
+    "good morning",
+    "good evening",
+    "good night",
+    "yes",
+    "no",
+    "cool",
+    "great",
+}
+
+
+def question_score(text: str) -> float:
+    """Heuristic confidence, from 0 to 1, that `text` is a question for the knowledge base."""
+    normalized = " ".join(_WORD_PATTERN.findall((text or "").lower()))
+    if not normalized or normalized in _SMALL_TALK:
+        return 0.0
+    words = normalized.split()
+    score = 0.0
+    if text.strip().endswith("?"):
+        score += 0.6
+    if words[0] in _QUESTION_WORDS or normalized.startswith(_REQUEST_PHRASES):
+        score += 0.6
+    elif words[0] in _AUXILIARY_VERBS:
+        # "Can you ..." and "Do you ..." are as often requests to the assistant as questions about documents.
+        score += 0.35
+    if len(words) < 3:
+        # "Why?" or "how so" are usually follow-ups that need the conversation, which only the planner sees.
+        score = min(score, 0.3)
+    return min(score, 1.0)
+
+
+def train_question_classifier(
+    examples: Iterable[Tuple[str, bool]]
+) -> Callable[[str], float]:
+    """Train a small multinomial naive Bayes classifier on (text, is_question) examples.
+
+    Returns a function giving the probability that a text is a question, usable as `QuestionRouter.classifier`.
+    """
+    word_counts = {True: Counter(), False: Counter()}
+    doc_counts = Counter()
+    for text, is_question in examples:
+        word_counts[bool(is_question)].update(_WORD_PATTERN.findall(text.lower()))
+        doc_counts[bool(is_question)] += 1
+    vocabulary = len(set(word_counts[True]) | set(word_counts[False])) or 1
+    totals = {label: sum(counts.values()) for label, counts in word_counts.items()}
+    documents = sum(doc_counts.values()) or 1
+
+    def classify(text: str) -> float:
+        log_odds = math.log((doc_counts[True] + 1) / (documents + 2)) - math.log(
+            (doc_counts[False] + 1) / (documents + 2)
+        )
+        for word in _WORD_PATTERN.findall(text.lower()):
+            p_question = (word_counts[True][word] + 1) / (totals[True] + vocabulary)
+            p_other = (word_counts[False][word] + 1) / (totals[False] + vocabulary)
+            log_odds += math.log(p_question / p_other)
+        return 1.0 / (1.0 + math.exp(-max(min(log_odds, 50.0), -50.0)))
+
+    return classify
+
+
+class QuestionRouter:
+    """Decides whether input can go straight to the question answering tool.
+
+    Input is routed when its score reaches `threshold`. With a `classifier`, the score is a blend of the
+    heuristic score and the classifier's probability, weighted by `classifier_weight`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.6,
+        classifier: Optional[Callable[[str], float]] = None,
+        classifier_weight: float = 0.5,
+    ):
+        self.threshold = threshold
+        self.classifier = classifier
+        self.classifier_weight = classifier_weight
+        self._lock = threading.Lock()
+        self.routed = 0
+        self.planned = 0
+
+    def score(self, text: str) -> float:
+        score = question_score(text)
+        if self.classifier is not None:
+            weight = self.classifier_weight
+            score = (1 - weight) * score + weight * self.classifier(text)
+        return score
+
+    def should_route(self, text: str) -> bool:
+        routed = self.score(text) >= self.threshold
+        with self._lock:
+            if routed:
+                self.routed += 1
+            else:
+                self.planned += 1
+        return routed
+
+    def stats(self) -> dict:
+        """How many first steps skipped the planner, and how many fell back to it."""
+        with self._lock:
+            decisions = self.routed + self.planned
+            return {
+                "planner_calls_skipped": self.routed,
+                "planner_fallbacks": self.planned,
+                "skip_rate": (self.routed / decisions) if decisions else 0.0,
+            }
+
+
+def route_to_tool(
+    router: QuestionRouter, tool: Tool, context: AgentContext
+) -> Optional[Action]:
+    """The Action calling `tool` with the user's message, if `router` is confident; otherwise None.
+
+    Either way, the decision is logged and counted in `router.stats()`.
+    """
+    text = context.chat_history.last_user_message.text
+    if router.should_route(text):
+        logging.info(f"Routed input straight to {tool.name}; planner skipped")
+        return Action(tool=tool, input=[Block(text=text)], context=context)
+    logging.info(f"Input not routed to {tool.name}; deferring to the planner")
+    return None
+
+
+# Shared by the agents in the process, so its counters cover every request.
+QUESTION_ROUTER = QuestionRouter()
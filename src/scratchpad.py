@@ -0,0 +1,142 @@
+"""Bounded ReACT scratchpads.
+
+A ReACT agent re-sends every earlier step (action, input, observation) on each planning call, so a few long
+observations, such as web search results, make every later call larger than the last. `bounded_scratchpad` caps
+each observation at a token budget, compacts the steps before the last few to a short excerpt of their
+observation, and omits the oldest steps if the prompt would still exceed its ceiling. Block references are never
+cut off, since the agent may need to return them.
+"""
+import logging
+from typing import List, Optional
+
+from steamship.agents.schema import Action, AgentContext
+
+from utils import block_references, count_tokens
+
+# Metadata key under which the prompt token counts of each planning step are recorded.
+SCRATCHPAD_KEY = "scratchpad"
+
+TRUNCATION_MARKER = " [...]"
+
+
+def observation_text(action: Action) -> str:
+    return " ".join(block.as_llm_input() for block in action.output or [])
+
+
+def format_step(action: Action, observation: str) -> str:
+    """One step of the scratchpad, as ReACTAgent formats it."""
+    return (
+        "Thought: Do I need to use a tool? Yes\n"
+        f"Action: {action.tool.name}\n"
+        f'Action Input: {" ".join([b.as_llm_input() for b in action.input])}\n'
+        f"Observation: {observation}\n"
+    )
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """The longest prefix of `text`, cut at a word boundary, that fits in `max_tokens` with a truncation marker.
+
+    Block references in the part cut off are appended after the marker.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    references = "".join(f" Block({ref})" for ref in block_references(text))
+    budget = max_tokens - count_tokens(TRUNCATION_MARKER + references)
+
+    # Binary search for the longest prefix within budget.
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    kept = text[:low]
+    if low < len(text) and not text[low].isspace() and " " in kept:
+        kept = kept[: kept.rindex(" ")]
+    kept = kept.rstrip()
+
+    missing = [ref for ref in block_references(text) if ref not in kept]
+    return kept + TRUNCATION_MARKER + "".join(f" Block({ref})" for ref in missing)
+
+
+def _omitted_note(steps: List[Action]) -> str:
+    if not steps:
+        return ""
+    references = [
+        ref for action in steps for ref in block_references(observation_text(action))
+    ]
+    note = f"({len(steps)} earlier steps omitted"
+    if references:
+        note += "; they returned " + " ".join(f"Block({ref})" for ref in references)
+    return f"{note}.)\n\n"
+
+
+def bounded_scratchpad(
+    steps: List[Action],
+    max_observation_tokens: int = 400,
+    keep_recent_steps: int = 2,
+    compacted_observation_tokens: int = 48,
+    token_budget: Optional[int] = None,
+    min_observation_tokens: int = 16,
+) -> str:
+    """The ReACT scratchpad of `steps`, kept within `token_budget` tokens where possible.
+
+    The last `keep_recent_steps` steps keep up to `max_observation_tokens` of their observation; earlier steps
+    keep `compacted_observation_tokens`. If the scratchpad is still over `token_budget`, the oldest steps are
+    omitted (the block references they returned are still listed), down to the most recent one, whose observation
+    is then cut further, to no less than `min_observation_tokens`.
+    """
+    recent_from = len(steps) - keep_recent_steps
+    observations = [
+        truncate_tokens(
+            observation_text(action),
+            max_observation_tokens
+            if i >= recent_from
+            else compacted_observation_tokens,
+        )
+        for i, action in enumerate(steps)
+    ]
+    texts = [format_step(a, o) for a, o in zip(steps, observations)]
+
+    omitted = 0
+    if token_budget is not None and steps:
+        # Steps are joined with newlines, each of which costs a token.
+        costs = [count_tokens(text) + 1 for text in texts]
+
+        def overflow() -> int:
+            note = count_tokens(_omitted_note(steps[:omitted]))
+            return note + sum(costs[omitted:]) - token_budget
+
+        while len(texts) - omitted > 1 and overflow() > 0:
+            omitted += 1
+        if overflow() > 0:
+            observation = truncate_tokens(
+                observations[-1],
+                max(
+                    count_tokens(observations[-1]) - overflow(), min_observation_tokens
+                ),
+            )
+            texts[-1] = format_step(steps[-1], observation)
+
+    scratchpad = _omitted_note(steps[:omitted]) + "\n".join(texts[omitted:])
+    return scratchpad + "Thought:"
+
+
+def record_prompt_tokens(
+    context: AgentContext, prompt: str, scratchpad: str, unbounded_scratchpad: str
+) -> dict:
+    """Log the token counts of a planning prompt and append them to `context.metadata[SCRATCHPAD_KEY]`."""
+    scratchpad_tokens = count_tokens(scratchpad)
+    step = {
+        "step": len(context.completed_steps),
+        "prompt_tokens": count_tokens(prompt),
+        "scratchpad_tokens": scratchpad_tokens,
+        "tokens_saved": count_tokens(unbounded_scratchpad) - scratchpad_tokens,
+    }
+    context.metadata.setdefault(SCRATCHPAD_KEY, []).append(step)
+    logging.info(
+        f"ReACT step {step['step']}: {step['prompt_tokens']} prompt tokens, "
+        f"{step['scratchpad_tokens']} in the scratchpad ({step['tokens_saved']} saved by bounding it)"
+    )
+    return step
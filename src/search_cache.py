@@ -0,0 +1,268 @@
+"""In-process cache of web and image search results.
+
+The same searches come up again and again ("today's wheat price", "aphid pictures"). `CachedSearchTool` wraps a
+search tool and answers a query it has seen recently from memory. Results are keyed on the tool and its
+configuration, the workspace (image results are blocks that live in it) and the query, lowercased and with its
+whitespace collapsed. Each wrapped tool has its own time to live, as prices go stale long before pictures of aphids
+do. The cache holds about `max_bytes` of results and evicts the least recently used beyond that. Identical searches
+that arrive while one is already in flight wait for its result instead of making their own upstream call.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from steamship import Block, Steamship, Task
+from steamship.agents.schema import AgentContext, Tool
+
+from cassette import CASSETTE
+
+# Time to live of each tool's results, by tool name; other tools get `DEFAULT_TTL_SECONDS`.
+TTL_SECONDS = {
+    "SearchTool": 15 * 60.0,
+    "GoogleImageSearchTool": 24 * 3600.0,
+}
+DEFAULT_TTL_SECONDS = 15 * 60.0
+
+# What SearchTool answers when the search failed. It is not a result worth keeping.
+_NO_RESULT = "No search result found"
+
+# Rough per-block overhead (ids, tags, mime type) on top of its text and URL.
+_BLOCK_OVERHEAD_BYTES = 256
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase a query and collapse its whitespace."""
+    return " ".join((query or "").lower().split())
+
+
+def search_key(workspace_id: Optional[str], tool: Tool, queries: List[str]) -> str:
+    """Cache key of a search for `queries` by `tool` (including its configuration) in a workspace."""
+    digest = hashlib.sha256()
+    for part in (
+        workspace_id or "",
+        type(tool).__name__,
+        json.dumps(tool.dict(), sort_keys=True, default=str),
+        *(normalize_query(query) for query in queries),
+    ):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _size_bytes(blocks: List[Block]) -> int:
+    return sum(
+        len(block.text or "") + len(block.url or "") + _BLOCK_OVERHEAD_BYTES
+        for block in blocks
+    )
+
+
+class _CacheEntry:
+    __slots__ = ("blocks", "size_bytes", "expires_at")
+
+    def __init__(self, blocks: List[Block], size_bytes: int, expires_at: float):
+        self.blocks = blocks
+        self.size_bytes = size_bytes
+        self.expires_at = expires_at
+
+
+class SearchCache:
+    """LRU + TTL cache of search results by `search_key`, bounded by approximately `max_bytes`.
+
+    Concurrent misses on one key are coalesced: the first caller of `lookup` searches and reports back with
+    `fulfil` or `fail`, and the others get a future of its result.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def lookup(self, key: str) -> Tuple[Optional[List[Block]], Optional[Future]]:
+        """The cached result of `key`, or else the future of an identical search in flight.
+
+        When there is neither, `(None, None)` is returned and the caller must search and then call `fulfil` or
+        `fail`; identical lookups until then wait for it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return [block.copy() for block in entry.blocks], None
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return None, future
+            self._in_flight[key] = Future()
+            self.misses += 1
+            return None, None
+
+    def fulfil(
+        self, key: str, blocks: List[Block], ttl_seconds: float, store: bool = True
+    ):
+        """Hand the result of the search for `key` to its waiters and, if `store`, cache it for `ttl_seconds`."""
+        blocks = [block.copy() for block in blocks]
+        with self._lock:
+            future = self._in_flight.pop(key, None)
+            if store and ttl_seconds > 0:
+                if key in self._entries:
+                    self._remove(key)
+                entry = _CacheEntry(
+                    blocks, _size_bytes(blocks), time.monotonic() + ttl_seconds
+                )
+                self._entries[key] = entry
+                self._bytes += entry.size_bytes
+                while len(self._entries) > 1 and self._bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        if future is not None:
+            future.set_result(blocks)
+
+    def fail(self, key: str, error: BaseException):
+        """Hand the failure of the search for `key` to its waiters. Failures are not cached."""
+        with self._lock:
+            future = self._in_flight.pop(key, None)
+        if future is not None:
+            future.set_exception(error)
+
+    def search(
+        self,
+        key: str,
+        search: Callable[[], List[Block]],
+        ttl_seconds: float,
+        cacheable: Callable[[List[Block]], bool] = bool,
+    ) -> List[Block]:
+        """The result of `key`: cached, shared with an identical search in flight, or from `search()`."""
+        blocks, in_flight = self.lookup(key)
+        if blocks is not None:
+            return blocks
+        if in_flight is not None:
+            return [block.copy() for block in in_flight.result()]
+        try:
+            blocks = search()
+        except BaseException as e:
+            self.fail(key, e)
+            raise
+        self.fulfil(key, blocks, ttl_seconds, store=cacheable(blocks))
+        return blocks
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size. `hit_rate` counts coalesced searches as hits."""
+        with self._lock:
+            lookups = self.hits + self.coalesced + self.misses
+            return {
+                "hits": self.hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "in_flight": len(self._in_flight),
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hit_rate": ((self.hits + self.coalesced) / lookups)
+                if lookups
+                else 0.0,
+            }
+
+    def _remove(self, key: str):
+        self._bytes -= self._entries.pop(key).size_bytes
+
+
+def _cacheable(blocks: List[Block]) -> bool:
+    return bool(blocks) and not any(block.text == _NO_RESULT for block in blocks)
+
+
+class CachedSearchTool(Tool):
+    """Runs `tool`, reusing its results for the same queries from `cache` for `ttl_seconds`."""
+
+    tool: Tool
+    cache: SearchCache
+    ttl_seconds: float = DEFAULT_TTL_SECONDS
+    # A cassette (see `cassette`) records the wrapped tool's searches, not cache hits.
+    replay_inner_calls: bool = True
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def key(self, tool_input: List[Block], client: Steamship) -> str:
+        workspace = client.config.workspace_id or client.config.workspace_handle
+        queries = [block.text for block in tool_input if block.is_text()]
+        return search_key(workspace, self.tool, queries)
+
+    def run(
+        self, tool_input: List[Block], context: AgentContext
+    ) -> Union[List[Block], Task[Any]]:
+        return self.cache.search(
+            self.key(tool_input, context.client),
+            lambda: CASSETTE.run_tool(self.tool, tool_input, context),
+            self.ttl_seconds,
+            _cacheable,
+        )
+
+    async def arun(self, tool_input: List[Block], context: AgentContext) -> List[Block]:
+        # Imported here, as async_agents' services build their agents with this module.
+        from async_agents import run_tool_async
+
+        key = self.key(tool_input, context.client)
+        blocks, in_flight = self.cache.lookup(key)
+        if blocks is not None:
+            return blocks
+        if in_flight is not None:
+            return [block.copy() for block in await asyncio.wrap_future(in_flight)]
+        try:
+            blocks = await run_tool_async(self.tool, tool_input, context)
+        except BaseException as e:
+            self.cache.fail(key, e)
+            raise
+        self.cache.fulfil(key, blocks, self.ttl_seconds, store=_cacheable(blocks))
+        return blocks
+
+
+def cached_search(tool: Tool, ttl_seconds: Optional[float] = None) -> Tool:
+    """`tool` behind the shared search cache, or `tool` itself if the cache is disabled.
+
+    The wrapper has the name and descriptions of `tool`, so planners see no difference.
+    """
+    if SEARCH_CACHE is None:
+        return tool
+    return CachedSearchTool(
+        name=tool.name,
+        human_description=tool.human_description,
+        agent_description=tool.agent_description,
+        tool=tool,
+        cache=SEARCH_CACHE,
+        ttl_seconds=TTL_SECONDS.get(tool.name, DEFAULT_TTL_SECONDS)
+        if ttl_seconds is None
+        else ttl_seconds,
+    )
+
+
+def _default_cache() -> Optional[SearchCache]:
+    max_bytes = int(os.environ.get("SEARCH_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+    return SearchCache(max_bytes) if max_bytes > 0 else None
+
+
+# Shared by every agent service in the process. Set SEARCH_CACHE_MAX_BYTES to 0 to disable it.
+SEARCH_CACHE = _default_cache()
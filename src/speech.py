@@ -0,0 +1,133 @@
+"""Sentence-pipelined speech synthesis.
+
+A reply is split at sentence boundaries and its sentences are synthesized concurrently on a shared, bounded
+pool. Audio is handed on in order as soon as each sentence (and every sentence before it) is ready, so the first
+audio is available after one sentence's synthesis time rather than the whole reply's.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Union
+
+from steamship import Block
+from steamship.agents.schema import EmitFunc, Metadata
+
+from metrics import METRICS
+
+# Metadata key under which the speech report of a request is stored.
+SPEECH_KEY = "speech"
+
+# End of a sentence: terminal punctuation, any closing quotes or brackets, then whitespace.
+_SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+")
+
+
+def split_sentences(text: str, min_chars: int = 20) -> List[str]:
+    """Split `text` into sentences, joining sentences shorter than `min_chars` onto the next one.
+
+    Very short clips ("Ah.") sound clipped when spoken on their own and cost a synthesis call each.
+    """
+    sentences, start = [], 0
+    for match in _SENTENCE_END.finditer(text or ""):
+        sentences.append(text[start : match.end()].strip())
+        start = match.end()
+    sentences.append((text or "")[start:].strip())
+
+    segments: List[str] = []
+    for sentence in filter(None, sentences):
+        if segments and len(segments[-1]) < min_chars:
+            segments[-1] = f"{segments[-1]} {sentence}"
+        else:
+            segments.append(sentence)
+    return segments
+
+
+class SpeechPipeline:
+    """Speaks the text blocks of agent output a sentence at a time, on a pool of `max_workers` threads."""
+
+    def __init__(self, max_workers: int = 8, min_sentence_chars: int = 20):
+        self.min_sentence_chars = min_sentence_chars
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="speech"
+        )
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.segments = 0
+        self.time_to_first_audio_s = 0.0
+
+    def submit(
+        self, blocks: List[Block], synthesize: Callable[[str], Block]
+    ) -> List[Union[Block, Future]]:
+        """Start synthesizing every sentence of every text block; other blocks are passed through, in place."""
+        items: List[Union[Block, Future]] = []
+        synthesize = METRICS.propagate(synthesize)
+        for block in blocks:
+            if not block.is_text():
+                items.append(block)
+                continue
+            for sentence in split_sentences(block.text, self.min_sentence_chars):
+                items.append(self._pool.submit(synthesize, sentence))
+        return items
+
+    def emit(
+        self,
+        blocks: List[Block],
+        synthesize: Callable[[str], Block],
+        emit_funcs: List[EmitFunc],
+        metadata: Metadata,
+    ) -> dict:
+        """Emit `blocks` with their text spoken, one block at a time and in order, as soon as each is ready.
+
+        Returns the request's speech report, which is also stored in `metadata[SPEECH_KEY]`.
+        """
+        started_at = time.perf_counter()
+        items = self.submit(blocks, synthesize)
+        report = {
+            "segments": sum(isinstance(item, Future) for item in items),
+            "time_to_first_audio_s": None,
+        }
+        try:
+            for item in items:
+                if isinstance(item, Future):
+                    item = item.result()
+                    if report["time_to_first_audio_s"] is None:
+                        report["time_to_first_audio_s"] = (
+                            time.perf_counter() - started_at
+                        )
+                for emit_func in emit_funcs:
+                    emit_func([item], metadata)
+        finally:
+            for item in items:
+                if isinstance(item, Future):
+                    item.cancel()
+        report["total_s"] = time.perf_counter() - started_at
+
+        metadata[SPEECH_KEY] = report
+        if report["segments"]:
+            logging.info(
+                f"Spoke {report['segments']} segments; first audio after "
+                f"{report['time_to_first_audio_s']:.2f}s, all after {report['total_s']:.2f}s"
+            )
+            with self._lock:
+                self.requests += 1
+                self.segments += report["segments"]
+                self.time_to_first_audio_s += report["time_to_first_audio_s"]
+        return report
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "segments": self.segments,
+                "mean_time_to_first_audio_s": (
+                    self.time_to_first_audio_s / self.requests if self.requests else 0.0
+                ),
+            }
+
+
+# Shared by the voice agents in the process, so concurrent requests together stay within one pool.
+SPEECH_PIPELINE = SpeechPipeline(
+    max_workers=int(os.environ.get("SPEECH_SYNTHESIS_THREADS", "8"))
+)
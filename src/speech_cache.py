@@ -0,0 +1,188 @@
+"""Persistent cache of synthesized speech.
+
+Audio is keyed on a hash of the workspace it was synthesized in (the blocks holding it live there), the speech
+plugin, its configuration (which includes the voice) and the normalized text. The cache stores a reference to the
+audio block rather than the audio itself, in a SQLite database, so stock phrases survive restarts and are spoken
+again without another synthesis call. Entries expire after `ttl_seconds`, and the least recently used entries are
+evicted beyond `max_entries`.
+
+The database may be shared by several worker processes. The cache never fails speech: a database error (such as a
+lock held too long by another process) is logged and counted, and the text is synthesized. Lookups only read; the
+times entries were last used are written in batches.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+from typing import Dict, Optional
+
+from steamship import Block
+
+SPEECH_CACHE_PATH_ENV = "SPEECH_CACHE_PATH"
+
+# Last-use times are written once this many lookups have hit, if no `put` has written them before.
+_TOUCH_BATCH = 256
+
+# The fields of an audio block needed to emit it again.
+_BLOCK_FIELDS = ("id", "file_id", "mime_type", "url", "content_url")
+
+
+def normalize_speech_text(text: str) -> str:
+    """Text as spoken: Unicode-normalized with whitespace collapsed. Case and punctuation change the delivery."""
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+def speech_key(
+    workspace_id: Optional[str], plugin_handle: str, plugin_config: dict, text: str
+) -> str:
+    digest = hashlib.sha256()
+    for part in (
+        workspace_id or "",
+        plugin_handle,
+        json.dumps(plugin_config, sort_keys=True),
+        normalize_speech_text(text),
+    ):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SpeechCache:
+    """On-disk LRU + TTL cache of audio block references, by `speech_key`."""
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 10000,
+        ttl_seconds: float = 30 * 24 * 3600.0,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Wait only briefly for another process's lock; a cache that is busy is a miss.
+        self._db = sqlite3.connect(path, timeout=0.5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS speech "
+            "(key TEXT PRIMARY KEY, block TEXT NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS speech_used_at ON speech (used_at)"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+        # Key -> when it was last used, not yet written to the database.
+        self._touched: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def get(self, key: str) -> Optional[Block]:
+        """The cached audio block of `key`, or None. Expired entries are misses, and removed by the next `put`."""
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT block, created_at FROM speech WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                self._error("read", e)
+                row = None
+            if row is None or row[1] + self.ttl_seconds <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = now
+            if len(self._touched) >= _TOUCH_BATCH:
+                try:
+                    self._write_touched()
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    self._error("write", e)
+        return Block(**json.loads(row[0]))
+
+    def put(self, key: str, block: Block):
+        if not block.id:
+            return
+        reference = json.dumps({name: getattr(block, name) for name in _BLOCK_FIELDS})
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO speech VALUES (?, ?, ?, ?)",
+                    (key, reference, now, now),
+                )
+                self._write_touched()
+                self.expirations += self._db.execute(
+                    "DELETE FROM speech WHERE created_at <= ?",
+                    (now - self.ttl_seconds,),
+                ).rowcount
+                self.evictions += self._db.execute(
+                    "DELETE FROM speech WHERE key IN "
+                    "(SELECT key FROM speech ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+                self._db.commit()
+            except sqlite3.Error as e:
+                self._error("write", e)
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._db.execute("DELETE FROM speech")
+            self._db.commit()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            try:
+                entries = self._db.execute("SELECT COUNT(*) FROM speech").fetchone()[0]
+            except sqlite3.Error as e:
+                self._error("read", e)
+                entries = None
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "entries": entries,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+    def _write_touched(self):
+        """Write the pending last-use times, in the caller's transaction. Called with the lock held."""
+        if self._touched:
+            self._db.executemany(
+                "UPDATE speech SET used_at = ? WHERE key = ?",
+                [(used_at, key) for key, used_at in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _error(self, operation: str, e: sqlite3.Error):
+        """Count and log a database error; the lookup or write it interrupted is skipped. Called with the lock held."""
+        self.errors += 1
+        if self._db.in_transaction:
+            self._db.rollback()
+        logging.warning(f"Speech cache {self.path}: {operation} failed: {e}")
+
+
+def _default_cache() -> Optional[SpeechCache]:
+    path = os.environ.get(
+        SPEECH_CACHE_PATH_ENV,
+        os.path.join(tempfile.gettempdir(), "speech-cache.sqlite3"),
+    )
+    return SpeechCache(path) if path else None
+
+
+# Shared by the voice agents in the process. Set SPEECH_CACHE_PATH to an empty string to disable it.
+SPEECH_CACHE = _default_cache()
@@ -0,0 +1,182 @@
+"""Incremental output from agent runs.
+
+`StreamingAgentService.stream_agent` runs an agent on a background thread and yields a `StreamEvent` as soon as
+each piece of output is available: every tool observation while the ReACT loop is still running, then the final
+text, then each non-text block once a URL for it has been resolved.
+"""
+
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+from steamship import Block, SteamshipError, Task
+from steamship.agents.logging import AgentLogging
+from steamship.agents.schema import Action, Agent, AgentContext, FinishAction, Metadata
+from steamship.agents.service.agent_service import AgentService
+
+from cassette import CASSETTE
+from metrics import METRICS
+from parallel_actions import action_steps, run_actions
+from utils import make_public_url
+
+# Key in AgentContext.metadata holding callables that are invoked with each completed (non-finish) Action.
+OBSERVERS_KEY = "action_observers"
+
+
+@dataclass
+class StreamEvent:
+    """One piece of streamed output.
+
+    `kind` is one of "observation" (a tool's output), "text" (final response text), "block" (a final non-text
+    block, with its URL), "error", or "done" (always last; carries the timing summary).
+    """
+
+    kind: str
+    text: Optional[str] = None
+    tool: Optional[str] = None
+    block_id: Optional[str] = None
+    mime_type: Optional[str] = None
+    url: Optional[str] = None
+    elapsed_ms: float = 0.0
+    timings: dict = field(default_factory=dict)
+
+
+_END = object()
+
+
+class _EventSink:
+    """Collects events from the agent thread, stamping each with its time since the stream started."""
+
+    def __init__(self, client, start: float):
+        self.client = client
+        self.start = start
+        self.events: "queue.Queue" = queue.Queue()
+
+    def put(self, event: StreamEvent):
+        event.elapsed_ms = (time.perf_counter() - self.start) * 1000
+        self.events.put(event)
+
+    def observe(self, action: Action):
+        for block in action.output or []:
+            self.put(
+                StreamEvent(
+                    kind="observation", tool=action.tool.name, text=block.as_llm_input()
+                )
+            )
+
+    def emit(self, blocks: List[Block], meta: Metadata):
+        for block in blocks:
+            if block.is_text():
+                self.put(StreamEvent(kind="text", text=block.text))
+        # Text goes out first; non-text blocks follow as each of their URLs resolves.
+        for block in blocks:
+            if not block.is_text():
+                self.put(
+                    StreamEvent(
+                        kind="block",
+                        block_id=block.id,
+                        mime_type=block.mime_type,
+                        url=_block_url(self.client, block),
+                    )
+                )
+
+    def close(self):
+        self.events.put(_END)
+
+    def __iter__(self) -> Iterator[StreamEvent]:
+        while True:
+            event = self.events.get()
+            if event is _END:
+                return
+            yield event
+
+
+class StreamingAgentService(AgentService):
+    """AgentService that can report tool observations as they happen and stream an agent's output."""
+
+    def run_action(self, action: Action, context: AgentContext):
+        if isinstance(action, FinishAction):
+            return
+        # The actions of a ParallelAction run concurrently, and are recorded in the order the planner chose them.
+        actions = action_steps(action)
+        outputs = run_actions(actions, self._run_tool, context)
+        for step, output in zip(actions, outputs):
+            step.output = output
+            context.completed_steps.append(step)
+            for observer in context.metadata.get(OBSERVERS_KEY, []):
+                observer(step)
+
+    @staticmethod
+    def _run_tool(action: Action, context: AgentContext) -> List[Block]:
+        with METRICS.span(f"tool.{action.tool.name}"):
+            if CASSETTE.records_tool(action.tool):
+                blocks_or_task = CASSETTE.run_tool(action.tool, action.input, context)
+            else:
+                blocks_or_task = action.tool.run(action.input, context)
+        if isinstance(blocks_or_task, Task):
+            raise SteamshipError(
+                "Tools return Tasks are not yet supported (but will be soon). "
+                "Please use synchronous Tasks (Tools that return List[Block] for now."
+            )
+        # Logged as AgentService.run_action does, for the REPL.
+        logging.info(
+            f"Tool {action.tool.name}: ({','.join(b.as_llm_input() for b in blocks_or_task)})",
+            extra={
+                AgentLogging.TOOL_NAME: action.tool.name,
+                AgentLogging.IS_MESSAGE: True,
+                AgentLogging.MESSAGE_TYPE: AgentLogging.OBSERVATION,
+                AgentLogging.MESSAGE_AUTHOR: AgentLogging.AGENT,
+            },
+        )
+        return blocks_or_task
+
+    def stream_agent(
+        self, agent: Agent, context: AgentContext, started_at: Optional[float] = None
+    ) -> Iterator[StreamEvent]:
+        """Run `agent` and yield its output incrementally.
+
+        The final "done" event reports `time_to_first_byte_ms` (until the first event was available) next to
+        `total_ms`, both measured from `started_at` (a `time.perf_counter()` value; defaults to now).
+        """
+        start = started_at or time.perf_counter()
+        sink = _EventSink(self.client, start)
+        context.metadata.setdefault(OBSERVERS_KEY, []).append(sink.observe)
+        context.emit_funcs.append(sink.emit)
+
+        def run():
+            try:
+                with METRICS.request("prompt_stream"):
+                    self.run_agent(agent, context)
+            except Exception as e:
+                logging.exception("Streaming agent run failed")
+                sink.put(StreamEvent(kind="error", text=str(e)))
+            finally:
+                sink.close()
+
+        threading.Thread(target=run, daemon=True).start()
+
+        time_to_first_byte_ms = None
+        for event in sink:
+            if time_to_first_byte_ms is None:
+                time_to_first_byte_ms = (time.perf_counter() - start) * 1000
+            yield event
+
+        total_ms = (time.perf_counter() - start) * 1000
+        timings = {"time_to_first_byte_ms": time_to_first_byte_ms, "total_ms": total_ms}
+        logging.info(f"Streamed agent run: {timings}")
+        yield StreamEvent(kind="done", elapsed_ms=total_ms, timings=timings)
+
+
+def _block_url(client, block: Block) -> Optional[str]:
+    if block.url:
+        return block.url
+    if block.content_url:
+        return block.content_url
+    try:
+        return make_public_url(client, block)
+    except Exception:
+        logging.exception(f"Unable to publish block {block.id}")
+        return None
@@ -1,16 +1,31 @@
 import logging
 import re
+import tempfile
+import threading
+import time
 import uuid
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from steamship import Block, Steamship
+import requests
+from steamship import Block, Steamship, SteamshipError
 from steamship.data.workspace import SignedUrl
 from steamship.utils.signed_urls import upload_to_signed_url
+from steamship.utils.url import apply_localstack_url_fix
 from termcolor import colored
 
+from cassette import CASSETTE
+from metrics import METRICS
+
 UUID_PATTERN = re.compile(
     r"([0-9A-Za-z]{8}-[0-9A-Za-z]{4}-[0-9A-Za-z]{4}-[0-9A-Za-z]{4}-[0-9A-Za-z]{12})"
 )
+# A reference to a block in LLM output: `Block(<uuid>)`, or a bare block id.
+BLOCK_REFERENCE_PATTERN = re.compile(
+    rf"Block\({UUID_PATTERN.pattern}\)|{UUID_PATTERN.pattern}"
+)
 
 
 def is_valid_uuid(uuid_to_test: str, version=4) -> bool:
@@ -23,14 +38,35 @@ def is_valid_uuid(uuid_to_test: str, version=4) -> bool:
     return str(uuid_obj) == lowered
 
 
-def show_result(client: Steamship, result: str):
-    maybe_block_id = UUID_PATTERN.search(result or "")
-    if maybe_block_id:
-        print(f"LLM response ('{result}') contained an image: ", end="")
-        signed_url = _make_image_public(
-            client, Block.get(client, _id=maybe_block_id.group())
+@lru_cache(maxsize=None)
+def _token_encoder(encoding_name: str):
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(encoding_name)
+    except Exception:
+        # tiktoken downloads its BPE tables on first use, which fails when offline.
+        logging.warning(
+            f"Unable to load tiktoken encoding {encoding_name}; estimating token counts instead."
         )
-        result = signed_url
+        return None
+
+
+def count_tokens(text: str, encoding_name: str = "cl100k_base") -> int:
+    """Count the tokens in `text` as the OpenAI chat models see them (estimated if tiktoken is unavailable)."""
+    if not text:
+        return 0
+    encoder = _token_encoder(encoding_name)
+    if encoder is None:
+        return max(1, len(text) // 4)
+    return len(encoder.encode(text))
+
+
+def show_result(client: Steamship, result: str):
+    urls = BLOCK_RESOLVER.resolve(client, result or "")
+    if urls:
+        print(f"LLM response ('{result}') contained {len(urls)} block(s): ", end="")
+        result = "\n".join(urls.values())
     print(result, end="\n\n")
 
 
@@ -39,84 +75,422 @@ def show_results(client: Steamship, results):
     if isinstance(results, str):
         show_result(client, results)
     else:
+        # Resolve the blocks of all results in one batch; showing each one then hits the cache.
+        BLOCK_RESOLVER.resolve(client, "\n".join(results))
         for result in results:
             show_result(client, result)
 
 
-def _make_image_public(client, block):
-    filepath = str(uuid.uuid4())
-    signed_url = (
-        client.get_workspace()
-        .create_signed_url(
-            SignedUrl.Request(
-                bucket=SignedUrl.Bucket.PLUGIN_DATA,
-                filepath=filepath,
-                operation=SignedUrl.Operation.WRITE,
-            )
+# Size of the pieces block content is read and uploaded in when streaming.
+STREAM_CHUNK_BYTES = 256 * 1024
+
+
+def open_block_content(client: Steamship, block: Block) -> requests.Response:
+    """Start downloading a block's content without reading it; iterate the response to consume it."""
+    if block.content_url:
+        response = requests.get(block.content_url, stream=True)
+    else:
+        # Same request as Block.raw(), but streamed; the SDK client has no public streaming call.
+        response = client._session.post(
+            client._url(operation="block/raw"),
+            json={"id": block.id},
+            headers=client._headers(),
+            stream=True,
         )
-        .signed_url
-    )
-    logging.info(f"Got signed url for uploading block content: {signed_url}")
-    read_signed_url = (
-        client.get_workspace()
-        .create_signed_url(
-            SignedUrl.Request(
-                bucket=SignedUrl.Bucket.PLUGIN_DATA,
-                filepath=filepath,
-                operation=SignedUrl.Operation.READ,
-            )
+    if response.status_code != 200:
+        raise SteamshipError(
+            message=f"Unable to read content of block {block.id}. Status code: {response.status_code}."
         )
-        .signed_url
-    )
-    upload_to_signed_url(signed_url, block.raw())
-    return read_signed_url
-
-
-def _make_public_url(client, block):
-    filepath = str(uuid.uuid4())
-    signed_url = (
-        client.get_workspace()
-        .create_signed_url(
-            SignedUrl.Request(
-                bucket=SignedUrl.Bucket.PLUGIN_DATA,
-                filepath=filepath,
-                operation=SignedUrl.Operation.WRITE,
-            )
+    return response
+
+
+class _ChunkedBody:
+    """File-like view of a sequence of byte chunks, holding at most one chunk at a time.
+
+    It reports its length, so `requests` sends a Content-Length header and streams the body, instead of using
+    chunked transfer encoding (which signed upload URLs reject).
+    """
+
+    def __init__(self, chunks: Iterator[bytes], length: int):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        chunk = self.read(STREAM_CHUNK_BYTES)
+        if not chunk:
+            raise StopIteration
+        return chunk
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b""
+            self._buffer = memoryview(chunk)
+        if size is None or size < 0:
+            size = len(self._buffer)
+        piece, self._buffer = self._buffer[:size], self._buffer[size:]
+        return piece.tobytes()
+
+
+def stream_to_signed_url(
+    url: str, response: requests.Response, chunk_bytes: int = STREAM_CHUNK_BYTES
+):
+    """Upload the body of a streamed download to a signed URL, `chunk_bytes` at a time.
+
+    If the download does not declare the length of its decoded content, it is spooled to a temporary file first (the
+    upload needs one). That includes compressed downloads: `iter_content` decodes their `Content-Encoding`, so
+    their `Content-Length` is not the length of the bytes uploaded.
+    """
+    chunks = response.iter_content(chunk_bytes)
+    length = response.headers.get("Content-Length")
+    if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+        length = None
+    spool = None
+    if length is not None:
+        body = _ChunkedBody(chunks, int(length))
+    else:
+        spool = body = tempfile.TemporaryFile()
+        for chunk in chunks:
+            spool.write(chunk)
+        spool.seek(0)
+    try:
+        http_response = requests.put(
+            apply_localstack_url_fix(url),
+            data=body,
+            headers={"Content-Type": "application/octet-stream"},
         )
-        .signed_url
-    )
-    logging.info(f"Got signed url for uploading block content: {signed_url}")
-    read_signed_url = (
-        client.get_workspace()
-        .create_signed_url(
-            SignedUrl.Request(
-                bucket=SignedUrl.Bucket.PLUGIN_DATA,
-                filepath=filepath,
-                operation=SignedUrl.Operation.READ,
+    finally:
+        response.close()
+        if spool is not None:
+            spool.close()
+    # S3 returns 204 upon success; we include 200 here for safety.
+    if http_response.status_code not in (200, 204):
+        raise SteamshipError(
+            message=f"Unable to upload data to signed URL. Status code: {http_response.status_code}. "
+            f"Status text: {http_response.text}"
+        )
+
+
+class _PublishedUrl:
+    __slots__ = ("filepath", "url", "expires_at")
+
+    def __init__(self, filepath: str, url: str, expires_at: float):
+        self.filepath = filepath
+        self.url = url
+        self.expires_at = expires_at
+
+
+class BlockPublisher:
+    """Publishes block content at signed read URLs, remembering each URL until shortly before it expires.
+
+    Publishing a block the first time costs three round trips (a write URL, the upload, a read URL). A block
+    published again while its URL is fresh costs none; one whose URL is about to expire costs one (a new read URL
+    for the already uploaded content). `publish` handles many blocks at once, in parallel.
+
+    With `stream_uploads`, content is piped from Steamship to the upload `STREAM_CHUNK_BYTES` at a time, so memory
+    use does not grow with the size of the image or audio being published.
+    """
+
+    ROUND_TRIPS_PER_PUBLISH = 3
+
+    def __init__(
+        self,
+        url_ttl_minutes: int = 60,
+        refresh_margin_s: float = 300,
+        max_entries: int = 1024,
+        max_workers: int = 8,
+        stream_uploads: bool = True,
+    ):
+        self.url_ttl_minutes = url_ttl_minutes
+        self.stream_uploads = stream_uploads
+        self.refresh_margin_s = refresh_margin_s
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, _PublishedUrl]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="publish"
+        )
+        self.uploads = 0
+        self.refreshes = 0
+        self.hits = 0
+        self.round_trips_saved = 0
+
+    def public_url(self, client: Steamship, block: Block) -> str:
+        """A signed URL from which `block`'s content can be read."""
+        return self.publish(client, [block])[0]
+
+    def publish(self, client: Steamship, blocks: List[Block]) -> List[str]:
+        """Signed read URLs for `blocks`, in order. Blocks that need uploading are uploaded in parallel."""
+        unique = OrderedDict((block.id or id(block), block) for block in blocks)
+        with METRICS.span("publish", blocks=len(unique)):
+            if len(unique) == 1:
+                results = [self._publish(client, block) for block in unique.values()]
+            else:
+                results = list(
+                    self._pool.map(lambda b: self._publish(client, b), unique.values())
+                )
+        urls = {key: url for key, (url, _) in zip(unique, results)}
+        saved = sum(saved for _, saved in results)
+        # Repeats of a block within the batch cost nothing either.
+        saved += (len(blocks) - len(unique)) * self.ROUND_TRIPS_PER_PUBLISH
+        with self._lock:
+            self.round_trips_saved += saved
+        if saved:
+            logging.info(f"Published {len(blocks)} blocks; saved {saved} round trips")
+        return [urls[block.id or id(block)] for block in blocks]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "uploads": self.uploads,
+                "refreshes": self.refreshes,
+                "hits": self.hits,
+                "round_trips_saved": self.round_trips_saved,
+                "entries": len(self._entries),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _publish(self, client: Steamship, block: Block) -> Tuple[str, int]:
+        """Returns the block's read URL and the number of round trips saved by the cache."""
+        with self._lock:
+            entry = self._entries.get(block.id) if block.id else None
+            if (
+                entry is not None
+                and entry.expires_at - self.refresh_margin_s > time.time()
+            ):
+                self._entries.move_to_end(block.id)
+                self.hits += 1
+                return entry.url, self.ROUND_TRIPS_PER_PUBLISH
+
+        def round_trips() -> List[str]:
+            if entry is not None:
+                return [self._read_url(client, entry.filepath), entry.filepath]
+            filepath = str(uuid.uuid4())
+            write_url = self._signed_url(client, filepath, SignedUrl.Operation.WRITE)
+            logging.info(f"Got signed url for uploading block content: {write_url}")
+            self._upload(client, block, write_url)
+            return [self._read_url(client, filepath), filepath]
+
+        url, filepath = CASSETTE.call(
+            "signed_url",
+            ["refresh" if entry is not None else "upload", block.id],
+            round_trips,
+        )
+        saved = 2 if entry is not None else 0
+
+        with self._lock:
+            if saved:
+                self.refreshes += 1
+            else:
+                self.uploads += 1
+            if block.id:
+                self._entries[block.id] = _PublishedUrl(
+                    filepath, url, time.time() + self.url_ttl_minutes * 60
+                )
+                self._entries.move_to_end(block.id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return url, saved
+
+    def _upload(self, client: Steamship, block: Block, write_url: str):
+        if self.stream_uploads and (block.content_url or block.id):
+            stream_to_signed_url(write_url, open_block_content(client, block))
+        else:
+            upload_to_signed_url(write_url, block.raw())
+
+    def _read_url(self, client: Steamship, filepath: str) -> str:
+        return self._signed_url(
+            client, filepath, SignedUrl.Operation.READ, self.url_ttl_minutes
+        )
+
+    @staticmethod
+    def _signed_url(
+        client: Steamship,
+        filepath: str,
+        operation: SignedUrl.Operation,
+        expires_in_minutes: Optional[int] = None,
+    ) -> str:
+        return (
+            client.get_workspace()
+            .create_signed_url(
+                SignedUrl.Request(
+                    bucket=SignedUrl.Bucket.PLUGIN_DATA,
+                    filepath=filepath,
+                    operation=operation,
+                    expires_in_minutes=expires_in_minutes,
+                )
             )
+            .signed_url
+        )
+
+
+# Shared by everything in the process that publishes blocks.
+PUBLISHER = BlockPublisher()
+
+
+def make_public_url(client: Steamship, block: Block) -> str:
+    """A signed URL from which `block`'s content can be read, reusing a recent one when possible."""
+    return PUBLISHER.public_url(client, block)
+
+
+def block_references(text: str) -> List[str]:
+    """The ids of the blocks referenced in `text`, in order of first reference."""
+    return list(
+        OrderedDict.fromkeys(
+            match.group(1) or match.group(2)
+            for match in BLOCK_REFERENCE_PATTERN.finditer(text or "")
         )
-        .signed_url
     )
-    upload_to_signed_url(signed_url, block.raw())
-    return read_signed_url
+
+
+def substitute_block_references(text: str, urls: Dict[str, str]) -> str:
+    """Replace the block references in `text` that have an entry in `urls` with it."""
+
+    def _substitute(match) -> str:
+        return urls.get(match.group(1) or match.group(2), match.group())
+
+    return BLOCK_REFERENCE_PATTERN.sub(_substitute, text)
+
+
+class BlockResolver:
+    """Resolves the blocks referenced in agent output to their text or a URL of their content, in one step.
+
+    The metadata of all referenced blocks is fetched concurrently (the API has no batch lookup) and kept in a small
+    LRU cache, as answers often reference the same images again; the blocks that still need a URL are then
+    published together with `BlockPublisher.publish`. Ids that are not blocks are left unresolved.
+    """
+
+    def __init__(
+        self,
+        publisher: BlockPublisher,
+        max_entries: int = 256,
+        max_workers: int = 8,
+    ):
+        self.publisher = publisher
+        self.max_entries = max_entries
+        self._blocks: "OrderedDict[str, Block]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="resolve"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.not_found = 0
+
+    def blocks(self, client: Steamship, block_ids: List[str]) -> Dict[str, Block]:
+        """The blocks with the given ids that exist, fetching those not cached in parallel."""
+        found: Dict[str, Block] = {}
+        with self._lock:
+            for block_id in block_ids:
+                if block_id in self._blocks:
+                    self._blocks.move_to_end(block_id)
+                    found[block_id] = self._blocks[block_id]
+            missing = [block_id for block_id in block_ids if block_id not in found]
+            self.hits += len(block_ids) - len(missing)
+            self.misses += len(missing)
+
+        with METRICS.span("block.get", blocks=len(missing)):
+            if len(missing) == 1:
+                fetched = [self._fetch(client, missing[0])]
+            else:
+                fetched = list(
+                    self._pool.map(lambda i: self._fetch(client, i), missing)
+                )
+
+        with self._lock:
+            for block_id, block in zip(missing, fetched):
+                if block is None:
+                    self.not_found += 1
+                    continue
+                found[block_id] = self._blocks[block_id] = block
+                while len(self._blocks) > self.max_entries:
+                    self._blocks.popitem(last=False)
+        return {
+            block_id: found[block_id] for block_id in block_ids if block_id in found
+        }
+
+    def urls(self, client: Steamship, blocks: List[Block]) -> List[str]:
+        """The text of each text block and a URL of each other block's content, publishing as needed in one batch."""
+        unpublished = [
+            block
+            for block in blocks
+            if not (block.is_text() or block.url or block.content_url)
+        ]
+        published = dict(
+            zip(map(id, unpublished), self.publisher.publish(client, unpublished))
+        )
+        return [
+            block.text
+            if block.is_text()
+            else block.url or block.content_url or published[id(block)]
+            for block in blocks
+        ]
+
+    def resolve(self, client: Steamship, text: str) -> Dict[str, str]:
+        """Map the id of each block referenced in `text` to its text or content URL."""
+        blocks = self.blocks(client, block_references(text))
+        return dict(zip(blocks, self.urls(client, list(blocks.values()))))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_found": self.not_found,
+                "entries": len(self._blocks),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    @staticmethod
+    def _fetch(client: Steamship, block_id: str) -> Optional[Block]:
+        try:
+            return Block.get(client, _id=block_id)
+        except SteamshipError as e:
+            logging.warning(f"Unable to resolve block reference {block_id}: {e}")
+            return None
+
+
+BLOCK_RESOLVER = BlockResolver(PUBLISHER)
 
 
 def print_blocks(client: Steamship, blocks: List[Block]) -> str:
     """Print a list of blocks to console."""
-    output = None
+    blocks = [
+        Block.parse_obj(block) if isinstance(block, dict) else block for block in blocks
+    ]
+    # Blocks referenced from text blocks are resolved, and published, together with the blocks themselves.
+    referenced = BLOCK_RESOLVER.blocks(
+        client,
+        [
+            block_id
+            for block in blocks
+            if block.is_text()
+            for block_id in block_references(block.text)
+        ],
+    )
+    outputs = BLOCK_RESOLVER.urls(client, blocks + list(referenced.values()))
+    reference_urls = dict(zip(referenced, outputs[len(blocks) :]))
 
-    for block in blocks:
-        if isinstance(block, dict):
-            block = Block.parse_obj(block)
+    output = None
+    for block, block_output in zip(blocks, outputs):
         if block.is_text():
-            output = block.text
-        elif block.url:
-            output = block.url
-        elif block.content_url:
-            output = block.content_url
+            output = substitute_block_references(block.text, reference_urls)
         else:
-            url = _make_public_url(client, block)
-            output = url
+            output = block_output
 
     if output:
         return output